@@ -0,0 +1,138 @@
+
+# --- COVARIATE BALANCE DIAGNOSTICS (pbalchk in 300_ps_model.do) ---
+# Replaces the do-file's eight pbalchk calls (each model's covariates, unweighted and
+# weighted by iptw_<model>) with one computation. The covariates of all four models
+# form one n x m matrix C and every weighting one column of an n x 2K matrix W, the
+# K weightings once for the untreated (no_drug == 1) rows and once for the treated.
+# Four products then give every group mean and variance at once:
+#
+#   W' P,  W' C,  W' C^2,  (W^2)' P        P: 1 where C is present, C: 0 where not
+#
+# Variances use the reliability-weights correction, so the unweighted ones are the
+# usual sample variances. As in pbalchk, a model's rows are the complete cases of its
+# own covariates. Standardised differences divide by the pooled SD of the unweighted
+# groups, so weighting only moves the means; variance ratios are untreated / treated.
+#
+# Writes the table (one row per model, weighting and covariate) and a love plot per
+# model, match_<model>.svg, as the do-file's graph export does.
+#
+# Usage: python analysis/balance.py [--input output/data/main.dta]
+#          [--output output/tables/balance.dta] [--figures output/figures] [--stabilised]
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import cox_model
+import propensity_model
+import svg_figures
+
+## |standardised difference| above which a covariate is usually called imbalanced
+THRESHOLD = 0.1
+
+
+def weightings(columns, weights, models=propensity_model.PS_MODELS):
+  # ([(model, "unweighted" | "weighted", covariates)], n x K weight matrix): each model's
+  # complete cases, then the same rows weighted by iptw_<model>
+  labels, matrix = [], []
+  for model, terms in models.items():
+    covariates = cox_model.model_columns({model: terms})
+    rows = np.ones(len(columns[covariates[0]]), dtype=bool)
+    for name in covariates:
+      rows &= ~np.isnan(np.asarray(columns[name], dtype=float))
+    weight = np.nan_to_num(np.asarray(weights[f"iptw_{model}"], dtype=float))
+    labels += [(model, "unweighted", covariates), (model, "weighted", covariates)]
+    matrix += [rows.astype(float), np.where(rows, weight, 0.0)]
+  return labels, np.column_stack(matrix)
+
+
+def moments(C, untreated, W):
+  # {mean_no_drug, mean_drug, var_no_drug, var_drug: K x m} for covariates C (n x m,
+  # missing as nan), weightings W (n x K)
+  present = ~np.isnan(C)
+  values = np.where(present, C, 0.0)
+  both = np.hstack([W * untreated[:, None], W * ~untreated[:, None]])
+  total = both.T @ present
+  first = both.T @ values
+  second = both.T @ (values * values)
+  squares = (both * both).T @ present
+  with np.errstate(divide="ignore", invalid="ignore"):
+    mean = first / total
+    var = (second / total - mean * mean) * total * total / (total * total - squares)
+  K = W.shape[1]
+  return {
+    "mean_no_drug": mean[:K], "mean_drug": mean[K:],
+    "var_no_drug": var[:K], "var_drug": var[K:],
+  }
+
+
+def balance_table(columns, weights, models=propensity_model.PS_MODELS):
+  # DataFrame: model, weighting, covariate, group means and variances, smd, variance_ratio
+  labels, W = weightings(columns, weights, models)
+  covariates = cox_model.model_columns(models)
+  C = np.column_stack([np.asarray(columns[name], dtype=float) for name in covariates])
+  untreated = propensity_model.no_drug(columns) == 1
+  stats = moments(C, untreated, W)
+  # the unweighted weighting of each model is the one before its weighted one
+  reference = [k if weighting == "unweighted" else k - 1 for k, (_, weighting, _) in enumerate(labels)]
+  with np.errstate(divide="ignore", invalid="ignore"):
+    pooled = np.sqrt((stats["var_no_drug"][reference] + stats["var_drug"][reference]) / 2)
+    stats["smd"] = (stats["mean_no_drug"] - stats["mean_drug"]) / pooled
+    stats["variance_ratio"] = stats["var_no_drug"] / stats["var_drug"]
+  rows = []
+  for k, (model, weighting, names) in enumerate(labels):
+    for name in names:
+      j = covariates.index(name)
+      rows.append({"model": model, "weighting": weighting, "covariate": name, **{key: value[k, j] for key, value in stats.items()}})
+  return pd.DataFrame(rows)
+
+
+def love_plot(table, model):
+  # svg_figures.Figure of the model's standardised differences, unweighted (open)
+  # and weighted (filled), covariates top to bottom
+  rows = table[table["model"] == model]
+  unweighted = rows[rows["weighting"] == "unweighted"]
+  weighted = rows[rows["weighting"] == "weighted"]
+  names = list(unweighted["covariate"])
+  positions = np.arange(len(names))[::-1]
+  extent = np.nanmax(np.abs(rows["smd"].to_numpy(dtype=float)), initial=0.0)
+  limit = max(1.5 * THRESHOLD, 1.1 * extent)
+  figure = svg_figures.Figure(
+    xlim=(-limit, limit), ylim=(-1, len(names)), height=max(240, 22 * len(names) + 100),
+    margins=(190, 20, 40, 50), title=f"Covariate balance: {model}", xlabel="Standardised difference",
+  )
+  figure.axes(xticks=np.round(np.linspace(-limit, limit, 5), 2), yticks=positions, ylabels=names)
+  figure.vline(0)
+  for edge in (-THRESHOLD, THRESHOLD):
+    figure.vline(edge, dash="4 3")
+  figure.points(unweighted["smd"], positions, colour=svg_figures.PALETTE[1], filled=False, label="Unweighted")
+  figure.points(weighted["smd"], positions, colour=svg_figures.PALETTE[0], label=f"Weighted (iptw_{model})")
+  figure.legend()
+  return figure
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Covariate balance before and after IPTW for the 300_ps_model models")
+  parser.add_argument("--input", default="output/data/main.dta")
+  parser.add_argument("--output", default="output/tables/balance.dta")
+  parser.add_argument("--figures", default="output/figures", help="directory for the match_<model>.svg love plots")
+  parser.add_argument("--stabilised", action="store_true", help="stabilise the weights by the marginal group probabilities")
+  args = parser.parse_args(argv)
+
+  started = time.perf_counter()
+  columns = ["patient_id", "drug", *cox_model.model_columns(propensity_model.PS_MODELS)]
+  frame = cox_model.load(args.input, columns)
+  _, weights = propensity_model.propensity_weights(frame, stabilised=args.stabilised)
+  table = balance_table(frame, weights)
+  table.to_stata(args.output, write_index=False, version=118)
+  os.makedirs(args.figures, exist_ok=True)
+  for model in propensity_model.PS_MODELS:
+    love_plot(table, model).save(os.path.join(args.figures, f"match_{model}.svg"))
+  print(f"Wrote {len(table)} balance rows to {args.output} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+  main()
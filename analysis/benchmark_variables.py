@@ -0,0 +1,169 @@
+
+# --- PER-VARIABLE EXTRACTION BENCHMARK ---
+# Times every StudyDefinition variable on its own against the local SQLite backend,
+# at several cohort sizes, to show which variables dominate extraction time and to
+# catch regressions between runs.
+#
+# For each size a synthetic database is built once (synthetic_tables.py, reused from
+# --cache-dir if already there) and the whole study is extracted so every variable's
+# inputs exist. Each variable is then evaluated again in isolation, with the backend's
+# codelist and window tables dropped first so it pays for its own setup, recording:
+#
+#   seconds     best wall time of --repeat uninstrumented runs
+#   rows        rows the query reads after codelist and window filtering, before
+#               grouping per patient (0 for variables not read from an event table)
+#   vm_steps    SQLite virtual machine steps, in thousands (a proxy for rows scanned,
+#               including index lookups and rows rejected by the filters)
+#   peak_bytes  peak Python allocation while evaluating (tracemalloc)
+#
+# vm_steps and peak_bytes come from one extra run: tracemalloc slows evaluation by
+# up to several times, unevenly across variables, so it is off while timing.
+#
+# Results are written as JSON ({size: {variable: measurements}}). With --baseline,
+# each variable's time is compared with the same size in an earlier results file and
+# the run exits non-zero listing every variable slower than --threshold times the
+# baseline (times under --min-seconds in both runs are ignored as noise).
+#
+# Usage: python analysis/benchmark_variables.py [--sizes 1000 10000 100000]
+#          [--output output/benchmark_variables.json] [--baseline previous.json]
+#          [--threshold 1.5] [--variables name ...] [--repeat 3]
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import local_backend
+import study_spec
+import synthetic_tables
+
+## progress-handler granularity: vm_steps counts in units of this many steps
+VM_STEP_UNIT = 1000
+
+
+def database(size, seed, cache_dir):
+  os.makedirs(cache_dir, exist_ok=True)
+  path = os.path.join(cache_dir, f"benchmark_{size}_{seed}.sqlite")
+  if not os.path.exists(path):
+    synthetic_tables.populate(path, size, seed).close()
+  return path
+
+
+def matched_rows(extraction, variable):
+  # rows the event query aggregates over
+  if variable.method not in local_backend.EVENT_METHODS:
+    return 0
+  source, where, params, date_column, _ = extraction.source(variable)
+  join, window_where, window_params = extraction.window(variable.kwargs, "x", date_column)
+  where, params = where + window_where, params + window_params
+  sql = f"SELECT COUNT(*) FROM {source}{join}{' WHERE ' + ' AND '.join(where) if where else ''}"
+  return extraction.conn.execute(sql, params).fetchone()[0]
+
+
+def measure(extraction, variable, repeat):
+  # the timed runs are left uninstrumented; a separate run counts VM steps and
+  # traces allocations, as tracemalloc slows evaluation unevenly across variables
+  best = None
+  for _ in range(repeat):
+    extraction.drop_temporary()
+    started = time.perf_counter()
+    extraction.evaluate(variable)
+    seconds = time.perf_counter() - started
+    best = seconds if best is None else min(best, seconds)
+
+  steps = [0]
+
+  def count():
+    steps[0] += 1
+
+  extraction.drop_temporary()
+  extraction.conn.set_progress_handler(count, VM_STEP_UNIT)
+  tracemalloc.start()
+  try:
+    extraction.evaluate(variable)
+    peak = tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+    extraction.conn.set_progress_handler(None, 0)
+  return {
+    "seconds": round(best, 6),
+    "rows": matched_rows(extraction, variable),
+    "vm_steps": steps[0],
+    "peak_bytes": peak,
+  }
+
+
+def benchmark(sizes, names=None, seed=0, repeat=3, cache_dir="output"):
+  # {size: {variable: measurements}}
+  variables = study_spec.load_study()
+  results = {}
+  for size in sizes:
+    conn = local_backend.connect(database(size, seed, cache_dir))
+    extraction = local_backend.Extraction(conn, variables)
+    extraction.run()
+    results[str(size)] = {
+      name: measure(extraction, variables[name], repeat) for name in (names or variables)
+    }
+    conn.close()
+  return results
+
+
+def regressions(results, baseline, threshold, min_seconds):
+  # [(size, variable, baseline seconds, seconds)] slower than threshold x baseline
+  found = []
+  for size, timings in results.items():
+    for name, measured in timings.items():
+      before = baseline.get(size, {}).get(name)
+      if before is None or max(before["seconds"], measured["seconds"]) < min_seconds:
+        continue
+      if measured["seconds"] > threshold * max(before["seconds"], min_seconds):
+        found.append((size, name, before["seconds"], measured["seconds"]))
+  return found
+
+
+def report(results, top=15):
+  for size, timings in results.items():
+    total = sum(measured["seconds"] for measured in timings.values())
+    print(f"\n{size} patients: {total:.2f}s over {len(timings)} variables")
+    slowest = sorted(timings.items(), key=lambda item: -item[1]["seconds"])[:top]
+    for name, measured in slowest:
+      print(
+        f"  {measured['seconds']:8.4f}s  {100 * measured['seconds'] / total:5.1f}%"
+        f"  {measured['rows']:>10} rows  {measured['vm_steps']:>8}k steps  {name}"
+      )
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Time each study variable on its own against the local backend")
+  parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+  parser.add_argument("--variables", nargs="+", default=None)
+  parser.add_argument("--output", default="output/benchmark_variables.json")
+  parser.add_argument("--baseline", default=None, help="earlier results file to compare against")
+  parser.add_argument("--threshold", type=float, default=1.5, help="slowdown ratio counted as a regression")
+  parser.add_argument("--min-seconds", type=float, default=0.005)
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--cache-dir", default="output")
+  args = parser.parse_args(argv)
+
+  results = benchmark(args.sizes, args.variables, args.seed, args.repeat, args.cache_dir)
+  with open(args.output, "w") as f:
+    json.dump({"seed": args.seed, "repeat": args.repeat, "results": results}, f, indent=2)
+  report(results)
+  print(f"\nWrote {args.output}")
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)["results"]
+    found = regressions(results, baseline, args.threshold, args.min_seconds)
+    for size, name, before, after in found:
+      print(f"REGRESSION {name} at {size} patients: {before:.4f}s -> {after:.4f}s ({after / max(before, 1e-9):.1f}x)")
+    if found:
+      sys.exit(1)
+    print(f"No variable slower than {args.threshold}x {args.baseline}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,169 @@
+
+# --- BINARY CODELIST CACHE ---
+# Parsed codelists are stored on disk keyed by the sha that codelists/codelists.json
+# records for each CSV, plus the column (and category column) they were read with:
+#
+#   <cache dir>/<sha>-<column>[-<category column>].bin
+#
+# Each file is a small fixed header followed by NUL-separated UTF-8 blobs for the
+# codes and, for categorised codelists, the categories. Warm starts mmap the file and
+# split the blob instead of parsing CSV text. The header also records the sha, size
+# and mtime of the CSV it was built from, so editing a CSV invalidates its entry
+# automatically.
+#
+# CODELIST_CACHE_DIR overrides the cache location; CODELIST_CACHE=0 disables it.
+# Run this file directly to build the cache for every codelist in codelists.py.
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = b"CLC1"
+## magic, csv sha1, csv size, csv mtime_ns, n codes, has categories, system name,
+## codes blob length, categories blob length
+HEADER = struct.Struct("<4s20sqqII16sQQ")
+SEPARATOR = b"\x00"
+
+_manifests = {}
+
+
+def cache_dir():
+  return os.environ.get("CODELIST_CACHE_DIR", os.path.join("codelists", ".cache"))
+
+
+def enabled():
+  return os.environ.get("CODELIST_CACHE", "1") != "0"
+
+
+def manifest_shas(codelist_dir):
+  # {csv file name: sha} from codelists.json, read once per directory
+  if codelist_dir not in _manifests:
+    path = os.path.join(codelist_dir, "codelists.json")
+    try:
+      with open(path) as f:
+        files = json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+      files = {}
+    _manifests[codelist_dir] = {name: entry.get("sha") for name, entry in files.items()}
+  return _manifests[codelist_dir]
+
+
+def file_sha(path):
+  # sha1 as recorded in codelists.json: line endings normalised and no trailing
+  # newline (the checkout adds one that the downloaded file did not have)
+  with open(path, "rb") as f:
+    content = f.read()
+  return hashlib.sha1(content.replace(b"\r\n", b"\n").rstrip(b"\n")).hexdigest()
+
+
+def cache_path(filename, column, category_column=None):
+  shas = manifest_shas(os.path.dirname(filename) or ".")
+  sha = shas.get(os.path.basename(filename)) or file_sha(filename)
+  key = f"{sha}-{column}"
+  if category_column:
+    key = f"{key}-{category_column}"
+  return os.path.join(cache_dir(), key + ".bin")
+
+
+def write(path, csv_path, system, codes, has_categories):
+  if has_categories:
+    codes, categories = zip(*codes) if codes else ((), ())
+    categories_blob = SEPARATOR.join(str(c).encode() for c in categories)
+  else:
+    categories_blob = b""
+  codes_blob = SEPARATOR.join(str(c).encode() for c in codes)
+  stat = os.stat(csv_path)
+  header = HEADER.pack(
+    MAGIC, bytes.fromhex(file_sha(csv_path)), stat.st_size, stat.st_mtime_ns,
+    len(codes), int(has_categories), system.encode()[:16],
+    len(codes_blob), len(categories_blob),
+  )
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  # write-then-rename so concurrent readers never see a partial file
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+  with os.fdopen(fd, "wb") as f:
+    f.write(header)
+    f.write(codes_blob)
+    f.write(categories_blob)
+  os.replace(tmp, path)
+
+
+def _split(blob, n):
+  if n == 0:
+    return []
+  return bytes(blob).decode().split("\x00")
+
+
+def read(path, csv_path):
+  # Returns (system, codes) or None when the entry is missing, stale or truncated
+  try:
+    f = open(path, "rb")
+  except FileNotFoundError:
+    return None
+  with f:
+    if os.fstat(f.fileno()).st_size < HEADER.size:
+      # empty (which mmap refuses) or cut off inside the header
+      return None
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      (magic, sha, size, mtime_ns, n, has_categories, system,
+       codes_len, categories_len) = HEADER.unpack_from(mm)
+      if magic != MAGIC or len(mm) < HEADER.size + codes_len + categories_len:
+        return None
+      stat = os.stat(csv_path)
+      touched = (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns)
+      if touched:
+        # e.g. a fresh checkout: only trust the entry if the content is unchanged
+        if stat.st_size != size or file_sha(csv_path) != sha.hex():
+          return None
+      view = memoryview(mm)
+      start = HEADER.size
+      codes = _split(view[start:start + codes_len], n)
+      if has_categories:
+        start += codes_len
+        categories = _split(view[start:start + categories_len], n)
+        codes = list(zip(codes, categories))
+      view.release()
+  if touched:
+    _restamp(path, stat)
+  return system.rstrip(b"\x00").decode(), codes
+
+
+def _restamp(path, stat):
+  # record the CSV's new mtime so the next read skips re-hashing it
+  offset = struct.calcsize("<4s20sq")
+  try:
+    with open(path, "r+b") as f:
+      f.seek(offset)
+      f.write(struct.pack("<q", stat.st_mtime_ns))
+  except OSError:
+    pass
+
+
+def load(filename, system, column, category_column, parse):
+  # Codes for one CSV codelist, via the cache when possible; `parse` reads the CSV
+  if not enabled():
+    return parse()
+  path = cache_path(filename, column, category_column)
+  cached = read(path, filename)
+  if cached is not None and cached[0] == system:
+    return cached[1]
+  codes = list(parse())
+  try:
+    write(path, filename, system, codes, bool(category_column))
+  except OSError:
+    # a read-only checkout still works, just without the cache
+    pass
+  return codes
+
+
+if __name__ == "__main__":
+  import codelists
+  from codelist_registry import LazyCodelist, report_load_times
+
+  for value in vars(codelists).values():
+    if isinstance(value, LazyCodelist):
+      value.resolve()
+  report_load_times()
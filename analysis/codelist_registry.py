@@ -0,0 +1,185 @@
+
+# --- LAZY CODELIST REGISTRY ---
+# Drop-in replacements for cohortextractor's codelist_from_csv / combine_codelists.
+# Each call returns a LazyCodelist: a Codelist whose system and has_categories are
+# known straight away, but whose codes are only read from disk the first time a
+# variable actually iterates over, indexes or measures it. Module-level names in
+# codelists.py keep working unchanged, and runs that touch a handful of variables
+# only pay for the CSVs those variables reference.
+#
+# CSV codelists are read through the sha-keyed binary cache in codelist_cache.py.
+# Loaded codes are interned: codelists with the same content share one tuple of
+# codes, and overlapping ones (e.g. solid_organ_transplant_nhsd_snomed_codes and its
+# _new subset) share the code strings themselves. combine_codelists is memoised on
+# its parts, so the unions study_definition.py repeats inline (oral steroids,
+# methotrexate, ...) are one codelist, loaded once.
+# Set CODELIST_LOAD_TIMES=1 to print the per-codelist load time on exit.
+
+import atexit
+import hashlib
+import os
+import sys
+import time
+
+from cohortextractor import codelist_from_csv as _codelist_from_csv
+from cohortextractor.codelistlib import Codelist
+
+import codelist_cache
+
+## Seconds spent resolving each codelist, keyed by codelist name, in load order
+LOAD_TIMES = {}
+## Loaded codes by content digest
+_contents = {}
+## combine_codelists results by the identity of their parts (kept alive with them)
+_combined = {}
+
+
+def _intern(item):
+  # codes are strings, or (code, category) tuples for categorised codelists
+  if isinstance(item, str):
+    return sys.intern(item)
+  if isinstance(item, tuple):
+    return tuple(_intern(value) for value in item)
+  return item
+
+
+def content_digest(codes):
+  # sha1 of the codes in order, as used to intern them
+  digest = hashlib.sha1()
+  for item in codes:
+    digest.update(repr(item).encode())
+    digest.update(b"\n")
+  return digest.hexdigest()
+
+
+def intern_codes(codes):
+  # the shared tuple holding this content, created the first time it is seen
+  codes = list(codes)
+  key = content_digest(codes)
+  if key not in _contents:
+    _contents[key] = tuple(_intern(item) for item in codes)
+  return _contents[key]
+
+
+class LazyCodelist(Codelist):
+
+  def __init__(self, name, loader, system, has_categories=False):
+    super().__init__()
+    self.name = name
+    self.system = system
+    self.has_categories = has_categories
+    self._loader = loader
+    self._loaded = False
+
+  @property
+  def loaded(self):
+    return self._loaded
+
+  def resolve(self):
+    if not self._loaded:
+      start = time.perf_counter()
+      list.extend(self, intern_codes(self._loader()))
+      self._loaded = True
+      LOAD_TIMES[self.name] = time.perf_counter() - start
+    return self
+
+  def __repr__(self):
+    if not self._loaded:
+      return f"<LazyCodelist {self.name} system={self.system} (not loaded)>"
+    return super().__repr__()
+
+  def __reduce__(self):
+    # pickle as a plain, fully loaded Codelist
+    return (_rebuild_codelist, (list(self), self.system, self.has_categories))
+
+
+def _rebuild_codelist(codes, system, has_categories):
+  codes = Codelist(codes)
+  codes.system = system
+  codes.has_categories = has_categories
+  return codes
+
+
+def _resolving(method):
+  def wrapper(self, *args, **kwargs):
+    self.resolve()
+    return method(self, *args, **kwargs)
+  wrapper.__name__ = method.__name__
+  wrapper.__doc__ = method.__doc__
+  return wrapper
+
+
+## Every read-only entry point on list resolves the codes first
+for _method in (
+  "__iter__", "__len__", "__getitem__", "__contains__", "__reversed__",
+  "__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__",
+  "__add__", "__mul__", "__rmul__", "index", "count", "copy",
+):
+  setattr(LazyCodelist, _method, _resolving(getattr(list, _method)))
+
+
+def codelist_from_csv(filename, system, column="code", category_column=None):
+  name = os.path.basename(filename)
+  if category_column:
+    name = f"{name}[{column},{category_column}]"
+  elif column != "code":
+    name = f"{name}[{column}]"
+
+  def parse():
+    return _codelist_from_csv(
+      filename, system=system, column=column, category_column=category_column
+    )
+
+  def load():
+    return codelist_cache.load(filename, system, column, category_column, parse)
+
+  return LazyCodelist(name, load, system, has_categories=bool(category_column))
+
+
+def combine_codelists(first_codelist, *other_codelists):
+  codelists = (first_codelist,) + other_codelists
+  for other in other_codelists:
+    if other.system != first_codelist.system:
+      raise ValueError(
+        f"Cannot combine codelists from different systems: "
+        f"'{first_codelist.system}' and '{other.system}'"
+      )
+    if other.has_categories != first_codelist.has_categories:
+      raise ValueError("Cannot combine categorised and uncategorised codelists")
+  key = tuple(id(codes) for codes in codelists)
+  if key in _combined:
+    return _combined[key][1]
+
+  def load():
+    # same first-seen ordering and de-duplication as cohortextractor
+    seen = set()
+    combined = []
+    for codes in codelists:
+      for item in codes:
+        if item not in seen:
+          seen.add(item)
+          combined.append(item)
+    return combined
+
+  name = "+".join(getattr(codes, "name", "<codelist>") for codes in codelists)
+  combined = LazyCodelist(
+    name, load, first_codelist.system, has_categories=first_codelist.has_categories
+  )
+  _combined[key] = codelists, combined
+  return combined
+
+
+def load_times():
+  return dict(LOAD_TIMES)
+
+
+def report_load_times(file=None):
+  file = file or sys.stderr
+  total = sum(LOAD_TIMES.values())
+  print(f"Loaded {len(LOAD_TIMES)} codelists in {total * 1000:.1f} ms", file=file)
+  for name, seconds in sorted(LOAD_TIMES.items(), key=lambda item: -item[1]):
+    print(f"  {seconds * 1000:8.2f} ms  {name}", file=file)
+
+
+if os.environ.get("CODELIST_LOAD_TIMES"):
+  atexit.register(report_load_times)
@@ -2,7 +2,10 @@
 # --- IMPORT STATEMENTS ---
 
 ## Import code building blocks from cohort extractor package
-from cohortextractor import (codelist, codelist_from_csv, combine_codelists)
+from cohortextractor import codelist
+
+## CSV-backed and combined codelists are resolved lazily, on first use by a variable
+from codelist_registry import codelist_from_csv, combine_codelists
 
 
 # --- CODELISTS ---
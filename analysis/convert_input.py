@@ -0,0 +1,144 @@
+
+# --- TYPED COLUMNAR COPY OF output/input.csv ---
+# Streams the cohortextractor CSV through pyarrow's incremental CSV reader with the
+# column types from study_schema.py, and writes a Parquet (default) or Arrow IPC file:
+#
+#   date -> date32   bool -> bool   int -> int64   float -> float64
+#   category -> dictionary<int32, string>
+#
+# Only one CSV block is held in memory at a time; Parquet row groups hold
+# --row-group-size rows so downstream readers can stream them too. Use
+# read_columns() to load just the columns a stage needs.
+#
+# Usage: python analysis/convert_input.py [--input output/input.csv]
+#          [--output output/input.parquet] [--format parquet|arrow] [--row-group-size N]
+
+import argparse
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+import study_schema
+
+ARROW_TYPES = {
+  "date": pa.date32(),
+  "bool": pa.bool_(),
+  "int": pa.int64(),
+  "float": pa.float64(),
+  "category": pa.string(),
+}
+
+
+def _reader(path, columns, block_size):
+  return pacsv.open_csv(
+    path,
+    read_options=pacsv.ReadOptions(block_size=block_size),
+    convert_options=pacsv.ConvertOptions(
+      column_types={column.name: ARROW_TYPES[column.type] for column in columns},
+      true_values=["1"],
+      false_values=["0"],
+      null_values=[""],
+      strings_can_be_null=True,
+    ),
+  )
+
+
+def _encode(array, known):
+  # dictionary-encode against a running per-column dictionary, seeded with the
+  # expected categories; unseen labels are appended so every batch's dictionary
+  # extends the previous one (which Arrow IPC files require)
+  new = [value for value in pc.unique(array.drop_null()).to_pylist() if value not in known]
+  for value in new:
+    known[value] = len(known)
+  dictionary = pa.array(list(known), pa.string())
+  indices = pc.index_in(array, value_set=dictionary).cast(pa.int32())
+  return pa.DictionaryArray.from_arrays(indices, dictionary)
+
+
+def _typed(batch, dictionaries):
+  # a CSV column missing from the schema (e.g. added since the schema was
+  # derived) keeps its inferred type
+  arrays, fields = [], []
+  for name, array in zip(batch.schema.names, batch.columns):
+    if name in dictionaries:
+      array = _encode(array, dictionaries[name])
+      fields.append(pa.field(name, array.type))
+    else:
+      fields.append(batch.schema.field(name))
+    arrays.append(array)
+  return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def convert(input_path, output_path, file_format="parquet", row_group_size=128_000,
+            block_size=16 << 20):
+  columns = study_schema.load_schema()
+  reader = _reader(input_path, columns, block_size)
+  dictionaries = {
+    column.name: {category: i for i, category in enumerate(column.categories)}
+    for column in columns if column.type == "category"
+  }
+  writer = file_schema = None
+  pending, pending_rows, total = [], 0, 0
+
+  def flush():
+    nonlocal writer, file_schema, pending, pending_rows
+    if not pending:
+      return
+    table = pa.concat_tables(pending)
+    if writer is None:
+      # the first flushed table fixes the file schema
+      file_schema = table.schema
+      if file_format == "parquet":
+        writer = pq.ParquetWriter(output_path, file_schema, compression="zstd")
+      else:
+        options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+        writer = pa.ipc.new_file(output_path, file_schema, options=options)
+    if table.schema != file_schema:
+      table = table.cast(file_schema)
+    if file_format == "parquet":
+      writer.write_table(table, row_group_size=row_group_size)
+    else:
+      writer.write_table(table, max_chunksize=row_group_size)
+    pending, pending_rows = [], 0
+
+  for batch in reader:
+    table = _typed(batch, dictionaries)
+    pending.append(table)
+    pending_rows += table.num_rows
+    total += table.num_rows
+    if pending_rows >= row_group_size:
+      flush()
+  flush()
+  if writer is not None:
+    writer.close()
+  return total
+
+
+def read_columns(path, columns=None):
+  # Load selected columns of a converted file as a pandas DataFrame
+  if str(path).endswith(".parquet"):
+    table = pq.read_table(path, columns=columns)
+  else:
+    with pa.memory_map(str(path)) as source:
+      table = pa.ipc.open_file(source).read_all()
+    if columns is not None:
+      table = table.select(columns)
+  return table.to_pandas()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Write a typed columnar copy of input.csv")
+  parser.add_argument("--input", default="output/input.csv")
+  parser.add_argument("--output")
+  parser.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+  parser.add_argument("--row-group-size", type=int, default=128_000)
+  args = parser.parse_args(argv)
+  output = args.output or f"output/input.{'parquet' if args.format == 'parquet' else 'arrow'}"
+  rows = convert(args.input, output, args.format, args.row_group_size)
+  print(f"Wrote {rows} rows to {output}")
+
+
+if __name__ == "__main__":
+  main()
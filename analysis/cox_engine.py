@@ -0,0 +1,255 @@
+
+# --- NUMPY COX PROPORTIONAL HAZARDS ENGINE ---
+# Fits Cox models the way `stcox ..., vce(robust)` does after
+# `stset stop, id(patient_id) origin(start) enter(start) failure(fail==1)`:
+# Breslow (Stata's default) or Efron ties, Newton-Raphson with step halving, and the
+# robust (Lin-Wei sandwich) variance clustered on patient, i.e. per row here, with
+# Stata's M/(M-1) cluster adjustment.
+#
+# RiskSets does the only sort, once per outcome: it numbers the distinct analysis
+# times, and every risk-set quantity of a fit is then a bincount over those groups
+# followed by a (reverse) cumulative sum, O(n p) per iteration with no n x p x p
+# terms. All the adjustment sets of an outcome reuse it; rows a model cannot use
+# (a missing covariate) get weight 0 instead of a new sort.
+#
+# With m tied events at a time, Efron's l-th term (l = 0..m-1) removes l/m of the
+# tied events' risk; Breslow removes none. Both share the code below through that
+# fraction.
+#
+# Covariates that are constant or collinear on the weighted rows are omitted, as stcox
+# omits them: fit() keeps the first column of each dependent set (independent()),
+# and an omitted column gets coefficient 0 with a missing standard error. A model
+# with no failures on its rows (or no rows) has nothing to estimate, and fit()
+# returns missing coefficients where stcox would stop with an error.
+#
+# Usage: risk_sets = RiskSets(time, event)
+#        result = fit(risk_sets, X, weights=included, ties="breslow")
+#        hazard_ratios = np.exp(result.coef)
+
+from collections import namedtuple
+
+import numpy as np
+
+TIES = ("breslow", "efron")
+## rows per block when forming X'DX and the sandwich, bounding the n x p temporaries
+CHUNK = 1 << 18
+## up to this many distinct times, per-time sums of X are matrix-vector products
+MAX_PRODUCT_GROUPS = 4096
+## invnormal(0.975)
+Z_975 = 1.959963984540054
+## a column whose part not explained by the columns before it has less than this
+## share of its own (weighted) sum of squares is collinear with them
+COLLINEAR = 1e-10
+
+## omitted: bool per column, True where the column was left out as collinear
+CoxFit = namedtuple("CoxFit", "coef se var model_var loglik iterations n events omitted")
+
+
+class RiskSets:
+
+  def __init__(self, time, event):
+    # time: analysis time per row (> 0); event: whether the row ends in a failure.
+    # Rows are kept in time order (order), each distinct time's rows contiguous
+    time = np.asarray(time, dtype=float)
+    self.order = np.argsort(time, kind="stable")
+    self.time = time[self.order]
+    self.event = np.asarray(event, dtype=bool)[self.order]
+    self.starts = np.flatnonzero(np.r_[True, self.time[1:] != self.time[:-1]])
+    self.groups = np.cumsum(np.r_[False, self.time[1:] != self.time[:-1]])
+    self.n, self.n_groups = len(self.time), len(self.starts)
+
+
+def _group_sums(risk_sets, values):
+  # sums of values (rows in time order, 1-d or 2-d) per distinct time
+  return np.add.reduceat(values, risk_sets.starts, axis=0) if len(values) else np.zeros((0,) + values.shape[1:])
+
+
+def _event_sums(risk_sets, rows, values):
+  # sums of values over the given rows only, per distinct time
+  sums = np.zeros((risk_sets.n_groups,) + values.shape[1:])
+  if len(rows):
+    groups = risk_sets.groups[rows]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    sums[groups[starts]] = np.add.reduceat(values, starts, axis=0)
+  return sums
+
+
+def _group_products(risk_sets, weights, X):
+  # (groups, p) of weights @ X per distinct time: one matrix-vector product per time
+  # when there are few (days since start_date), else a blocked reduceat
+  if risk_sets.n_groups <= MAX_PRODUCT_GROUPS:
+    bounds = np.r_[risk_sets.starts, risk_sets.n]
+    return np.stack([weights[start:stop] @ X[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])])
+  return _group_sums(risk_sets, weights[:, None] * X)
+
+
+def gram(X, weights):
+  # X' diag(weights) X for weights >= 0, in row blocks, as symmetric products
+  p = X.shape[1]
+  total = np.zeros((p, p))
+  for start in range(0, len(X), CHUNK):
+    block = X[start:start + CHUNK] * np.sqrt(weights[start:start + CHUNK, None])
+    total += block.T @ block
+  return total
+
+
+def independent(cross_products, tol=COLLINEAR):
+  # bool per column of a gram() matrix X'WX: False where the column is zero on every
+  # weighted row or, within tol, a combination of the columns before it, i.e. the
+  # terms Stata omits as collinear (the first of a dependent set is kept). One
+  # Cholesky pass that skips the dependent columns
+  p = len(cross_products)
+  keep = np.zeros(p, dtype=bool)
+  factor = np.zeros((p, p))
+  for j in range(p):
+    kept = np.flatnonzero(keep)
+    row = np.linalg.solve(factor[np.ix_(kept, kept)], cross_products[kept, j]) if len(kept) else np.zeros(0)
+    residual = cross_products[j, j] - row @ row
+    if cross_products[j, j] > 0 and residual > tol * cross_products[j, j]:
+      keep[j] = True
+      factor[j, kept] = row
+      factor[j, j] = np.sqrt(residual)
+  return keep
+
+
+class _State:
+  # everything one Newton step needs at a given beta; X, weights in time order
+
+  def __init__(self, risk_sets, X, weights, beta, efron):
+    groups, event = risk_sets.groups, risk_sets.event
+    included = weights > 0
+    eta = X @ beta
+    # shifting eta leaves every ratio, and (with the matching loglik) the fit, unchanged
+    eta -= eta[included].max() if included.any() else 0.0
+    risk = np.exp(eta)
+    weighted_risk = weights * risk
+    failed = event & included
+    events = np.flatnonzero(failed)
+
+    # risk set at each distinct time: everyone whose time is at or after it
+    S0 = np.cumsum(_group_sums(risk_sets, weighted_risk)[::-1])[::-1]
+    S1 = np.cumsum(_group_products(risk_sets, weighted_risk, X)[::-1], axis=0)[::-1]
+    tied = _event_sums(risk_sets, events, np.ones(len(events)))
+    E0 = _event_sums(risk_sets, events, weighted_risk[events])
+    E1 = _event_sums(risk_sets, events, weighted_risk[events, None] * X[events])
+    event_weight = _event_sums(risk_sets, events, weights[events])
+
+    # one (time, l) pair per tied event
+    times = np.flatnonzero(tied > 0)
+    m = tied[times].astype("int64")
+    pair = np.repeat(np.arange(len(times)), m)
+    l = np.arange(len(pair)) - np.repeat(np.cumsum(m) - m, m)
+    fraction = l / m[pair] if efron else np.zeros(len(pair))
+    mean_weight = (event_weight[times] / m)[pair]
+    S0_pair = S0[times][pair] - fraction * E0[times][pair]
+    z = (S1[times][pair] - fraction[:, None] * E1[times][pair]) / S0_pair[:, None]
+
+    self.loglik = float(weights[events] @ eta[events] - mean_weight @ np.log(S0_pair))
+    self.score = weights[events] @ X[events] - mean_weight @ z
+
+    # per time: A = sum_l w/S0, B = sum_l w z/S0, and the tied events' own shares,
+    # who are (1 - l/m) of a member of the l-th risk set
+    G, p = risk_sets.n_groups, X.shape[1]
+    A, A_tied = np.zeros(G), np.zeros(G)
+    B, B_tied = np.zeros((G, p)), np.zeros((G, p))
+    share = mean_weight / S0_pair
+    pair_starts = np.cumsum(m) - m
+    A[times] = np.add.reduceat(share, pair_starts)
+    A_tied[times] = np.add.reduceat(share * (1 - fraction), pair_starts)
+    B[times] = np.add.reduceat(share[:, None] * z, pair_starts, axis=0)
+    B_tied[times] = np.add.reduceat((share * (1 - fraction))[:, None] * z, pair_starts, axis=0)
+    self.mean_z = np.zeros((G, p))
+    self.mean_z[times] = np.add.reduceat(z, pair_starts, axis=0) / m[:, None]
+    # each row's sums over the event times at or before its own: c per row, and b
+    # (n x p, formed per block by rows()) from its cumulative and tied parts
+    self.c = np.cumsum(A)[groups] - failed * (A - A_tied)[groups]
+    self.cumulative_B, self.tied_B = np.cumsum(B, axis=0), B - B_tied
+    self.information = gram(X, weighted_risk * self.c) - (z * mean_weight[:, None]).T @ z
+    self.risk, self.failed, self.groups = risk, failed, groups
+
+  def residual_cross_products(self, X, weights):
+    # sum over rows of (w U)(w U)', U the row's score residual
+    p = X.shape[1]
+    total = np.zeros((p, p))
+    for start in range(0, len(X), CHUNK):
+      rows = slice(start, start + CHUNK)
+      x, failed, groups = X[rows], self.failed[rows], self.groups[rows]
+      b = self.cumulative_B[groups] - failed[:, None] * self.tied_B[groups]
+      residual = failed[:, None] * (x - self.mean_z[groups])
+      residual -= self.risk[rows, None] * (x * self.c[rows, None] - b)
+      residual *= weights[rows, None]
+      total += residual.T @ residual
+    return total
+
+
+def _expand(matrix, keep):
+  # p x p matrix with the kept columns' entries and nan for the omitted ones
+  full = np.full((len(keep), len(keep)), np.nan)
+  full[np.ix_(keep, keep)] = matrix
+  return full
+
+
+def fit(risk_sets, X, weights=None, ties="breslow", robust=True, tol=1e-9, max_iter=50, start=None):
+  # CoxFit for covariates X (n x p); rows with weight 0 are left out (their X must
+  # still be finite). var is the robust variance when robust, else the model-based one.
+  # start: initial coefficients (e.g. a previous fit's), else zeros. Collinear columns
+  # are omitted: coefficient 0, and missing in se, var and model_var. Without a failure
+  # on the included rows (or without included rows) nothing is estimable and every
+  # coefficient is missing
+  if ties not in TIES:
+    raise ValueError(f"ties must be one of {TIES}, not {ties!r}")
+  order = risk_sets.order
+  weights = np.ones(risk_sets.n) if weights is None else np.asarray(weights, dtype=float)[order]
+  included = weights > 0
+  X = np.asarray(X, dtype=float)[order]
+  events = int((risk_sets.event & included).sum())
+  if not events:
+    p = X.shape[1]
+    return CoxFit(
+      np.full(p, np.nan), np.full(p, np.nan), np.full((p, p), np.nan), np.full((p, p), np.nan), np.nan,
+      0, int(included.sum()), 0, np.zeros(p, dtype=bool),
+    )
+  # omit the columns that are constant or collinear once the baseline hazard (a
+  # constant) is allowed for: the centred columns alone would keep a constant one
+  # that centring leaves as rounding noise
+  keep = independent(gram(np.column_stack([np.ones(len(X)), X]), weights))[1:]
+  # time order, centred: centring changes no estimate but keeps X'DX well conditioned
+  X = X[:, keep]
+  X -= np.average(X[included], axis=0, weights=weights[included])
+  efron = ties == "efron"
+
+  # a missing start (a fit that had no failures) starts from zero
+  beta = np.zeros(X.shape[1]) if start is None else np.nan_to_num(np.array(start, dtype=float)[keep])
+  state = _State(risk_sets, X, weights, beta, efron)
+  for iteration in range(1, max_iter + 1):
+    step = np.linalg.solve(state.information, state.score)
+    for _ in range(30):
+      trial = _State(risk_sets, X, weights, beta + step, efron)
+      if trial.loglik >= state.loglik - 1e-12 * abs(state.loglik):
+        break
+      step /= 2
+    converged = abs(trial.loglik - state.loglik) <= tol * (abs(state.loglik) + tol) and np.max(np.abs(step), initial=0.0) < 1e-6
+    beta, state = beta + step, trial
+    if converged:
+      break
+
+  model_var = np.linalg.inv(state.information)
+  var = model_var
+  if robust:
+    clusters = int(included.sum())
+    meat = state.residual_cross_products(X, weights)
+    var = model_var @ meat @ model_var * (clusters / max(clusters - 1, 1))
+  coef = np.zeros(len(keep))
+  coef[keep] = beta
+  return CoxFit(
+    coef, np.sqrt(np.diag(_expand(var, keep))), _expand(var, keep), _expand(model_var, keep), state.loglik,
+    iteration, int(included.sum()), events, ~keep,
+  )
+
+
+def hazard_ratios(result, columns):
+  # (hr, lower, upper) 95% CI per column index, as r(table) rows 1, 5 and 6; all
+  # missing for an omitted column
+  coef = np.where(result.omitted[columns], np.nan, result.coef[columns])
+  se = result.se[columns]
+  return np.exp(coef), np.exp(coef - Z_975 * se), np.exp(coef + Z_975 * se)
@@ -0,0 +1,181 @@
+
+# --- COX MODEL SUMMARY (200_cox_model.do) ---
+# Python counterpart of the model loop in 200_cox_model.do: for each outcome it
+# stsets stop_<outcome> from start_date with failure fail_<outcome>==1, fits the five
+# adjustment sets with cox_engine, and writes the same rows to the same
+# cox_model_summary.dta that the do-file's postfile does:
+#
+#   model failure  ptime_all events_all rate_all  ptime_control ... rate_mol
+#                  hr_sot lc_sot uc_sot  hr_pax lc_pax uc_pax  hr_mol lc_mol uc_mol
+#
+# The analysis times are sorted once per outcome and shared by all five models; each
+# model only builds its design matrix (Stata factor-variable terms such as i.drug
+# and 1b.bmi_group become indicator columns) and drops rows with a missing covariate,
+# as stcox does, through their weight. A term that is constant or collinear on those
+# rows is omitted with a note, as stcox omits it, and a drug term omitted that way
+# gets a missing hazard ratio instead of aborting the grid; so does every drug of a
+# model with no failures on its rows (a rare outcome on dummy data). Person-time, events and
+# rates come from person_time.py in one pass over every outcome, with counts of 1-5
+# suppressed.
+#
+# --workers spreads the fits over processes sharing the cohort (parallel_fits.py).
+#
+# Usage: python analysis/cox_model.py [--input output/data/main.dta]
+#          [--output output/tables/cox_model_summary.dta] [--ties breslow|efron]
+#          [--workers N]
+
+import argparse
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+import cox_engine
+import person_time
+
+OUTCOMES = [
+  "ae_diverticulitis_snomed", "new_ae_ra_snomed", "ae_anaphylaxis_icd", "ae_all",
+  "covid_hosp", "all_hosp", "died",
+]
+## the do-file's globals, term for term
+COMORBIDITIES = (
+  "i.region_nhs drugs_consider_risk_contra downs_syndrome solid_cancer haem_disease renal_disease"
+  " liver_disease imid_on_drug immunosupression hiv_aids solid_organ rare_neuro"
+)
+MODELS = {
+  "crude": "i.drug",
+  "agesex": "i.drug age i.sex",
+  "adj": f"i.drug age i.sex {COMORBIDITIES}",
+  "fulladj1": f"i.drug age i.sex {COMORBIDITIES} vaccination_status imd White",
+  "fulladj2": (
+    f"i.drug age i.sex {COMORBIDITIES} vaccination_status imd White 1b.bmi_group diabetes"
+    " chronic_cardiac_disease chronic_respiratory_disease hypertension"
+  ),
+}
+## drug codes and their column suffixes; 0 is the control group
+DRUGS = {1: "sot", 2: "pax", 3: "mol"}
+
+TERM = re.compile(r"^(?:i|(\d+)b)\.(\w+)$")
+
+
+def load(path, columns=None):
+  # main.dta with value-labelled variables as their codes and dates as day numbers
+  return pd.read_stata(path, columns=columns, convert_categoricals=False, convert_dates=False)
+
+
+def model_columns(models=MODELS):
+  # every variable the models refer to
+  names = []
+  for terms in models.values():
+    for term in terms.split():
+      match = TERM.match(term)
+      name = match.group(2) if match else term
+      if name not in names:
+        names.append(name)
+  return names
+
+
+def design(columns, terms, rows=None):
+  # (X, column names, included) from a DataFrame or {name: array}: X has one column
+  # per continuous term and one per non-base level of each factor term, levels taken
+  # from the included rows (those without a missing covariate, within rows), missing
+  # values set to 0
+  parsed = []
+  for term in terms.split():
+    match = TERM.match(term)
+    name = match.group(2) if match else term
+    parsed.append((name, match, np.asarray(columns[name], dtype=float)))
+  n = len(parsed[0][2])
+  included = np.ones(n, dtype=bool) if rows is None else rows.copy()
+  for _, _, values in parsed:
+    included &= ~np.isnan(values)
+  X, names = [], []
+  for name, match, values in parsed:
+    if match is None:
+      X.append(np.where(included, values, 0.0))
+      names.append(name)
+      continue
+    levels = np.unique(values[included])
+    base = float(match.group(1)) if match.group(1) else levels[0] if len(levels) else None
+    for level in levels:
+      if level != base:
+        X.append((included & (values == level)).astype(float))
+        names.append(f"{level:g}.{name}")
+  return (np.column_stack(X) if X else np.zeros((n, 0))), names, included
+
+
+def analysis_time(columns, outcome):
+  # (rows stset keeps, analysis time, failed) for stop_<outcome> from start_date
+  times = np.asarray(columns[f"stop_{outcome}"], dtype=float) - np.asarray(columns["start_date"], dtype=float)
+  kept = ~np.isnan(times) & (times > 0)
+  failed = np.asarray(columns[f"fail_{outcome}"], dtype=float) == 1
+  return kept, times, failed
+
+
+def outcome_risk_sets(columns, outcome):
+  # (kept, RiskSets) over every row; rows stset drops are given time 0, and fit_model
+  # gives them weight 0, so all of an outcome's models share one sort
+  kept, times, failed = analysis_time(columns, outcome)
+  return kept, cox_engine.RiskSets(np.where(kept, times, 0.0), failed & kept)
+
+
+def fit_model(columns, kept, risk_sets, terms, ties="breslow", weights=None):
+  # {hr_sot: ..., uc_mol: ...} for one model of an outcome, weights (e.g. IPTW)
+  # applied to the rows the model can use; rows with a missing weight are dropped
+  X, names, included = design(columns, terms, rows=kept)
+  if weights is not None:
+    weights = np.asarray(weights, dtype=float)
+    included &= ~np.isnan(weights)
+  weights = included.astype(float) if weights is None else np.where(included, weights, 0.0)
+  result = cox_engine.fit(risk_sets, X, weights=weights, ties=ties)
+  if not result.events:
+    print(f"note: no failures among the {result.n} rows of the estimation sample, hazard ratios missing ({terms})")
+  for name in np.array(names)[result.omitted]:
+    print(f"note: {name} omitted because of collinearity ({terms})")
+  row = {}
+  for code, suffix in DRUGS.items():
+    name = f"{code}.drug"
+    hr, lower, upper = cox_engine.hazard_ratios(result, names.index(name)) if name in names else (np.nan,) * 3
+    row.update({f"hr_{suffix}": hr, f"lc_{suffix}": lower, f"uc_{suffix}": upper})
+  return row
+
+
+def summarise(frame, outcomes=OUTCOMES, models=MODELS, ties="breslow"):
+  # DataFrame in cox_model_summary.dta's layout, one row per outcome x model
+  rows = []
+  counts = person_time.outcome_rates(frame, outcomes)
+  for outcome in outcomes:
+    kept, risk_sets = outcome_risk_sets(frame, outcome)
+    for model, terms in models.items():
+      rows.append({"model": model, "failure": outcome, **counts[outcome], **fit_model(frame, kept, risk_sets, terms, ties)})
+  return pd.DataFrame(rows)
+
+
+def write_summary(summary, path):
+  summary.to_stata(path, write_index=False, version=118)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Fit the 200_cox_model outcome x model grid")
+  parser.add_argument("--input", default="output/data/main.dta")
+  parser.add_argument("--output", default="output/tables/cox_model_summary.dta")
+  parser.add_argument("--ties", choices=cox_engine.TIES, default="breslow")
+  parser.add_argument("--workers", type=int, default=1, help="fit in this many processes (0: one per CPU)")
+  args = parser.parse_args(argv)
+
+  started = time.perf_counter()
+  columns = ["patient_id", "start_date", *model_columns()]
+  columns += [f"{prefix}_{outcome}" for outcome in OUTCOMES for prefix in ("stop", "fail")]
+  frame = load(args.input, columns)
+  if args.workers == 1:
+    summary = summarise(frame, ties=args.ties)
+  else:
+    import parallel_fits
+    summary = parallel_fits.summarise(frame, ties=args.ties, workers=args.workers or None)
+  write_summary(summary, args.output)
+  print(f"Wrote {len(summary)} models to {args.output} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,200 @@
+
+# --- STREAMING output/input.csv -> output/input.dta ---
+# Replaces Stata's `import delimited` of the extraction output, and the date(...)
+# conversion loop that follows it in 000_define_covariates.do, with a two-pass
+# streaming conversion in bounded memory:
+#
+#   pass 1  reads the CSV in chunks to count rows and size the string columns
+#   pass 2  reads it again, converts each chunk to a numpy record array and
+#           appends it to a Stata 14+ (format 118) .dta file
+#
+# Column types come from study_schema.py: dates become %td days since 01jan1960,
+# binary flags bytes, ints longs, floats doubles and category columns either
+# numbers (if every label is numeric, as import delimited would do for imd/sgtf)
+# or fixed-width strings. Variable names are lower-cased and cut to 32 characters
+# to match import delimited (clashes become v#), so the .do files see the same
+# names as before.
+#
+# Usage: python analysis/csv_to_dta.py [--input output/input.csv]
+#          [--output output/input.dta] [--chunksize 100000]
+
+import argparse
+import datetime
+import struct
+
+import numpy as np
+import pandas as pd
+
+import study_schema
+
+STATA_EPOCH = np.datetime64("1960-01-01", "D")
+
+## type code, numpy dtype, missing value, display format
+BYTE = (65530, "<i1", 101, "%8.0g")
+LONG = (65528, "<i4", 2147483621, "%12.0g")
+DOUBLE = (65526, "<f8", struct.unpack("<d", bytes.fromhex("000000000000e07f"))[0], "%10.0g")
+DATE = (65528, "<i4", 2147483621, "%td")
+
+
+def stata_name(name):
+  return name.lower()[:32]
+
+
+class _Column:
+
+  def __init__(self, schema_column):
+    self.name = schema_column.name
+    self.stata_name = stata_name(schema_column.name)
+    self.kind = schema_column.type
+    self.width = 1
+    self.numeric_labels = True
+
+  def observe(self, values):
+    # pass 1: track string width and whether all category labels are integers
+    present = values[values != ""]
+    if len(present):
+      self.width = max(self.width, int(present.str.encode("utf-8").str.len().max()))
+      if self.numeric_labels:
+        self.numeric_labels = bool(present.str.fullmatch(r"-?\d+").all())
+
+  def storage(self):
+    if self.kind == "date":
+      return DATE
+    if self.kind == "bool":
+      return BYTE
+    if self.kind == "int":
+      return LONG
+    if self.kind == "float":
+      return DOUBLE
+    if self.numeric_labels:
+      return LONG
+    width = min(self.width, 2045)
+    return (width, f"S{width}", b"", f"%{width}s")
+
+  def convert(self, values):
+    code, dtype, missing, _ = self.storage()
+    if self.kind == "date":
+      days = pd.to_datetime(values, format="%Y-%m-%d", errors="coerce")
+      days = (days.values.astype("datetime64[D]") - STATA_EPOCH).astype("int64")
+      return np.where(values.values == "", missing, days).astype(dtype)
+    if code < 32768:
+      return values.str.encode("utf-8").values.astype(dtype)
+    numbers = pd.to_numeric(values.where(values != ""), errors="coerce")
+    return numbers.fillna(missing).values.astype(dtype)
+
+
+def _chunks(path, chunksize):
+  return pd.read_csv(
+    path, dtype=str, keep_default_na=False, na_filter=False, chunksize=chunksize,
+  )
+
+
+def _tag(name, content=b""):
+  return b"<" + name + b">" + content + b"</" + name + b">"
+
+
+def _fixed(text, width):
+  return text.encode("utf-8")[:width - 1].ljust(width, b"\x00")
+
+
+def _header(columns, nobs, label):
+  now = datetime.datetime.now().strftime("%d %b %Y %H:%M").encode()
+  label = label.encode("utf-8")[:80]
+  return (
+    b"<stata_dta>"
+    + b"<header>"
+    + _tag(b"release", b"118")
+    + _tag(b"byteorder", b"LSF")
+    + _tag(b"K", struct.pack("<H", len(columns)))
+    + _tag(b"N", struct.pack("<Q", nobs))
+    + _tag(b"label", struct.pack("<H", len(label)) + label)
+    + _tag(b"timestamp", struct.pack("<B", len(now)) + now)
+    + b"</header>"
+  )
+
+
+def _metadata(columns):
+  storage = [column.storage() for column in columns]
+  return [
+    (b"variable_types", b"".join(struct.pack("<H", s[0]) for s in storage)),
+    (b"varnames", b"".join(_fixed(c.stata_name, 129) for c in columns)),
+    (b"sortlist", b"\x00\x00" * (len(columns) + 1)),
+    (b"formats", b"".join(_fixed(s[3], 57) for s in storage)),
+    (b"value_label_names", b"\x00" * 129 * len(columns)),
+    (b"variable_labels", b"".join(_fixed(c.name, 321) for c in columns)),
+    (b"characteristics", b""),
+  ]
+
+
+def convert(input_path, output_path, chunksize=100_000, label="output/input.csv"):
+  schema = {column.name: column for column in study_schema.load_schema()}
+
+  ## pass 1: shape of the data
+  columns, nobs = None, 0
+  for chunk in _chunks(input_path, chunksize):
+    if columns is None:
+      columns = [
+        _Column(schema.get(name, study_schema.Column(name, "category", ())))
+        for name in chunk.columns
+      ]
+    for column in columns:
+      if column.kind == "category":
+        column.observe(chunk[column.name])
+    nobs += len(chunk)
+  if columns is None:
+    raise ValueError(f"{input_path} has no header row")
+  # like import delimited, a column whose cut-down name is already taken becomes v#
+  taken = set()
+  for position, column in enumerate(columns, 1):
+    if column.stata_name in taken:
+      column.stata_name = f"v{position}"
+    taken.add(column.stata_name)
+
+  record = np.dtype([(f"f{i}", c.storage()[1]) for i, c in enumerate(columns)])
+  header = _header(columns, nobs, label)
+  sections = _metadata(columns)
+
+  # map offsets can all be computed up front because N is already known
+  offsets = [0, len(header)]
+  position = len(header) + len(_tag(b"map", b"\x00" * 14 * 8))
+  for name, content in sections:
+    offsets.append(position)
+    position += len(_tag(name, content))
+  data_start = position
+  data_end = data_start + len(b"<data>") + nobs * record.itemsize + len(b"</data>")
+  strls_end = data_end + len(_tag(b"strls"))
+  value_labels_end = strls_end + len(_tag(b"value_labels"))
+  offsets += [data_start, data_end, strls_end, value_labels_end,
+              value_labels_end + len(b"</stata_dta>")]
+
+  ## pass 2: stream the rows
+  with open(output_path, "wb") as f:
+    f.write(header)
+    f.write(_tag(b"map", b"".join(struct.pack("<Q", offset) for offset in offsets)))
+    for name, content in sections:
+      f.write(_tag(name, content))
+    f.write(b"<data>")
+    for chunk in _chunks(input_path, chunksize):
+      rows = np.empty(len(chunk), dtype=record)
+      for i, column in enumerate(columns):
+        rows[f"f{i}"] = column.convert(chunk[column.name])
+      f.write(rows.tobytes())
+    f.write(b"</data>")
+    f.write(_tag(b"strls"))
+    f.write(_tag(b"value_labels"))
+    f.write(b"</stata_dta>")
+  return nobs
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Convert input.csv to a Stata .dta file")
+  parser.add_argument("--input", default="output/input.csv")
+  parser.add_argument("--output", default="output/input.dta")
+  parser.add_argument("--chunksize", type=int, default=100_000)
+  args = parser.parse_args(argv)
+  rows = convert(args.input, args.output, args.chunksize)
+  print(f"Wrote {rows} rows to {args.output}")
+
+
+if __name__ == "__main__":
+  main()
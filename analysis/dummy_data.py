@@ -0,0 +1,309 @@
+
+# --- VECTORISED DUMMY DATA ---
+# Generates dummy extraction output from the return_expectations in
+# study_definition.py (read offline via study_spec), for load-testing later stages
+# at any size, e.g. 10M rows rather than project.yaml's population_size.
+#
+# Every column of a chunk is drawn with numpy in one call:
+#
+#   incidence         share of patients with a value (or flagged); rate "universal"
+#                     means everyone unless an incidence is given
+#   date              uniform in [earliest, latest] ("exponential_increase" skews
+#                     late), intersected with the variable's own window, so
+#                     sotrovimab falls within 5 days of covid_test_positive_date and
+#                     the date_treated outcomes after date_treated. Where the range
+#                     misses the window entirely, the window alone is used
+#   category.ratios   labels drawn with the given weights (None -> missing)
+#   int               population_ages, or normal(mean, stddev) rounded
+#   float             normal(mean, stddev)
+#
+# satisfying, categorised_as without ratios, and maximum_of / minimum_of are
+# computed from the columns they refer to (study_expressions), so population and
+# date_treated agree with their inputs. A drawn column that comes out empty for
+# every patient who should have a value raises ValueError. Variables are generated in dependency order;
+# those at the same depth are generated in parallel threads. Each (chunk, variable)
+# has its own seeded stream, so output does not depend on --workers. Chunks are
+# streamed to CSV (cohortextractor layout) or Parquet as they are made.
+#
+# Usage: python analysis/dummy_data.py --rows 10000000 [--output output/dummy_input.csv]
+#          [--format csv|parquet] [--seed 0] [--chunk-size 200000] [--workers N]
+
+import argparse
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+import study_dependencies
+import study_expressions
+import study_schema
+import study_spec
+
+DATE_RETURNING = study_schema.DATE_RETURNING
+## rough England age structure for int.distribution "population_ages"
+POPULATION_AGES = [(0, 17, 0.21), (18, 29, 0.16), (30, 49, 0.26), (50, 69, 0.24), (70, 89, 0.12), (90, 105, 0.01)]
+## returning= values with no category ratios that still need plausible values
+RETURNING_VALUES = {
+  "index_of_multiple_deprivation": lambda rng, n: rng.integers(0, 329, n) * 100.0,
+}
+
+
+## Ordering
+
+def _levels(variables):
+  # [[variable name, ...], ...]: each level only depends on earlier levels
+  graph = study_dependencies.dependencies(variables)
+  depth = {}
+  for name in study_dependencies.topological_order(graph):
+    depth[name] = 1 + max((depth[d] for d in graph[name]), default=-1)
+  levels = [[] for _ in range(max(depth.values()) + 1)]
+  for name in variables:
+    levels[depth[name]].append(name)
+  return levels
+
+
+## Drawing values
+
+def _incidence(expectations, defaults):
+  if "incidence" in expectations:
+    return float(expectations["incidence"])
+  if expectations.get("rate") == "universal":
+    return 1.0
+  return float(defaults.get("incidence", 0.05))
+
+
+def _window(variable, columns, options, n):
+  # (lower, upper) datetime64[D] arrays for the variable's own between / on_or_* window
+  kwargs = variable.kwargs
+  lower, upper = kwargs.get("between") or (kwargs.get("on_or_after"), kwargs.get("on_or_before"))
+  evaluate = study_expressions.date_expression
+  return (
+    evaluate(lower, columns, options, n) if lower else None,
+    evaluate(upper, columns, options, n) if upper else None,
+  )
+
+
+def _dates(rng, n, expectations, defaults, window, options, columns):
+  # datetime64[D] dates inside both the expectation range and the window; where the
+  # two do not overlap (e.g. latest: index_date for a date after
+  # covid_test_positive_date), inside the window alone, bounded on an open side by
+  # the study's default expectations. NaT where the window itself is missing or empty
+  expected = {**defaults.get("date", {}), **expectations.get("date", {})}
+  evaluate = study_expressions.date_expression
+  lower = evaluate(expected.get("earliest", "1900-01-01"), columns, options, n)
+  upper = evaluate(expected.get("latest", "today"), columns, options, n)
+  if window[0] is not None:
+    lower = np.where(np.isnat(window[0]) | (window[0] > lower), window[0], lower)
+  if window[1] is not None:
+    upper = np.where(np.isnat(window[1]) | (window[1] < upper), window[1], upper)
+  disjoint = upper < lower
+  if disjoint.any() and (window[0] is not None or window[1] is not None):
+    fallback = defaults.get("date", {})
+    own_lower = window[0] if window[0] is not None else evaluate(fallback.get("earliest", "1900-01-01"), columns, options, n)
+    own_upper = window[1] if window[1] is not None else evaluate(fallback.get("latest", "today"), columns, options, n)
+    # a one-sided window beyond the default range too: its own bound
+    own_upper = np.where(own_upper < own_lower, own_lower, own_upper)
+    lower = np.where(disjoint, own_lower, lower)
+    upper = np.where(disjoint, own_upper, upper)
+  span = (upper - lower).astype("int64") + 1
+  fraction = rng.random(n)
+  if expectations.get("rate", defaults.get("rate")) == "exponential_increase":
+    fraction = np.sqrt(fraction)
+  valid = ~(np.isnat(lower) | np.isnat(upper)) & (span > 0)
+  offsets = np.floor(fraction * np.where(valid, span, 1)).astype("int64")
+  dates = lower + offsets.astype("timedelta64[D]")
+  dates[~valid] = np.datetime64("NaT")
+  return dates
+
+
+def _window_open(variable, columns, n):
+  # patients whose window is defined: a missing anchor date means no match
+  kwargs = variable.kwargs
+  bounds = list(kwargs.get("between") or []) + [kwargs.get("on_or_after"), kwargs.get("on_or_before")]
+  open_ = np.ones(n, dtype=bool)
+  for bound in bounds:
+    match = study_expressions.DATE.match(str(bound)) if bound else None
+    if match and match.group(1) in columns:
+      open_ &= ~np.isnat(np.asarray(columns[match.group(1)]).astype("datetime64[D]"))
+  return open_
+
+
+def _categories(rng, n, ratios):
+  labels = list(ratios)
+  weights = np.array([float(ratios[label]) for label in labels])
+  drawn = np.searchsorted(np.cumsum(weights / weights.sum()), rng.random(n), side="right")
+  values = np.array(labels + [labels[-1]], dtype=object)[np.minimum(drawn, len(labels) - 1)]
+  return values
+
+
+def _ints(rng, n, expected):
+  if expected.get("distribution") == "population_ages":
+    bands = np.array([(low, high) for low, high, _ in POPULATION_AGES])
+    weights = np.array([weight for _, _, weight in POPULATION_AGES])
+    band = rng.choice(len(bands), size=n, p=weights / weights.sum())
+    return rng.integers(bands[band, 0], bands[band, 1] + 1)
+  values = rng.normal(expected.get("mean", 0), expected.get("stddev", 1), n)
+  return np.maximum(np.rint(values), 0).astype("int64")
+
+
+def generate_variable(variable, columns, options, n, rng):
+  # {output name: array} for one variable; columns holds the variables it depends on
+  defaults = options.get("default_expectations") or {}
+  expectations = variable.expectations
+  returning = variable.returning
+  kwargs = variable.kwargs
+
+  if variable.method in ("maximum_of", "minimum_of"):
+    # missing inputs are skipped: fmax/fmin ignore NaN and NaT
+    inputs = [np.asarray(columns[name]) for name in kwargs["column_names"]]
+    if inputs[0].dtype.kind != "M":
+      inputs = [study_expressions._numeric(values) for values in inputs]
+    reduce = np.fmax if variable.method == "maximum_of" else np.fmin
+    return {variable.name: reduce.reduce(np.stack(inputs), axis=0)}
+  if variable.method == "satisfying":
+    return {variable.name: study_expressions.evaluate(kwargs["expression"], columns, n)}
+  if variable.method == "categorised_as" and not expectations.get("category"):
+    return {variable.name: study_expressions.categorise(kwargs["category_definitions"], columns, n)}
+
+  present = (rng.random(n) < _incidence(expectations, defaults)) & _window_open(variable, columns, n)
+  # the window itself is only needed for dates (month arithmetic is the costly part)
+  needs_dates = returning in DATE_RETURNING or len(variable.outputs) > 1
+  window = _window(variable, columns, options, n) if needs_dates else None
+  result = {}
+  if returning in DATE_RETURNING:
+    values = _dates(rng, n, expectations, defaults, window, options, columns)
+    values[~present] = np.datetime64("NaT")
+  elif returning == "binary_flag":
+    values = present
+  elif "category" in expectations:
+    values = _categories(rng, n, expectations["category"]["ratios"])
+    values[~present] = None
+  elif "int" in expectations or returning in study_schema.INT_RETURNING:
+    values = np.where(present, _ints(rng, n, expectations.get("int", {})), 0)
+  elif "float" in expectations or returning in study_schema.FLOAT_RETURNING:
+    expected = expectations.get("float", {})
+    values = np.round(rng.normal(expected.get("mean", 0), expected.get("stddev", 1), n), 1)
+    values[~present] = np.nan
+  elif returning in RETURNING_VALUES:
+    values = RETURNING_VALUES[returning](rng, n)
+    values[~present] = np.nan
+  else:
+    values = np.full(n, None, dtype=object)
+  result[variable.name] = values
+
+  # implicit date columns
+  for extra in variable.outputs[1:]:
+    dates = _dates(rng, n, expectations, defaults, window, options, columns)
+    dates[~study_expressions.truthy(values)] = np.datetime64("NaT")
+    result[extra] = dates
+  for name, column in result.items():
+    _check_populated(name, column, present if name == variable.name else study_expressions.truthy(values))
+  return result
+
+
+def _check_populated(name, values, expected):
+  # a column with patients who should have a value but none drawn means the
+  # expectations and the window leave nothing to draw from
+  values = np.asarray(values)
+  if values.dtype.kind == "M":
+    missing = np.isnat(values)
+  elif values.dtype.kind == "f":
+    missing = np.isnan(values)
+  elif values.dtype == object:
+    missing = np.equal(values, None)
+  else:
+    return
+  if expected.any() and missing[expected].all():
+    raise ValueError(f"{name}: no value drawn for any of the {int(expected.sum())} patients who should have one")
+
+
+## Chunks
+
+def to_table(schema, columns, csv):
+  # pyarrow table of the schema's output columns; flags are 0/1 ints in CSV output
+  arrays = {}
+  for column in schema:
+    values = columns[column.name]
+    if column.type == "bool":
+      values = study_expressions.truthy(values)
+      values = values.astype("int8") if csv else values
+    elif column.type == "date":
+      values = np.asarray(values).astype("datetime64[D]")
+    elif column.type == "category":
+      values = np.asarray(values, dtype=object)
+    arrays[column.name] = pa.array(values, from_pandas=True)
+  return pa.table(arrays)
+
+
+class Generator:
+
+  def __init__(self, seed=0, workers=None, variables=None):
+    self.variables = variables or study_spec.load_study()
+    self.options = study_spec.study_options()
+    self.schema = study_schema.load_schema(self.variables)
+    self.levels = _levels(self.variables)
+    self.index = {name: i for i, name in enumerate(self.variables)}
+    self.seed = seed
+    self.workers = workers or os.cpu_count()
+
+  def chunk(self, number, start, n):
+    # dict of arrays for rows [start, start + n); deterministic in (seed, number)
+    columns = {}
+
+    def one(name):
+      rng = np.random.default_rng([self.seed, number, self.index[name]])
+      return generate_variable(self.variables[name], columns, self.options, n, rng)
+
+    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+      for level in self.levels:
+        for result in pool.map(one, level):
+          columns.update(result)
+    columns["patient_id"] = np.arange(start + 1, start + n + 1)
+    return columns
+
+  def chunks(self, rows, chunk_size, csv=True):
+    for number, start in enumerate(range(0, rows, chunk_size)):
+      yield to_table(self.schema, self.chunk(number, start, min(chunk_size, rows - start)), csv)
+
+
+def write(path, rows, file_format="csv", seed=0, chunk_size=200_000, workers=None):
+  generator = Generator(seed, workers)
+  writer = None
+  for table in generator.chunks(rows, chunk_size, csv=file_format == "csv"):
+    if writer is None:
+      if file_format == "csv":
+        options = pacsv.WriteOptions(quoting_style="needed")
+        writer = pacsv.CSVWriter(path, table.schema, write_options=options)
+      else:
+        writer = pq.ParquetWriter(path, table.schema, compression="zstd")
+    writer.write_table(table)
+  if writer is not None:
+    writer.close()
+
+
+def _population_size(path=study_dependencies.PROJECT_YAML):
+  with open(path) as f:
+    match = re.search(r"population_size:\s*(\d+)", f.read())
+  return int(match.group(1)) if match else 1000
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Generate dummy extraction output from return_expectations")
+  parser.add_argument("--rows", type=int, default=None, help="default: population_size in project.yaml")
+  parser.add_argument("--output", default="output/dummy_input.csv")
+  parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--chunk-size", type=int, default=200_000)
+  parser.add_argument("--workers", type=int, default=None)
+  args = parser.parse_args(argv)
+  rows = args.rows or _population_size()
+  write(args.output, rows, args.format, args.seed, args.chunk_size, args.workers)
+  print(f"Wrote {rows} rows to {args.output}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,89 @@
+
+# --- PER-PATIENT EVENT INDEX ---
+# The matching events of one source (a table filtered by a codelist and any other
+# non-window condition), laid out per patient and sorted by date in contiguous
+# arrays, so that any window over them is answered for every patient at once:
+#
+#   keys    patient position * SPAN + day number, sorted: each patient's events
+#           form one run, in date order
+#   days    the event dates as day numbers, aligned with keys
+#   values  {name: array} of other columns of the event rows, aligned with keys
+#
+# A window [lower, upper] (per-patient datetime64 arrays, or None for unbounded)
+# becomes two vectorised binary searches of keys, giving each patient's first and
+# one-past-last matching event, from which the first match, last match, count and
+# flag follow without another pass over the events. The comorbidity families, which
+# ask the same codelist over several windows anchored on covid_test_positive_date,
+# build the index once and look it up per window.
+#
+# Usage: index = EventIndex(patient_ids, event_patients, event_days, {"value": ...})
+#        first, last, count = index.lookup(lower, upper)
+
+import numpy as np
+
+## days per patient run in the combined key; covers 1700-2300 with day numbers
+## offset by ORIGIN
+SPAN = 1 << 18
+ORIGIN = np.datetime64("1700-01-01", "D")
+
+
+class EventIndex:
+
+  def __init__(self, patient_ids, event_patients, event_days, values=None):
+    # patient_ids: sorted ids of every patient looked up; events of other patients
+    # are dropped. event_days: datetime64[D] (NaT rows are dropped)
+    event_patients = np.asarray(event_patients, dtype="int64")
+    event_days = np.asarray(event_days, dtype="datetime64[D]")
+    positions = np.searchsorted(patient_ids, event_patients)
+    known = positions < len(patient_ids)
+    known[known] = patient_ids[positions[known]] == event_patients[known]
+    known &= ~np.isnat(event_days)
+    keys = positions[known].astype("int64") * SPAN + (event_days[known] - ORIGIN).astype("int64")
+    order = np.argsort(keys, kind="stable")
+    self.n = len(patient_ids)
+    self.keys = keys[order]
+    self.days = event_days[known][order]
+    self.values = {name: np.asarray(column)[known][order] for name, column in (values or {}).items()}
+
+  def __len__(self):
+    return len(self.keys)
+
+  def _bounds(self, lower, upper):
+    # [start, stop) of each patient's events inside the window
+    base = np.arange(self.n, dtype="int64") * SPAN
+    low = base if lower is None else base + _day_numbers(lower, 0)
+    high = base + SPAN - 1 if upper is None else base + _day_numbers(upper, SPAN - 1)
+    start = np.searchsorted(self.keys, low, side="left")
+    stop = np.searchsorted(self.keys, high, side="right")
+    closed = np.zeros(self.n, dtype=bool)
+    for bound in (lower, upper):
+      if bound is not None:
+        closed |= np.isnat(bound)
+    stop = np.where(closed | (stop < start), start, stop)
+    return start, stop
+
+  def lookup(self, lower=None, upper=None):
+    # (first row, last row, count) per patient; rows are -1 where there is no match
+    start, stop = self._bounds(lower, upper)
+    count = stop - start
+    found = count > 0
+    return np.where(found, start, -1), np.where(found, stop - 1, -1), count
+
+  def take(self, rows, column=None):
+    # per-patient dates (column None) or values at rows from lookup(); missing at -1
+    source = self.days if column is None else self.values[column]
+    found = rows >= 0
+    if source.dtype.kind == "M":
+      result = np.full(self.n, np.datetime64("NaT"), dtype=source.dtype)
+    elif source.dtype.kind == "f":
+      result = np.full(self.n, np.nan)
+    else:
+      result = np.full(self.n, None, dtype=object)
+    result[found] = source[rows[found]]
+    return result
+
+
+def _day_numbers(dates, missing):
+  dates = np.asarray(dates, dtype="datetime64[D]")
+  numbers = (dates - ORIGIN).astype("int64")
+  return np.where(np.isnat(dates), missing, np.clip(numbers, 0, SPAN - 1))
@@ -0,0 +1,253 @@
+
+# --- INCREMENTAL EXTRACTION ---
+# end_date is date.today(), so each rerun of the study re-extracts every patient,
+# although nearly all of them, and most of their covariates, are unchanged since the
+# last run. This extracts against the local backend incrementally: the full set of
+# evaluated columns (hidden variables included) is checkpointed per patient, and a
+# later run re-evaluates a variable only for the patients where it can have changed:
+#
+#   new patients          not in the checkpoint: every variable
+#   open windows          the variable's window ends (per patient) on or after the
+#                         settled date, or has no end, e.g. the 28-day hospitalisation,
+#                         death and adverse-event outcomes of recently treated patients
+#   changed inputs        a variable it depends on changed for that patient, e.g.
+#                         population for a patient with a new positive test
+#
+# The settled date is the last run's date less --lag-days, for records that arrive
+# late. A first-match date found before the settled date is final, whatever the
+# window. Event queries for a partial refresh are restricted to those patients with
+# a joined temporary table; the refreshed values are merged into the checkpoint, the
+# merged output written as a full extraction would be, and the checkpoint replaced.
+#
+# Usage: python analysis/incremental_extraction.py --db output/local.sqlite
+#          [--checkpoint output/checkpoint] [--output output/local_input.csv]
+#          [--lag-days 14] [--as-of YYYY-MM-DD] [--full]
+
+import argparse
+import datetime
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import local_backend
+import study_dependencies
+import study_expressions
+
+DEFAULT_LAG_DAYS = 14
+COLUMNS_FILE = "columns.parquet"
+METADATA_FILE = "checkpoint.json"
+## comparator_from sources are checkpointed as extra columns with this prefix
+COMPARATOR_PREFIX = "__comparator__"
+
+
+## Checkpoints
+
+def save_checkpoint(directory, columns, comparators, as_of):
+  os.makedirs(directory, exist_ok=True)
+  arrays, kinds = {}, {}
+  named = {**columns, **{COMPARATOR_PREFIX + name: values for name, values in comparators.items()}}
+  for name, values in named.items():
+    values = np.asarray(values)
+    kinds[name] = values.dtype.str
+    arrays[name] = pa.array(values.tolist() if values.dtype == object else values, from_pandas=True)
+  pq.write_table(pa.table(arrays), os.path.join(directory, COLUMNS_FILE), compression="zstd")
+  with open(os.path.join(directory, METADATA_FILE), "w") as f:
+    json.dump({"as_of": as_of, "dtypes": kinds}, f, indent=2)
+
+
+def load_checkpoint(directory):
+  # (columns, comparators, as_of), or None when there is no checkpoint
+  metadata_path = os.path.join(directory, METADATA_FILE)
+  if not os.path.exists(metadata_path):
+    return None
+  with open(metadata_path) as f:
+    metadata = json.load(f)
+  table = pq.read_table(os.path.join(directory, COLUMNS_FILE))
+  columns, comparators = {}, {}
+  for name in table.column_names:
+    dtype = np.dtype(metadata["dtypes"][name])
+    if dtype == object:
+      values = np.array(table.column(name).to_pylist(), dtype=object)
+    else:
+      values = table.column(name).to_numpy().astype(dtype)
+    if name.startswith(COMPARATOR_PREFIX):
+      comparators[name[len(COMPARATOR_PREFIX):]] = values
+    else:
+      columns[name] = values
+  return columns, comparators, metadata["as_of"]
+
+
+def _missing(dtype, n):
+  if dtype.kind == "M":
+    return np.full(n, np.datetime64("NaT"), dtype=dtype)
+  if dtype.kind == "f":
+    return np.full(n, np.nan, dtype=dtype)
+  if dtype == object:
+    return np.full(n, None, dtype=object)
+  return np.zeros(n, dtype=dtype)
+
+
+def align(values, old_ids, new_ids):
+  # values for old_ids reindexed to new_ids, missing for patients not in old_ids
+  values = np.asarray(values)
+  if np.array_equal(old_ids, new_ids):
+    return values, np.ones(len(new_ids), dtype=bool)
+  result = _missing(values.dtype, len(new_ids))
+  positions = np.searchsorted(old_ids, new_ids)
+  found = positions < len(old_ids)
+  found[found] = old_ids[positions[found]] == new_ids[found]
+  result[found] = values[positions[found]]
+  return result, found
+
+
+def differs(a, b):
+  # elementwise a != b, with missing equal to missing
+  a, b = np.asarray(a), np.asarray(b)
+  if a.dtype.kind == "M" or b.dtype.kind == "M":
+    a, b = a.astype("datetime64[D]"), b.astype("datetime64[D]")
+    return (a != b) & ~(np.isnat(a) & np.isnat(b))
+  if a.dtype.kind == "f" or b.dtype.kind == "f":
+    a, b = study_expressions._numeric(a), study_expressions._numeric(b)
+    return (a != b) & ~(np.isnan(a) & np.isnan(b))
+  if a.dtype == object or b.dtype == object:
+    missing_a, missing_b = pd.isna(a), pd.isna(b)
+    return np.where(missing_a | missing_b, missing_a != missing_b, a != b).astype(bool)
+  return a != b
+
+
+## Which patients to refresh
+
+def open_window(variable, previous, columns, options, n, settled):
+  # patients whose value for variable could still change after the settled date
+  kwargs = variable.kwargs
+  if variable.method not in local_backend.EVENT_METHODS and variable.method not in (
+    "registered_practice_as_of", "address_as_of", "date_deregistered_from_all_supported_practices",
+  ):
+    # computed from other columns, or fixed per patient (sex, age at a fixed date)
+    return np.zeros(n, dtype=bool)
+  upper = kwargs.get("between", [None, None])[1] if kwargs.get("between") else kwargs.get("on_or_before")
+  if variable.method in ("registered_practice_as_of", "address_as_of"):
+    upper = kwargs["date"]
+  if upper:
+    bound = study_expressions.date_expression(upper, columns, options, n)
+    still_open = ~np.isnat(bound) & (bound >= settled)
+  else:
+    still_open = np.ones(n, dtype=bool)
+  first = not kwargs.get("find_last_match_in_period") and variable.returning in ("date", "date_admitted", "date_of_death")
+  if first and previous is not None:
+    # an earlier first match cannot appear once records before it have settled
+    found = np.asarray(previous).astype("datetime64[D]")
+    still_open &= np.isnat(found) | (found >= settled)
+  return still_open
+
+
+class IncrementalExtraction(local_backend.Extraction):
+
+  def __init__(self, conn, checkpoint, settled, **kwargs):
+    super().__init__(conn, **kwargs)
+    old_columns, old_comparators, _ = checkpoint
+    old_ids = np.asarray(old_columns["patient_id"])
+    self.previous = {name: align(values, old_ids, self.patient_ids)[0] for name, values in old_columns.items()}
+    self.previous_comparators = {
+      name: align(values, old_ids, self.patient_ids)[0] for name, values in old_comparators.items()
+    }
+    self.new = ~align(old_ids, old_ids, self.patient_ids)[1]
+    self.settled = np.datetime64(settled, "D")
+    self.refreshed = {}
+
+  def run(self):
+    graph = study_dependencies.dependencies(self.variables)
+    changed = {}
+    for name in study_dependencies.topological_order(graph):
+      variable = self.variables[name]
+      started = time.perf_counter()
+      previous = self.previous.get(name)
+      mask = self.new | open_window(variable, previous, self.columns, self.options, self.n, self.settled)
+      for dependency in graph[name]:
+        mask |= changed.get(dependency, False)
+      if previous is None:
+        mask[:] = True
+      self.refreshed[name] = int(mask.sum())
+      with self.tracer.span(name, method=variable.method, refreshed=self.refreshed[name]):
+        result = self.merge(variable, mask)
+      self.columns.update(result)
+      # dependents refer to the variable by name, whichever of its outputs changed
+      changed[name] = np.zeros(self.n, dtype=bool)
+      for output, values in result.items():
+        old = self.previous.get(output)
+        if old is None:
+          changed[name] |= mask
+        else:
+          changed[name][mask] |= differs(np.asarray(values)[mask], old[mask])
+      self.timings[name] = time.perf_counter() - started
+    self.columns["patient_id"] = self.patient_ids
+    return self.columns
+
+  def merge(self, variable, mask):
+    # refreshed values where mask is set, checkpointed values elsewhere
+    outputs = variable.outputs or [variable.name]
+    if not mask.any():
+      if variable.name in self.previous_comparators:
+        self.comparators[variable.name] = self.previous_comparators[variable.name]
+      return {output: self.previous[output] for output in outputs}
+    self.restrict(None if mask.all() else mask)
+    result = self.evaluate(variable)
+    if mask.all():
+      return result
+    merged = {}
+    for output, values in result.items():
+      merged[output] = np.where(mask, values, self.previous[output]) if output in self.previous else values
+    if variable.name in self.previous_comparators:
+      refreshed = self.comparators.get(variable.name, np.full(self.n, None, dtype=object))
+      self.comparators[variable.name] = np.where(mask, refreshed, self.previous_comparators[variable.name])
+    return merged
+
+
+def extract(conn, checkpoint_dir, as_of, lag_days=DEFAULT_LAG_DAYS, full=False, tracer=None):
+  # Extraction (full or incremental) whose columns are current as of as_of
+  checkpoint = None if full else load_checkpoint(checkpoint_dir)
+  options = {"tracer": tracer} if tracer is not None else {}
+  if checkpoint is None:
+    extraction = local_backend.Extraction(conn, **options)
+  else:
+    settled = np.datetime64(checkpoint[2], "D") - np.timedelta64(lag_days, "D")
+    extraction = IncrementalExtraction(conn, checkpoint, settled, **options)
+  extraction.run()
+  extraction.restrict(None)
+  save_checkpoint(checkpoint_dir, extraction.columns, extraction.comparators, as_of)
+  return extraction
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Extract the study incrementally from a local SQLite database")
+  parser.add_argument("--db", default="output/local.sqlite")
+  parser.add_argument("--checkpoint", default="output/checkpoint")
+  parser.add_argument("--output", default="output/local_input.csv")
+  parser.add_argument("--lag-days", type=int, default=DEFAULT_LAG_DAYS)
+  parser.add_argument("--as-of", default=datetime.date.today().isoformat(), help="date of this run's data")
+  parser.add_argument("--full", action="store_true", help="ignore the checkpoint and extract everything")
+  args = parser.parse_args(argv)
+
+  conn = local_backend.connect(args.db)
+  started = time.perf_counter()
+  extraction = extract(conn, args.checkpoint, args.as_of, args.lag_days, args.full)
+  rows = local_backend.write(extraction.columns, extraction.variables, args.output)
+  seconds = time.perf_counter() - started
+  if isinstance(extraction, IncrementalExtraction):
+    refreshed = extraction.refreshed
+    reused = sum(1 for count in refreshed.values() if count == 0)
+    print(
+      f"Incremental: {int(extraction.new.sum())} new patients, {reused} of {len(refreshed)} variables"
+      f" reused unchanged, {sum(refreshed.values())} patient-variables refreshed"
+      f" of {extraction.n * len(refreshed)}"
+    )
+  print(f"Extracted {rows} of {extraction.n} patients to {args.output} in {seconds:.1f}s")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,830 @@
+
+# --- LOCAL SQLITE BACKEND ---
+# A stand-in for the TPP database, so study_definition.py can be extracted, timed
+# and tuned offline. It holds the subset of tables behind the patients.* calls used
+# in this study (see SCHEMA) and translates each variable, read statically via
+# study_spec, into one SQL query:
+#
+#   with_these_clinical_events / _medications   clinical_event / medication
+#   admitted_to_hospital                        apcs (+ apcs_diagnosis, apcs_procedure)
+#   with_test_result_in_sgss                    sgss_test
+#   with_covid_therapeutics                     therapeutic
+#   with_high_cost_drugs                        high_cost_drug
+#   died_from_any_cause / ..._death_certificate ons_death (+ ons_death_cause)
+#   with_tpp_vaccination_record                 vaccination
+#   registered_practice_as_of / address_as_of / date_deregistered_...
+#                                               registration / address
+#   age_as_of / sex / most_recent_bmi / with_ethnicity_from_sus
+#                                               patient / clinical_event / sus_ethnicity
+#
+# Variables are evaluated in dependency order. Windows that refer to other columns
+# ("covid_test_positive_date - 6 months") are computed with numpy and loaded once
+# per distinct window into a temporary table that the event query joins; codelists
+# become temporary (code, category) tables, one per distinct code set, which drive
+# the join (CROSS JOIN fixes the order) so events are found through the (code,
+# patient_id, date) indexes rather than by scanning the table. First/last-match
+# values use SQLite's min()/max() bare-column rule, so each variable is a single
+# GROUP BY. satisfying, categorised_as and maximum_of / minimum_of are evaluated on
+# the results with study_expressions. Codes are matched exactly (cohortextractor
+# prefix-matches ICD-10 in APCS); the synthetic tables only use exact codes.
+#
+# By default event variables are not queried one by one: the rows of each distinct
+# source (table, codelist and other non-window conditions) are read once into an
+# event_index.EventIndex, and each variable's window, whatever its anchor, is looked
+# up in it for every patient at once. --no-index uses the per-variable queries above,
+# which give the same columns (a first/last-match value may come from a different
+# row among several on the same day).
+#
+# The windowed binary flags that shared_scans.plan() groups by source table and
+# anchor (the comorbidity_*, drug_* and *_highcostdrugs helpers) skip both: the
+# first such flag evaluated reads its scan's rows once and shared_scans.evaluate()
+# answers every flag of the scan, which the others then take from the cache, along
+# with any maximum_of / minimum_of over that scan's flags (shared_scans.combine(),
+# e.g. imid_drug_HCD over the *_highcostdrugs flags as one row-wise OR). The
+# with_covid_therapeutics columns likewise come from one read of the therapeutic
+# table per set of anchor columns (therapeutics_timeline.timeline()). --no-scans
+# evaluates all of these one by one like any other event variable.
+#
+# Populate a database with synthetic_tables.py, then:
+#   python analysis/local_backend.py --db output/local.sqlite [--output output/local_input.csv]
+#          [--explain] [--trace output/trace.jsonl [--trace-plans]] [--no-index] [--no-scans]
+
+import argparse
+import csv
+import hashlib
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+import dummy_data
+import event_index
+import shared_scans
+import study_dependencies
+import study_expressions
+import study_schema
+import study_spec
+import study_trace
+import therapeutics_timeline
+
+REPO_DIR = os.path.dirname(study_spec.ANALYSIS_DIR)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patient (patient_id INTEGER PRIMARY KEY, date_of_birth TEXT, sex TEXT);
+CREATE TABLE IF NOT EXISTS registration (patient_id INTEGER, start_date TEXT, end_date TEXT, stp_code TEXT, region TEXT);
+CREATE TABLE IF NOT EXISTS address (patient_id INTEGER, start_date TEXT, end_date TEXT, imd INTEGER);
+CREATE TABLE IF NOT EXISTS clinical_event (patient_id INTEGER, date TEXT, code TEXT, numeric_value REAL, comparator TEXT);
+CREATE TABLE IF NOT EXISTS medication (patient_id INTEGER, date TEXT, code TEXT);
+CREATE TABLE IF NOT EXISTS apcs (spell_id INTEGER PRIMARY KEY, patient_id INTEGER, admission_date TEXT, discharge_date TEXT,
+  admission_method TEXT, patient_classification TEXT, primary_diagnosis TEXT);
+CREATE TABLE IF NOT EXISTS apcs_diagnosis (spell_id INTEGER, code TEXT);
+CREATE TABLE IF NOT EXISTS apcs_procedure (spell_id INTEGER, code TEXT);
+CREATE TABLE IF NOT EXISTS sgss_test (patient_id INTEGER, specimen_date TEXT, result TEXT, episode_start INTEGER,
+  case_category TEXT,
+  sgtf TEXT, symptomatic TEXT, variant TEXT);
+CREATE TABLE IF NOT EXISTS therapeutic (patient_id INTEGER, date TEXT, therapeutic TEXT, status TEXT, indication TEXT,
+  risk_group TEXT, region TEXT);
+CREATE TABLE IF NOT EXISTS high_cost_drug (patient_id INTEGER, date TEXT, drug_name TEXT);
+CREATE TABLE IF NOT EXISTS ons_death (patient_id INTEGER PRIMARY KEY, date TEXT, underlying_cause TEXT);
+CREATE TABLE IF NOT EXISTS ons_death_cause (patient_id INTEGER, code TEXT);
+CREATE TABLE IF NOT EXISTS vaccination (patient_id INTEGER, date TEXT, target_disease TEXT);
+CREATE TABLE IF NOT EXISTS sus_ethnicity (patient_id INTEGER, group_6 TEXT);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS ix_clinical_event ON clinical_event (code, patient_id, date);
+CREATE INDEX IF NOT EXISTS ix_medication ON medication (code, patient_id, date);
+CREATE INDEX IF NOT EXISTS ix_apcs ON apcs (patient_id, admission_date);
+CREATE INDEX IF NOT EXISTS ix_apcs_diagnosis ON apcs_diagnosis (code, spell_id);
+CREATE INDEX IF NOT EXISTS ix_apcs_procedure ON apcs_procedure (code, spell_id);
+CREATE INDEX IF NOT EXISTS ix_sgss_test ON sgss_test (patient_id, specimen_date);
+CREATE INDEX IF NOT EXISTS ix_therapeutic ON therapeutic (patient_id, date);
+CREATE INDEX IF NOT EXISTS ix_high_cost_drug ON high_cost_drug (drug_name, patient_id, date);
+CREATE INDEX IF NOT EXISTS ix_ons_death_cause ON ons_death_cause (code, patient_id);
+CREATE INDEX IF NOT EXISTS ix_vaccination ON vaccination (patient_id, date);
+CREATE INDEX IF NOT EXISTS ix_registration ON registration (patient_id, start_date);
+CREATE INDEX IF NOT EXISTS ix_address ON address (patient_id, start_date);
+CREATE INDEX IF NOT EXISTS ix_sus_ethnicity ON sus_ethnicity (patient_id);
+"""
+
+## methods translated by Extraction.source(); the rest read patient-level tables
+EVENT_METHODS = {
+  "with_these_clinical_events", "with_these_medications", "admitted_to_hospital",
+  "with_test_result_in_sgss", "with_covid_therapeutics", "with_high_cost_drugs",
+  "with_tpp_vaccination_record", "died_from_any_cause", "with_these_codes_on_death_certificate",
+  "most_recent_bmi",
+}
+## codes most_recent_bmi reads from clinical_event (CTV3 and SNOMED BMI)
+BMI_CODES = ("22K..", "60621009")
+COVID_VACCINE_DISEASE = "SARS-2 CORONAVIRUS"
+## shared_scans source -> (coded table, code column, joins to its patient-level table,
+## date column) of the rows a scan reads
+SCAN_SOURCES = {
+  ("with_these_clinical_events", "codelist"): ("clinical_event x", "x.code", "", "x.date"),
+  ("with_these_medications", "codelist"): ("medication x", "x.code", "", "x.date"),
+  ("admitted_to_hospital", "with_these_diagnoses"): (
+    "apcs_diagnosis ad", "ad.code", " CROSS JOIN apcs x ON x.spell_id = ad.spell_id", "x.admission_date",
+  ),
+  ("admitted_to_hospital", "with_these_procedures"): (
+    "apcs_procedure ap", "ap.code", " CROSS JOIN apcs x ON x.spell_id = ap.spell_id", "x.admission_date",
+  ),
+  ("with_high_cost_drugs", "drug_name_matches"): ("high_cost_drug x", "x.drug_name", "", "x.date"),
+  ("with_high_cost_drugs", None): ("high_cost_drug x", "x.drug_name", "", "x.date"),
+}
+DEFAULT_THERAPEUTIC_STATUSES = ("Approved", "Treatment Complete")
+
+
+def connect(path):
+  conn = sqlite3.connect(path)
+  conn.executescript(SCHEMA)
+  # the temporary codelist tables have no statistics, and SQLite would otherwise
+  # build a throwaway index on each event table rather than use INDEXES
+  conn.execute("PRAGMA automatic_index = OFF")
+  return conn
+
+
+def create_indexes(conn):
+  conn.executescript(INDEXES)
+  conn.execute("ANALYZE")
+
+
+## Codelists
+
+def load_codes(name, specs, codelist_dir=REPO_DIR):
+  # [(code, category)] for a codelists.py name, read straight from the CSVs
+  spec = specs[name]
+  if spec.codes is not None:
+    return [(code, None) for code in spec.codes]
+  if spec.path is not None:
+    with open(os.path.join(codelist_dir, spec.path), newline="") as f:
+      return [
+        (row[spec.column], row[spec.category_column] if spec.category_column else None)
+        for row in csv.DictReader(f) if row.get(spec.column)
+      ]
+  # combine_codelists: the file-backed parts with the same system
+  codes, seen = [], set()
+  for part in specs.values():
+    if part.path and part.system == spec.system and os.path.basename(part.path) in spec.sources:
+      for code, category in load_codes(part.name, specs, codelist_dir):
+        if code not in seen:
+          seen.add(code)
+          codes.append((code, category))
+  return codes
+
+
+## Query translation
+
+class Extraction:
+
+  def __init__(
+    self, conn, variables=None, codelist_dir=REPO_DIR, tracer=study_trace.NULL, patients=None, indexed=True,
+    scans=True,
+  ):
+    self.conn = conn
+    self.tracer = tracer
+    # answer event variables from shared EventIndexes rather than one query each
+    self.indexed = indexed
+    self.variables = variables or study_spec.load_study()
+    # binary flags answered by shared_scans, one read per (source table, anchor), and
+    # with_covid_therapeutics columns answered by therapeutics_timeline
+    self.scanned, self.timelined = {}, {}
+    if scans:
+      for scan in shared_scans.plan(self.variables):
+        self.scanned.update((flag.name, scan) for flag in scan.flags)
+      # a maximum_of / minimum_of over one scan's flags (imid_drug_HCD) comes with them
+      for variable in self.variables.values():
+        inputs = variable.kwargs.get("column_names", []) if variable.method in ("maximum_of", "minimum_of") else []
+        if inputs and all(name in self.scanned for name in inputs):
+          if len({id(self.scanned[name]) for name in inputs}) == 1:
+            self.scanned[variable.name] = self.scanned[inputs[0]]
+      self.timelined = {query.name: query for query in therapeutics_timeline.plan(self.variables)}
+    self.options = study_spec.study_options()
+    self.specs = study_spec.load_codelists()
+    self.codelist_dir = codelist_dir
+    # a caller's patient list (a shard, or an incremental batch) restricts every event
+    # query to those patients; by default the extraction covers the whole table
+    restricted = patients is not None
+    if patients is None:
+      patients = [row[0] for row in conn.execute("SELECT patient_id FROM patient ORDER BY patient_id")]
+    self.patient_ids = np.sort(np.asarray(patients, dtype="int64"))
+    self.n = len(self.patient_ids)
+    self.columns = {}
+    self.comparators = {}
+    self.timings = {}
+    # codelist names -> (table, codes), and code set digest -> table
+    self._codelists = {}
+    self._code_sets = {}
+    self._windows = {}
+    self._indexes = {}
+    self._scans = {}
+    self._memberships = {}
+    self._window_number = 0
+    # patients event queries are restricted to (see restrict()), and their table
+    self.subset = None
+    self._subset_key = None
+    self._subset_mask = None
+    if restricted:
+      # only these patients' events are read
+      self.restrict(np.ones(self.n, dtype=bool))
+
+  # -- temporary tables
+
+  def codelist_table(self, ref):
+    # a codelists.py reference, or literal codes such as drug names
+    if isinstance(ref, study_spec.CodelistRef):
+      names = tuple(ref.names)
+    else:
+      names = (ref,) if isinstance(ref, str) else tuple(ref)
+    if names in self._codelists:
+      table, size = self._codelists[names]
+      with self.tracer.span("codelist_upload", codelists=names, codes=size, cache_hit=True):
+        return table
+    with self.tracer.span("codelist_upload", codelists=names, cache_hit=False) as event:
+      rows = {}
+      for name in names:
+        codes = load_codes(name, self.specs, self.codelist_dir) if name in self.specs else [(name, None)]
+        for code, category in codes:
+          rows.setdefault(code, category)
+      event["codes"] = len(rows)
+      # the same code set under other names (e.g. a union spelt in another order)
+      # reuses its table, and so its event indexes
+      content = hashlib.sha1(repr(sorted(rows.items(), key=lambda row: row[0])).encode()).hexdigest()
+      if content in self._code_sets:
+        event["shared"] = True
+        table = self._code_sets[content]
+      else:
+        table = f"temp.codelist_{len(self._code_sets)}"
+        self.conn.execute(f"CREATE TABLE {table} (code TEXT PRIMARY KEY, category TEXT)")
+        self.conn.executemany(f"INSERT INTO {table} VALUES (?, ?)", rows.items())
+        self._code_sets[content] = table
+      self._codelists[names] = table, len(rows)
+    return table
+
+  def drop_temporary(self):
+    # forget cached codelist and window tables, so the next query rebuilds its own
+    for table in list(self._code_sets.values()) + list(self._windows.values()):
+      self.conn.execute(f"DROP TABLE {table}")
+    self._codelists, self._code_sets, self._windows, self._indexes = {}, {}, {}, {}
+    self._scans, self._memberships = {}, {}
+
+  def restrict(self, mask):
+    # limit event queries to the patients where mask is true; None lifts the limit.
+    # Windowed queries only load those patients' windows; others join temp.subset
+    key = None if mask is None else mask.tobytes()
+    if key == self._subset_key:
+      return
+    for window in [window for window in self._windows if window[-1] is not None]:
+      self.conn.execute(f"DROP TABLE {self._windows.pop(window)}")
+    self.conn.execute("DROP TABLE IF EXISTS temp.subset")
+    self._scans = {}
+    self.subset, self._subset_key = None, key
+    self._subset_mask = mask
+
+  def _subset_table(self):
+    if self.subset is None:
+      self.conn.execute("CREATE TABLE temp.subset (patient_id INTEGER PRIMARY KEY)")
+      self.conn.executemany(
+        "INSERT INTO temp.subset VALUES (?)", ((i,) for i in self.patient_ids[self._subset_mask].tolist())
+      )
+      self.subset = "temp.subset"
+    return self.subset
+
+  def _date_bound(self, expression):
+    # SQL literal for a constant bound, or a per-patient datetime64 array
+    match = study_expressions.DATE.match(str(expression))
+    if match and match.group(1) in self.columns:
+      return None, study_expressions.date_expression(expression, self.columns, self.options, self.n)
+    value = study_expressions.date_expression(expression, {}, self.options, 1)[0]
+    return str(value), None
+
+  def window(self, kwargs, alias, date_column):
+    # (join SQL, where SQL, params) restricting alias.date_column to the window
+    lower, upper = kwargs.get("between") or (kwargs.get("on_or_after"), kwargs.get("on_or_before"))
+    bounds = [(">=", lower), ("<=", upper)]
+    where, params, per_patient = [], [], []
+    for operator, expression in bounds:
+      if not expression:
+        continue
+      literal, values = self._date_bound(expression)
+      if literal is not None:
+        where.append(f"{alias}.{date_column} {operator} ?")
+        params.append(literal)
+      else:
+        per_patient.append((operator, expression, values))
+    if not per_patient:
+      return "", where, params
+    key = tuple((operator, expression) for operator, expression, _ in per_patient) + (self._subset_key,)
+    with self.tracer.span("window_upload", window=key[:-1], cache_hit=key in self._windows) as event:
+      if key not in self._windows:
+        event["rows"] = self._window_table(key, per_patient)
+    table = self._windows[key]
+    join = f" JOIN {table} w ON w.patient_id = {alias}.patient_id"
+    for operator, _, _ in per_patient:
+      where.append(f"{alias}.{date_column} {operator} w.{'lower' if operator == '>=' else 'upper'}")
+    return join, where, params
+
+  def _window_table(self, key, per_patient):
+    # load per-patient bounds into a temporary table; the number of patients with one
+    table = f"temp.window_{self._window_number}"
+    self._window_number += 1
+    self.conn.execute(f"CREATE TABLE {table} (patient_id INTEGER PRIMARY KEY, lower TEXT, upper TEXT)")
+    lower_values = next((v for o, _, v in per_patient if o == ">="), None)
+    upper_values = next((v for o, _, v in per_patient if o == "<="), None)
+    defined = np.ones(self.n, dtype=bool) if self._subset_key is None else self._subset_mask.copy()
+    for _, _, values in per_patient:
+      defined &= ~np.isnat(values)
+    as_text = lambda values: values[defined].astype(str).tolist() if values is not None else [None] * int(defined.sum())
+    self.conn.executemany(
+      f"INSERT INTO {table} VALUES (?, ?, ?)",
+      zip(self.patient_ids[defined].tolist(), as_text(lower_values), as_text(upper_values)),
+    )
+    self._windows[key] = table
+    return int(defined.sum())
+
+  @staticmethod
+  def _in(column, values, where, params):
+    values = [values] if isinstance(values, str) else list(values)
+    where.append(f"{column} IN ({', '.join('?' * len(values))})")
+    params.extend(values)
+
+  # -- event sources: (FROM ... JOIN ..., where, params, date column, {returning: column})
+
+  def source(self, variable):
+    kwargs, method = variable.kwargs, variable.method
+    where, params = [], []
+    if method in ("with_these_clinical_events", "with_these_medications"):
+      table = "clinical_event" if method == "with_these_clinical_events" else "medication"
+      codes = self.codelist_table(kwargs["codelist"])
+      values = {"category": "c.category"}
+      if table == "clinical_event":
+        values.update(numeric_value="x.numeric_value", comparator="x.comparator")
+      return f"{codes} c CROSS JOIN {table} x ON x.code = c.code", where, params, "date", values
+    if method == "admitted_to_hospital":
+      joins = ["apcs x"]
+      if kwargs.get("with_these_diagnoses"):
+        codes = self.codelist_table(kwargs["with_these_diagnoses"])
+        joins = [f"{codes} c CROSS JOIN apcs_diagnosis ad ON ad.code = c.code CROSS JOIN apcs x ON x.spell_id = ad.spell_id"]
+      if kwargs.get("with_these_primary_diagnoses"):
+        codes = self.codelist_table(kwargs["with_these_primary_diagnoses"])
+        joins.append(f"JOIN {codes} cp ON cp.code = x.primary_diagnosis")
+      if kwargs.get("with_these_procedures"):
+        codes = self.codelist_table(kwargs["with_these_procedures"])
+        joins.append(f"JOIN apcs_procedure ap ON ap.spell_id = x.spell_id JOIN {codes} cq ON cq.code = ap.code")
+      if kwargs.get("with_admission_method"):
+        self._in("x.admission_method", kwargs["with_admission_method"], where, params)
+      if kwargs.get("with_patient_classification"):
+        self._in("x.patient_classification", kwargs["with_patient_classification"], where, params)
+      values = {"date_discharged": "x.discharge_date", "primary_diagnosis": "x.primary_diagnosis"}
+      return " ".join(joins), where, params, "admission_date", values
+    if method == "with_test_result_in_sgss":
+      result = kwargs.get("test_result", "any")
+      if result != "any":
+        self._in("x.result", result, where, params)
+      if kwargs.get("restrict_to_earliest_specimen_date", True):
+        # only the first specimen of each infection episode, as in SGSS_Positive
+        where.append("x.episode_start = 1")
+      values = {
+        "case_category": "x.case_category", "s_gene_target_failure": "x.sgtf",
+        "symptomatic": "x.symptomatic", "variant": "x.variant",
+      }
+      return "sgss_test x", where, params, "specimen_date", values
+    if method == "with_covid_therapeutics":
+      self._in("x.status", kwargs.get("with_these_statuses") or DEFAULT_THERAPEUTIC_STATUSES, where, params)
+      for argument, column in (("with_these_therapeutics", "therapeutic"), ("with_these_indications", "indication")):
+        if kwargs.get(argument):
+          self._in(f"x.{column}", kwargs[argument], where, params)
+      return "therapeutic x", where, params, "date", {"risk_group": "x.risk_group", "region": "x.region"}
+    if method == "with_high_cost_drugs":
+      if not kwargs.get("drug_name_matches"):
+        # any high-cost drug
+        return "high_cost_drug x", where, params, "date", {}
+      codes = self.codelist_table(kwargs["drug_name_matches"])
+      return f"{codes} c CROSS JOIN high_cost_drug x ON x.drug_name = c.code", where, params, "date", {}
+    if method == "with_tpp_vaccination_record":
+      self._in("x.target_disease", kwargs.get("target_disease_matches", COVID_VACCINE_DISEASE), where, params)
+      return "vaccination x", where, params, "date", {}
+    if method == "died_from_any_cause":
+      return "ons_death x", where, params, "date", {}
+    if method == "with_these_codes_on_death_certificate":
+      codes = self.codelist_table(kwargs["codelist"])
+      if kwargs.get("match_only_underlying_cause"):
+        return f"ons_death x JOIN {codes} c ON c.code = x.underlying_cause", where, params, "date", {}
+      return (
+        f"ons_death x JOIN ons_death_cause oc ON oc.patient_id = x.patient_id JOIN {codes} c ON c.code = oc.code",
+        where, params, "date", {},
+      )
+    if method == "most_recent_bmi":
+      self._in("x.code", BMI_CODES, where, params)
+      source = "clinical_event x"
+      if kwargs.get("minimum_age_at_measurement"):
+        source += " JOIN patient p ON p.patient_id = x.patient_id"
+        where.append("x.date >= date(p.date_of_birth, ?)")
+        params.append(f"+{int(kwargs['minimum_age_at_measurement'])} years")
+      return source, where, params, "date", {"float": "x.numeric_value"}
+    return None
+
+  def event_query(self, variable):
+    # SQL returning (patient_id, date, value) per patient with a match
+    source, where, params, date_column, values = self.source(variable)
+    join, window_where, window_params = self.window(variable.kwargs, "x", date_column)
+    where, params = where + window_where, params + window_params
+    if self._subset_key is not None and not join:
+      join = f" JOIN {self._subset_table()} s ON s.patient_id = x.patient_id"
+    returning = "float" if variable.method == "most_recent_bmi" else variable.returning
+    last = variable.kwargs.get("find_last_match_in_period") or variable.method == "most_recent_bmi"
+    if returning == "number_of_matches_in_period":
+      select = "COUNT(*), NULL"
+    else:
+      select = f"{'MAX' if last else 'MIN'}(x.{date_column}), {values.get(returning, 'NULL')}"
+    if returning == "numeric_value":
+      # kept for comparator_from
+      select += ", x.comparator"
+    sql = (
+      f"SELECT x.patient_id, {select} FROM {source}{join}"
+      f"{' WHERE ' + ' AND '.join(where) if where else ''} GROUP BY x.patient_id"
+    )
+    return sql, params
+
+  # -- results
+
+  def _empty(self, kind):
+    # missing values of a _kind(): NaT, False, 0, NaN or None
+    if kind == "date":
+      return np.full(self.n, np.datetime64("NaT"), dtype="datetime64[D]")
+    if kind == "bool":
+      return np.zeros(self.n, dtype=bool)
+    if kind == "int":
+      return np.zeros(self.n, dtype="int64")
+    if kind == "float":
+      return np.full(self.n, np.nan)
+    return np.full(self.n, None, dtype=object)
+
+  def _scatter(self, rows, column, target, convert=None):
+    if not rows:
+      return target
+    ids = np.fromiter((row[0] for row in rows), dtype="int64", count=len(rows))
+    positions = np.searchsorted(self.patient_ids, ids)
+    # events of patients without a patient row are dropped
+    known = positions < self.n
+    known[known] = self.patient_ids[positions[known]] == ids[known]
+    values = [row[column] for row, keep in zip(rows, known) if keep]
+    if convert is not None:
+      values = convert(values)
+    target[positions[known]] = values
+    return target
+
+  def event_index(self, variable):
+    # EventIndex of the variable's source rows before windowing, shared by every
+    # variable with the same source (e.g. one codelist asked over several windows)
+    source, where, params, date_column, values = self.source(variable)
+    key = (source, tuple(where), tuple(params), self._subset_key)
+    with self.tracer.span("index_build", cache_hit=key in self._indexes) as event:
+      if key not in self._indexes:
+        if self._subset_key is not None:
+          source += f" JOIN {self._subset_table()} s ON s.patient_id = x.patient_id"
+        selected = "".join(f", {column}" for column in values.values())
+        sql = f"SELECT x.patient_id, x.{date_column}{selected} FROM {source}{' WHERE ' + ' AND '.join(where) if where else ''}"
+        event["sql"] = sql
+        rows = self.conn.execute(sql, params).fetchall()
+        event["rows"] = len(rows)
+        columns = list(zip(*rows)) if rows else [()] * (2 + len(values))
+        value_columns = {}
+        for name, column in zip(values, columns[2:]):
+          if name in ("numeric_value", "float"):
+            value_columns[name] = np.array([np.nan if value is None else value for value in column], dtype=float)
+          elif name == "date_discharged":
+            value_columns[name] = _dates(column)
+          else:
+            value_columns[name] = np.array(column, dtype=object)
+        self._indexes[key] = event_index.EventIndex(
+          self.patient_ids, np.array(columns[0], dtype="int64"), _dates(columns[1]), value_columns,
+        )
+    return self._indexes[key]
+
+  def _window_bounds(self, kwargs):
+    # per-patient (lower, upper) datetime64 arrays of the window, None where unbounded
+    lower, upper = kwargs.get("between") or (kwargs.get("on_or_after"), kwargs.get("on_or_before"))
+    bounds = []
+    for expression in (lower, upper):
+      if not expression:
+        bounds.append(None)
+        continue
+      literal, values = self._date_bound(expression)
+      bounds.append(np.full(self.n, np.datetime64(literal, "D")) if literal is not None else values)
+    return bounds
+
+  def evaluate_indexed(self, variable):
+    index = self.event_index(variable)
+    with self.tracer.span("index_lookup") as event:
+      first, last, count = index.lookup(*self._window_bounds(variable.kwargs))
+      event["patients"] = int((count > 0).sum())
+    with self.tracer.span("post_process"):
+      returning = "float" if variable.method == "most_recent_bmi" else variable.returning
+      use_last = variable.kwargs.get("find_last_match_in_period") or variable.method == "most_recent_bmi"
+      rows = last if use_last else first
+      dates = index.take(rows)
+      kind = _kind(returning)
+      if returning == "number_of_matches_in_period":
+        values = count.astype("int64")
+      elif kind == "bool":
+        values = count > 0
+      elif returning == "date_discharged":
+        values = index.take(rows, "date_discharged")
+      elif kind == "date":
+        values = dates
+      elif returning in index.values:
+        values = index.take(rows, returning)
+      else:
+        values = self._empty(kind)
+      if returning == "numeric_value":
+        self.comparators[variable.name] = index.take(rows, "comparator")
+      result = {variable.name: values}
+      for extra in variable.outputs[1:]:
+        result[extra] = dates
+      return result
+
+  def evaluate_events(self, variable):
+    if self.indexed:
+      return self.evaluate_indexed(variable)
+    sql, params = self.event_query(variable)
+    with self.tracer.span("scan", sql=sql, params=len(params)) as event:
+      if self.tracer.plans:
+        event["plan"] = [row[-1] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+      rows = self.conn.execute(sql, params).fetchall()
+      event["rows"] = len(rows)
+    with self.tracer.span("post_process"):
+      return self._event_columns(variable, rows)
+
+  def scan_events(self, scan):
+    # DataFrame (patient_id, code, date) of the rows of a shared_scans source whose
+    # code is in one of the scan's codelists (every row for a codelist-less scan)
+    table, code, joins, date_column = SCAN_SOURCES[scan.source]
+    names = sorted({name for flag in scan.flags for name in flag.codelists})
+    source = f"{table}{joins}"
+    if names:
+      source = f"{self.codelist_table(names)} c CROSS JOIN {table} ON {code} = c.code{joins}"
+    if self._subset_key is not None:
+      source += f" JOIN {self._subset_table()} s ON s.patient_id = x.patient_id"
+    rows = self.conn.execute(f"SELECT x.patient_id, {code}, {date_column} FROM {source}").fetchall()
+    columns = list(zip(*rows)) if rows else [(), (), ()]
+    return pd.DataFrame({
+      "patient_id": np.array(columns[0], dtype="int64"),
+      "code": np.array(columns[1], dtype=object),
+      "date": pd.to_datetime(_dates(columns[2])),
+    })
+
+  def scan_codelists(self, scan):
+    # (codelists, compiled membership) of a scan, built once per extraction: the
+    # codes of its flags and the CodelistMembership that tags scanned rows with them
+    if scan.source not in self._memberships:
+      codelists = {}
+      for flag in scan.flags:
+        for name in flag.codelists:
+          codes = load_codes(name, self.specs, self.codelist_dir) if name in self.specs else [(name, None)]
+          codelists[name] = {code for code, _ in codes}
+      self._memberships[scan.source] = codelists, shared_scans.membership(shared_scans.scan_codelists(scan, codelists))
+    return self._memberships[scan.source]
+
+  def evaluate_scanned(self, variable):
+    # every flag of the variable's scan, and the maximum_of / minimum_of columns over
+    # them, from one read of its source, kept for the scan's other columns while the
+    # anchor column and patient subset are unchanged
+    scan = self.scanned[variable.name]
+    anchor = self.columns[scan.anchor]
+    key = (scan.source, scan.anchor, hashlib.sha1(anchor.tobytes()).hexdigest())
+    with self.tracer.span("shared_scan", source=list(scan.source), flags=len(scan.flags), cache_hit=key in self._scans) as event:
+      if key not in self._scans:
+        events = self.scan_events(scan)
+        event["rows"] = len(events)
+        codelists, compiled = self.scan_codelists(scan)
+        anchors = pd.DataFrame({scan.anchor: anchor}, index=self.patient_ids)
+        flags = shared_scans.evaluate([scan], {scan.source: events}, codelists, anchors, {scan.source: compiled})
+        self._scans[key] = shared_scans.combine(flags, self.variables)
+    return {variable.name: self._scans[key][variable.name].to_numpy(dtype=bool)}
+
+  def therapeutics(self):
+    # DataFrame of the therapeutic table's rows (the subset's, if restricted)
+    key = ("therapeutic", self._subset_key)
+    if key not in self._scans:
+      source = "therapeutic x"
+      if self._subset_key is not None:
+        source += f" JOIN {self._subset_table()} s ON s.patient_id = x.patient_id"
+      names = ["patient_id", "date", "therapeutic", "status", "indication", "risk_group", "region"]
+      rows = self.conn.execute(f"SELECT {', '.join('x.' + name for name in names)} FROM {source}").fetchall()
+      self._scans[key] = pd.DataFrame(rows, columns=names)
+    return self._scans[key]
+
+  def evaluate_timeline(self, variable):
+    # the variable and every other with_covid_therapeutics column anchored on the
+    # same columns from one pass over the table, cached like the shared scans
+    outputs = {column for other in self.variables.values() for column in other.outputs}
+    anchors = therapeutics_timeline.anchor_columns(self.timelined[variable.name], outputs)
+    key = ("timeline", anchors) + tuple(hashlib.sha1(self.columns[name].tobytes()).hexdigest() for name in anchors)
+    with self.tracer.span("timeline", anchors=list(anchors), cache_hit=key in self._scans) as event:
+      if key not in self._scans:
+        table = self.therapeutics()
+        event["rows"] = len(table)
+        queries = [
+          query for query in self.timelined.values()
+          if therapeutics_timeline.anchor_columns(query, outputs) == anchors
+        ]
+        frame = pd.DataFrame({name: self.columns[name] for name in anchors}, index=self.patient_ids)
+        self._scans[key] = therapeutics_timeline.timeline(table, queries, frame, self.options)
+    values = self._scans[key][variable.name].to_numpy()
+    kind = _kind(variable.returning)
+    if kind == "date":
+      values = values.astype("datetime64[D]")
+    elif kind == "bool":
+      values = values.astype(bool)
+    else:
+      values = np.array([None if pd.isna(value) else value for value in values], dtype=object)
+    return {variable.name: values}
+
+  def _event_columns(self, variable, rows):
+    returning = "float" if variable.method == "most_recent_bmi" else variable.returning
+    kind = _kind(returning)
+    dates = self._scatter(rows, 1, self._empty("date"), _dates)
+    result = {}
+    if kind == "date":
+      result[variable.name] = self._scatter(rows, 2, self._empty("date"), _dates) if returning == "date_discharged" else dates
+    elif kind == "bool":
+      result[variable.name] = self._scatter(rows, 1, self._empty("bool"), lambda v: True)
+    elif returning == "number_of_matches_in_period":
+      result[variable.name] = self._scatter(rows, 1, self._empty("int"))
+    else:
+      result[variable.name] = self._scatter(rows, 2, self._empty(kind))
+    if rows and len(rows[0]) > 3:
+      self.comparators[variable.name] = self._scatter(rows, 3, self._empty("category"))
+    extras = variable.outputs[1:]
+    for extra in extras:
+      result[extra] = dates
+    return result
+
+  def evaluate_patient(self, variable):
+    kwargs, method = variable.kwargs, variable.method
+    if method == "sex":
+      rows = self.conn.execute("SELECT patient_id, sex FROM patient").fetchall()
+      return {variable.name: self._scatter(rows, 1, self._empty("category"))}
+    if method == "age_as_of":
+      rows = self.conn.execute("SELECT patient_id, date_of_birth FROM patient").fetchall()
+      born = self._scatter(rows, 1, self._empty("date"), _dates)
+      on = study_expressions.date_expression(kwargs["reference_date"], self.columns, self.options, self.n)
+      years = on.astype("datetime64[Y]").astype(int) - born.astype("datetime64[Y]").astype(int)
+      before_birthday = (on - on.astype("datetime64[Y]")) < (born - born.astype("datetime64[Y]"))
+      age = np.where(np.isnat(on) | np.isnat(born), 0, years - before_birthday)
+      return {variable.name: age.astype("int64")}
+    if method == "with_ethnicity_from_sus":
+      rows = self.conn.execute("SELECT patient_id, group_6 FROM sus_ethnicity GROUP BY patient_id").fetchall()
+      return {variable.name: self._scatter(rows, 1, self._empty("category"))}
+    if method in ("registered_practice_as_of", "address_as_of"):
+      table, column = ("address", "imd") if method == "address_as_of" else (
+        "registration", "region" if kwargs.get("returning") == "nuts1_region_name" else "stp_code"
+      )
+      join, where, params = self.window({"on_or_before": kwargs["date"]}, "x", "start_date")
+      where.append("(x.end_date IS NULL OR x.end_date >= COALESCE(w.upper, ?))" if join else "(x.end_date IS NULL OR x.end_date >= ?)")
+      params.append(params[0] if params else "9999-12-31")
+      sql = f"SELECT x.patient_id, MAX(x.start_date), x.{column} FROM {table} x{join} WHERE {' AND '.join(where)} GROUP BY x.patient_id"
+      rows = self.conn.execute(sql, params).fetchall()
+      values = self._scatter(rows, 2, self._empty("category"))
+      if method == "address_as_of" and kwargs.get("round_to_nearest"):
+        step = kwargs["round_to_nearest"]
+        values = np.array([None if v is None else float(round(v / step) * step) for v in values], dtype=object)
+      return {variable.name: values}
+    if method == "date_deregistered_from_all_supported_practices":
+      join, where, params = self.window(kwargs, "x", "end_date")
+      sql = (
+        f"SELECT x.patient_id, MAX(x.end_date) FROM registration x{join}"
+        f"{' WHERE ' + ' AND '.join(where) if where else ''} GROUP BY x.patient_id"
+        " HAVING SUM(x.end_date IS NULL) = 0"
+      )
+      rows = self.conn.execute(sql, params).fetchall()
+      return {variable.name: self._scatter(rows, 1, self._empty("date"), _dates)}
+    return None
+
+  def evaluate(self, variable):
+    kwargs, method = variable.kwargs, variable.method
+    if variable.name in self.scanned:
+      return self.evaluate_scanned(variable)
+    if variable.name in self.timelined:
+      return self.evaluate_timeline(variable)
+    if method in EVENT_METHODS:
+      return self.evaluate_events(variable)
+    if method in ("satisfying", "categorised_as", "maximum_of", "minimum_of", "comparator_from"):
+      with self.tracer.span("expression"):
+        return self.evaluate_columns(variable)
+    with self.tracer.span("patient_query"):
+      result = self.evaluate_patient(variable)
+    if result is None:
+      raise NotImplementedError(f"{variable.name}: patients.{variable.method} has no local table")
+    return result
+
+  def evaluate_columns(self, variable):
+    # variables computed from other columns
+    kwargs, method = variable.kwargs, variable.method
+    if method == "satisfying":
+      return {variable.name: study_expressions.evaluate(kwargs["expression"], self.columns, self.n)}
+    if method == "categorised_as":
+      return {variable.name: study_expressions.categorise(kwargs["category_definitions"], self.columns, self.n)}
+    if method in ("maximum_of", "minimum_of"):
+      inputs = [np.asarray(self.columns[name]) for name in kwargs["column_names"]]
+      if inputs[0].dtype.kind != "M":
+        inputs = [study_expressions._numeric(values) for values in inputs]
+      reduce = np.fmax if method == "maximum_of" else np.fmin
+      return {variable.name: reduce.reduce(np.stack(inputs), axis=0)}
+    if method == "comparator_from":
+      return {variable.name: self.comparators.get(kwargs["source"], self._empty("category"))}
+
+  def run(self):
+    # {column: array} for every variable, hidden helpers included
+    graph = study_dependencies.dependencies(self.variables)
+    for name in study_dependencies.topological_order(graph):
+      variable = self.variables[name]
+      started = time.perf_counter()
+      with self.tracer.span(name, method=variable.method):
+        self.columns.update(self.evaluate(variable))
+      self.timings[name] = time.perf_counter() - started
+    self.columns["patient_id"] = self.patient_ids
+    return self.columns
+
+  def explain(self, name):
+    # EXPLAIN QUERY PLAN rows for an event variable (run() first for its anchors)
+    sql, params = self.event_query(self.variables[name])
+    return [row[-1] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def _kind(returning):
+  if returning in study_schema.DATE_RETURNING or returning == "date_discharged":
+    return "date"
+  if returning in study_schema.BOOL_RETURNING:
+    return "bool"
+  if returning in study_schema.INT_RETURNING:
+    return "int"
+  if returning in study_schema.FLOAT_RETURNING:
+    return "float"
+  return "category"
+
+
+def _dates(values):
+  return np.array([value or "NaT" for value in values], dtype="datetime64[D]")
+
+
+def output_table(columns, variables, csv=True, population=True):
+  # pyarrow table of the output columns, population rows only
+  schema = study_schema.load_schema(variables)
+  if population and "population" in columns:
+    keep = study_expressions.truthy(columns["population"])
+    columns = {name: np.asarray(values)[keep] for name, values in columns.items()}
+  return dummy_data.to_table(schema, columns, csv=csv)
+
+
+def write_table(table, path):
+  if path.endswith(".parquet"):
+    pq.write_table(table, path, compression="zstd")
+  else:
+    pacsv.write_csv(table, path, pacsv.WriteOptions(quoting_style="needed"))
+
+
+def write(columns, variables, path, population=True):
+  # cohortextractor-style CSV (or Parquet) of the output columns
+  table = output_table(columns, variables, not path.endswith(".parquet"), population)
+  write_table(table, path)
+  return table.num_rows
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Extract the study from a local SQLite database")
+  parser.add_argument("--db", default="output/local.sqlite")
+  parser.add_argument("--output", default="output/local_input.csv")
+  parser.add_argument("--explain", action="store_true", help="print the query plan of each event variable")
+  parser.add_argument("--trace", default=None, help=f"JSONL trace file (default ${study_trace.ENVIRONMENT})")
+  parser.add_argument("--trace-plans", action="store_true", help="include query plans in the trace")
+  parser.add_argument("--no-index", action="store_true", help="query each event variable separately")
+  parser.add_argument("--no-scans", action="store_true", help="evaluate the shared_scans flags one by one too")
+  args = parser.parse_args(argv)
+
+  conn = connect(args.db)
+  tracer = study_trace.from_environment(args.trace, args.trace_plans)
+  extraction = Extraction(conn, tracer=tracer, indexed=not args.no_index, scans=not args.no_scans)
+  started = time.perf_counter()
+  columns = extraction.run()
+  with tracer.span("write", path=args.output):
+    rows = write(columns, extraction.variables, args.output)
+  tracer.close()
+  print(f"Extracted {rows} of {extraction.n} patients to {args.output} in {time.perf_counter() - started:.1f}s")
+  slowest = sorted(extraction.timings.items(), key=lambda item: -item[1])[:10]
+  for name, seconds in slowest:
+    print(f"  {seconds:8.3f}s  {name}")
+  if args.explain:
+    for name, variable in extraction.variables.items():
+      if variable.method in EVENT_METHODS:
+        print(f"\n{name}:")
+        for line in extraction.explain(name):
+          print(f"  {line}")
+
+
+if __name__ == "__main__":
+  main()
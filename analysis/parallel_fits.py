@@ -0,0 +1,134 @@
+
+# --- SHARED-MEMORY PARALLEL MODEL FITTING ---
+# Fans the Cox fits of cox_model.py (7 outcomes x 5 adjustment sets) out to a pool
+# of worker processes. The cohort columns the fits read (covariates, start_date,
+# stop_* / fail_*, and any weight columns such as IPTW weights) are copied once into
+# a single shared-memory block; workers map it as read-only numpy views, so starting
+# a fit copies nothing but its task tuple, and each worker sorts an outcome's risk
+# sets at most once (cached per process).
+#
+# Workers are started with spawn and one BLAS thread each, so N workers use N cores
+# instead of contending for threads; tasks are submitted largest model first, which
+# keeps every core busy until the end. Results come back in task order, in the rows
+# of the existing summary tables.
+#
+# Usage: python analysis/cox_model.py --workers 32
+#        with SharedColumns(columns) as shared:
+#          rows = fit_all(shared, [FitTask("died", "crude", "i.drug")], workers=8)
+
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import cox_model
+import person_time
+
+## variables that cap BLAS / OpenMP threads in each spawned worker
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
+
+## weights names a shared column (None: unweighted)
+FitTask = namedtuple("FitTask", "outcome model terms weights")
+FitTask.__new__.__defaults__ = (None,)
+
+
+class SharedColumns:
+  # {name: float64 array} of equal length, held in one shared-memory block
+
+  def __init__(self, columns):
+    names = list(columns)
+    n = len(next(iter(columns.values())))
+    self.memory = shared_memory.SharedMemory(create=True, size=max(8 * n * len(names), 1))
+    block = np.ndarray((len(names), n), dtype="float64", buffer=self.memory.buf)
+    for row, name in enumerate(names):
+      block[row] = np.asarray(columns[name], dtype=float)
+    self.spec = (self.memory.name, names, n)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    self.memory.close()
+    self.memory.unlink()
+
+
+def attach(spec):
+  # (SharedMemory, {name: read-only view}) for a SharedColumns.spec
+  name, names, n = spec
+  memory = shared_memory.SharedMemory(name=name)
+  block = np.ndarray((len(names), n), dtype="float64", buffer=memory.buf)
+  block.flags.writeable = False
+  return memory, {column: block[row] for row, column in enumerate(names)}
+
+
+## per worker process: the attached columns and each outcome's (kept, RiskSets)
+_worker = {}
+
+
+def _initialise(spec, ties):
+  _worker["memory"], _worker["columns"] = attach(spec)
+  _worker["ties"] = ties
+  _worker["risk_sets"] = {}
+
+
+def _fit(task):
+  columns = _worker["columns"]
+  if task.outcome not in _worker["risk_sets"]:
+    _worker["risk_sets"][task.outcome] = cox_model.outcome_risk_sets(columns, task.outcome)
+  kept, risk_sets = _worker["risk_sets"][task.outcome]
+  weights = None if task.weights is None else columns[task.weights]
+  return cox_model.fit_model(columns, kept, risk_sets, task.terms, _worker["ties"], weights)
+
+
+def _cost(task):
+  # fits scale with the number of covariate terms
+  return len(task.terms.split())
+
+
+@contextmanager
+def single_threaded_pool(workers=None, initializer=None, initargs=()):
+  # spawn-context ProcessPoolExecutor whose workers each run BLAS on one thread
+  saved = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+  os.environ.update({variable: "1" for variable in THREAD_VARIABLES})
+  try:
+    with ProcessPoolExecutor(
+      max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context("spawn"),
+      initializer=initializer, initargs=initargs,
+    ) as pool:
+      yield pool
+  finally:
+    for variable, value in saved.items():
+      if value is None:
+        os.environ.pop(variable, None)
+      else:
+        os.environ[variable] = value
+
+
+def fit_all(shared, tasks, workers=None, ties="breslow"):
+  # fit_model() result for each task, in task order
+  order = sorted(range(len(tasks)), key=lambda i: -_cost(tasks[i]))
+  with single_threaded_pool(workers, _initialise, (shared.spec, ties)) as pool:
+    futures = {i: pool.submit(_fit, tasks[i]) for i in order}
+    return [futures[i].result() for i in range(len(tasks))]
+
+
+def summarise(frame, outcomes=cox_model.OUTCOMES, models=cox_model.MODELS, ties="breslow", workers=None):
+  # cox_model.summarise() with the fits spread over worker processes
+  names = ["start_date", *cox_model.model_columns(models)]
+  names += [f"{prefix}_{outcome}" for outcome in outcomes for prefix in ("stop", "fail")]
+  tasks = [FitTask(outcome, model, terms) for outcome in outcomes for model, terms in models.items()]
+  with SharedColumns({name: frame[name] for name in names}) as shared:
+    fits = fit_all(shared, tasks, workers, ties)
+  counts = person_time.outcome_rates(frame, outcomes)
+  return pd.DataFrame([
+    {"model": task.model, "failure": task.outcome, **counts[task.outcome], **fit}
+    for task, fit in zip(tasks, fits)
+  ])
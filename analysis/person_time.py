@@ -0,0 +1,62 @@
+
+# --- PERSON-TIME AND EVENT RATES (stptime in 200_cox_model.do) ---
+# The do-file calls stptime five times per outcome and model (all patients, then
+# drug == 0/1/2/3), each a scan of the data, and redacts small event counts by hand
+# after each call. Here the analysis times of every outcome form one n x outcomes
+# matrix (stop_<outcome> - start_date where positive, else 0) and the drug groups
+# one n x groups indicator matrix M, so person-time and events for every group and
+# outcome are two products, M' T and M' F.
+#
+# suppress() is the one place small numbers are handled: event counts of 1-5 are
+# set to missing, and so is the rate computed from them (rate x ptime would give the
+# count back). Everything written from these tables goes through it.
+#
+# Usage: rates = outcome_rates(frame, ["died", "covid_hosp"])
+#        row = rates["died"]    # {"ptime_all": ..., "events_all": ..., "rate_mol": ...}
+
+import numpy as np
+import pandas as pd
+
+## stptime's groups: everyone, then each drug code (0 is the control group)
+GROUPS = {"all": None, "control": 0, "sot": 1, "pax": 2, "mol": 3}
+## event counts in this range are suppressed
+REDACT = (1, 5)
+
+
+def group_indicators(drug, groups=GROUPS):
+  # n x groups float matrix, 1 where the row is in the group
+  drug = np.asarray(drug, dtype=float)
+  return np.column_stack([np.ones(len(drug)) if code is None else (drug == code).astype(float) for code in groups.values()])
+
+
+def rate_table(columns, outcomes, groups=GROUPS):
+  # DataFrame, one row per outcome, of ptime_/events_/rate_<group> before suppression
+  start = np.asarray(columns["start_date"], dtype=float)
+  times = np.column_stack([np.asarray(columns[f"stop_{outcome}"], dtype=float) - start for outcome in outcomes])
+  kept = ~np.isnan(times) & (times > 0)
+  failed = np.column_stack([np.asarray(columns[f"fail_{outcome}"], dtype=float) == 1 for outcome in outcomes]) & kept
+  M = group_indicators(columns["drug"], groups)
+  ptime = M.T @ np.where(kept, times, 0.0)
+  events = M.T @ failed.astype(float)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    rate = np.where(ptime > 0, events / ptime, np.nan)
+  table = {}
+  for j, group in enumerate(groups):
+    table[f"ptime_{group}"] = ptime[j]
+    table[f"events_{group}"] = events[j]
+    table[f"rate_{group}"] = rate[j]
+  return pd.DataFrame(table, index=pd.Index(outcomes, name="failure"))
+
+
+def suppress(table, groups=GROUPS):
+  # copy of a rate_table() with events of REDACT[0]-REDACT[1], and their rates, missing
+  table = table.copy()
+  for group in groups:
+    small = table[f"events_{group}"].between(*REDACT)
+    table.loc[small, [f"events_{group}", f"rate_{group}"]] = np.nan
+  return table
+
+
+def outcome_rates(columns, outcomes, groups=GROUPS):
+  # {outcome: {column: value}} of suppressed person-time, events and rates
+  return suppress(rate_table(columns, outcomes, groups), groups).to_dict(orient="index")
@@ -0,0 +1,167 @@
+
+# --- BOOTSTRAP CONFIDENCE INTERVALS FOR THE IPTW HAZARD RATIOS ---
+# The robust SEs of propensity_model.py treat the iptw_<model> weights as known.
+# This resamples patients with replacement and, in every replicate, refits the four
+# propensity models, recomputes the weights and refits the weighted Cox models on
+# ae_all, giving percentile intervals that carry the uncertainty of the estimated
+# propensity scores. Output is cox_model_propensity.dta's layout, hr_* being the
+# full-sample estimates and lc_* / uc_* the 2.5th / 97.5th bootstrap percentiles,
+# plus the number of replicates that converged.
+#
+# A resample is never materialised: drawing n patients with replacement is the same
+# as giving each patient a frequency weight (the number of times it is drawn), so a
+# replicate is the full-sample fits with those weights. The design matrices and the
+# sort of ae_all's analysis times are therefore built once per worker, and each fit
+# starts from the full-sample coefficients, which it usually needs 2-3 Newton steps
+# to leave. (Breslow ties match fits on the duplicated rows exactly; Efron, which
+# splits tied events by row rather than by weight, differs slightly.)
+#
+# Replicates run in batches over a process pool (parallel_fits.single_threaded_pool)
+# reading the cohort from one shared-memory block. Each batch draws from its own
+# stream, spawned from --seed with np.random.SeedSequence, so results do not depend
+# on the number of workers or on which worker ran which batch.
+#
+# Usage: python analysis/propensity_bootstrap.py [--input output/data/main.dta]
+#          [--output output/tables/cox_model_propensity_bootstrap.dta]
+#          [--replicates 1000] [--seed 20230424] [--workers N] [--stabilised]
+
+import argparse
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import cox_engine
+import cox_model
+import parallel_fits
+import propensity_model
+
+## replicates per pool task
+BATCH = 20
+## percentiles of the replicate distribution reported as lc / uc
+PERCENTILES = (2.5, 97.5)
+
+
+def prepare(columns):
+  # everything a replicate reuses: the propensity design, treatment indicator, the
+  # risk sets of the outcome and the i.drug design
+  X, selections, rows = propensity_model.shared_design(columns)
+  kept, risk_sets = cox_model.outcome_risk_sets(columns, propensity_model.OUTCOME)
+  D, names, included = cox_model.design(columns, propensity_model.TREATMENT_TERMS, rows=kept)
+  drugs = [names.index(f"{code}.drug") for code in cox_model.DRUGS]
+  return {
+    "X": X, "selections": selections, "rows": rows, "y": propensity_model.no_drug(columns),
+    "risk_sets": risk_sets, "D": D, "included": included, "drugs": drugs,
+  }
+
+
+def estimate(state, frequency=None, starts=(None, None), stabilised=False, ties="breslow"):
+  # (log hazard ratios (models x drugs), logistic coefficients, Cox coefficients per
+  # model) with patients weighted by frequency (None: once each)
+  logistic_start, cox_starts = starts
+  X, rows, y = state["X"], state["rows"], state["y"]
+  B = propensity_model.fit_logistic(X, y, state["selections"], rows, frequency, logistic_start)
+  p = np.where(rows, np.exp(-np.logaddexp(0.0, -(X @ B))), np.nan)
+  log_hr, coefs = [], []
+  for k in range(len(state["selections"])):
+    weights = np.nan_to_num(propensity_model.iptw(p[:, k], 1 - y, stabilised, frequency))
+    if frequency is not None:
+      weights *= frequency
+    result = cox_engine.fit(
+      state["risk_sets"], state["D"], weights * state["included"], ties, robust=False,
+      start=None if cox_starts is None else cox_starts[k],
+    )
+    # a drug no patient drawn into the replicate received is omitted: missing
+    log_hr.append(np.where(result.omitted[state["drugs"]], np.nan, result.coef[state["drugs"]]))
+    coefs.append(result.coef)
+  return np.array(log_hr), B, coefs
+
+
+## per worker process: the attached cohort, prepare()'s state and the fit settings
+_worker = {}
+
+
+def _initialise(spec, starts, stabilised, ties):
+  _worker["memory"], columns = parallel_fits.attach(spec)
+  _worker["state"] = prepare(columns)
+  _worker["settings"] = starts, stabilised, ties
+
+
+def run_batch(state, seed, size, starts, stabilised, ties):
+  # (size, models, drugs) log hazard ratios, nan for replicates that fail to fit
+  rng = np.random.default_rng(seed)
+  n = len(state["y"])
+  replicates = np.full((size, len(state["selections"]), len(state["drugs"])), np.nan)
+  for r in range(size):
+    frequency = np.bincount(rng.integers(0, n, n), minlength=n).astype(float)
+    try:
+      replicates[r] = estimate(state, frequency, starts, stabilised, ties)[0]
+    except np.linalg.LinAlgError:
+      pass
+  return replicates
+
+
+def _batch(seed, size):
+  return run_batch(_worker["state"], seed, size, *_worker["settings"])
+
+
+def bootstrap(frame, replicates=1000, seed=20230424, workers=1, stabilised=False, ties="breslow"):
+  # (point log hazard ratios (models x drugs), replicate log hazard ratios
+  # (replicates x models x drugs))
+  state = prepare(frame)
+  point, B, coefs = estimate(state, stabilised=stabilised, ties=ties)
+  starts = (B, coefs)
+  sizes = [min(BATCH, replicates - start) for start in range(0, replicates, BATCH)]
+  seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+  if workers == 1:
+    batches = [run_batch(state, s, size, starts, stabilised, ties) for s, size in zip(seeds, sizes)]
+  else:
+    names = ["start_date", "drug", *cox_model.model_columns(propensity_model.PS_MODELS)]
+    names += [f"stop_{propensity_model.OUTCOME}", f"fail_{propensity_model.OUTCOME}"]
+    with parallel_fits.SharedColumns({name: frame[name] for name in names}) as shared:
+      with parallel_fits.single_threaded_pool(workers or None, _initialise, (shared.spec, starts, stabilised, ties)) as pool:
+        batches = list(pool.map(_batch, seeds, sizes))
+  return point, np.concatenate(batches)
+
+
+def summarise(point, replicates, models=propensity_model.PS_MODELS):
+  # DataFrame in cox_model_propensity.dta's layout with percentile intervals
+  with warnings.catch_warnings():
+    # a model with no failures has no estimate in any replicate: missing, quietly
+    warnings.simplefilter("ignore", RuntimeWarning)
+    lower, upper = np.exp(np.nanpercentile(replicates, PERCENTILES, axis=0))
+  converged = (~np.isnan(replicates).any(axis=2)).sum(axis=0)
+  rows = []
+  for k, model in enumerate(models):
+    row = {"model": model}
+    for j, suffix in enumerate(cox_model.DRUGS.values()):
+      row.update({f"hr_{suffix}": np.exp(point[k, j]), f"lc_{suffix}": lower[k, j], f"uc_{suffix}": upper[k, j]})
+    row["replicates"] = int(converged[k])
+    rows.append(row)
+  return pd.DataFrame(rows)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Bootstrap the 300_ps_model IPTW hazard ratios")
+  parser.add_argument("--input", default="output/data/main.dta")
+  parser.add_argument("--output", default="output/tables/cox_model_propensity_bootstrap.dta")
+  parser.add_argument("--replicates", type=int, default=1000)
+  parser.add_argument("--seed", type=int, default=20230424)
+  parser.add_argument("--workers", type=int, default=0, help="replicate in this many processes (0: one per CPU)")
+  parser.add_argument("--stabilised", action="store_true", help="stabilise the weights by the marginal group probabilities")
+  parser.add_argument("--ties", choices=cox_engine.TIES, default="breslow")
+  args = parser.parse_args(argv)
+
+  started = time.perf_counter()
+  columns = ["patient_id", "start_date", "drug", *cox_model.model_columns(propensity_model.PS_MODELS)]
+  columns += [f"stop_{propensity_model.OUTCOME}", f"fail_{propensity_model.OUTCOME}"]
+  frame = cox_model.load(args.input, columns)
+  point, replicates = bootstrap(frame, args.replicates, args.seed, args.workers, args.stabilised, args.ties)
+  summary = summarise(point, replicates)
+  cox_model.write_summary(summary, args.output)
+  print(f"Wrote {len(summary)} models ({args.replicates} replicates) to {args.output} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,180 @@
+
+# --- PROPENSITY SCORE COX MODELS (300_ps_model.do) ---
+# Python counterpart of the model loop in 300_ps_model.do: `logistic no_drug $model`
+# for the four adjustment sets, iptw_<model> = 1/p for the untreated and 1/(1-p) for
+# the treated, then `stcox i.drug [pw=iptw_<model>], vce(robust)` on ae_all, posting
+# the same rows to cox_model_propensity.dta:
+#
+#   model  hr_sot lc_sot uc_sot  hr_pax lc_pax uc_pax  hr_mol lc_mol uc_mol
+#
+# The four logistic models are fitted together. Every term any of them uses is
+# expanded once into one shared design matrix; each model is a subset of its columns
+# plus the rows where its own covariates are present. Each IRLS iteration takes the
+# linear predictors of all four models in one matrix product (X @ B, B holding each
+# model's coefficients with zeros outside its columns) and their scores in another
+# (X' R), leaving only a p x p solve per model. Weights are then formed for all
+# rows at once, and the weighted Cox fits share one sort of ae_all's analysis times.
+#
+# --stabilised multiplies each weight by the marginal probability of the group the
+# patient is in (Pr(no_drug) or 1 - Pr(no_drug)); the do-file's weights are not.
+# --workers fits the weighted Cox models through parallel_fits.py, with the weights
+# as shared columns.
+#
+# Usage: python analysis/propensity_model.py [--input output/data/main.dta]
+#          [--output output/tables/cox_model_propensity.dta] [--stabilised]
+#          [--ties breslow|efron] [--workers N]
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import cox_engine
+import cox_model
+
+## the do-file's globals, term for term
+PS_MODELS = {
+  "agesex": "age i.sex i.region_nhs",
+  "adj": f"age i.sex {cox_model.COMORBIDITIES}",
+  "fulladj1": f"age i.sex {cox_model.COMORBIDITIES} vaccination_status imd White",
+  "fulladj2": (
+    f"age i.sex {cox_model.COMORBIDITIES} vaccination_status imd White 1b.bmi_group diabetes"
+    " chronic_cardiac_disease chronic_respiratory_disease hypertension"
+  ),
+}
+OUTCOME = "ae_all"
+TREATMENT_TERMS = "i.drug"
+
+
+def no_drug(columns):
+  # 1 for the untreated (drug == 0), 0 for any treatment
+  return (np.asarray(columns["drug"], dtype=float) == 0).astype(float)
+
+
+def shared_design(columns, models=PS_MODELS):
+  # (X, selections, rows): X holds a constant and every term any model uses, each
+  # expanded once; selections[k] are model k's column indexes and rows[:, k] its
+  # complete cases. Columns that are constant, empty or collinear with earlier ones
+  # over a model's complete cases (e.g. a factor level with no complete case, or
+  # White when every complete case is White) are left out of it, as Stata omits them
+  terms = []
+  for model_terms in models.values():
+    terms += [term for term in model_terms.split() if term not in terms]
+  blocks, term_columns, present = [], {}, {}
+  width = 1
+  for term in terms:
+    X, _, present[term] = cox_model.design(columns, term)
+    blocks.append(X)
+    term_columns[term] = list(range(width, width + X.shape[1]))
+    width += X.shape[1]
+  n = len(present[terms[0]])
+  X = np.column_stack([np.ones(n), *blocks])
+  selections, rows = [], np.ones((n, len(models)), dtype=bool)
+  for k, model_terms in enumerate(models.values()):
+    selection = [0]
+    for term in model_terms.split():
+      rows[:, k] &= present[term]
+      selection += term_columns[term]
+    kept = cox_engine.independent(cox_engine.gram(X[:, selection], rows[:, k].astype(float)))
+    selections.append(np.array(selection)[kept])
+  return X, selections, rows
+
+
+def fit_logistic(X, y, selections, rows, weights=None, start=None, tol=1e-8, max_iter=50):
+  # coefficients (columns x models) of the logistic regressions of y on each
+  # selection of X over its rows, fitted together by IRLS (Newton-Raphson);
+  # weights: frequency weight per row, start: initial coefficients. Columns that
+  # are collinear on the rows with weight (e.g. a rare level no replicate drew) are
+  # omitted from that fit, with coefficient 0
+  B = np.zeros((X.shape[1], len(selections))) if start is None else np.array(start, dtype=float)
+  weights = rows.astype(float) if weights is None else rows * np.asarray(weights, dtype=float)[:, None]
+  selections = list(selections)
+  active = list(range(len(selections)))
+  for iteration in range(max_iter):
+    p = np.exp(-np.logaddexp(0.0, -(X @ B)))
+    scores = X.T @ (weights * (y[:, None] - p))
+    curvature = weights * p * (1 - p)
+    for k in list(active):
+      selection = selections[k]
+      information = cox_engine.gram(X[:, selection], curvature[:, k])
+      omitted = False
+      if iteration == 0:
+        kept = cox_engine.independent(information)
+        omitted = not kept.all()
+        if omitted:
+          B[selection[~kept], k] = 0.0
+          selection = selections[k] = selection[kept]
+          information = information[np.ix_(kept, kept)]
+      step = np.linalg.solve(information, scores[selection, k])
+      B[selection, k] += step
+      if np.max(np.abs(step)) < tol and not omitted:
+        active.remove(k)
+    if not active:
+      break
+  return B
+
+
+def iptw(p, treated, stabilised=False, frequency=None):
+  # inverse probability of treatment weights from p = Pr(no_drug); missing where p is.
+  # frequency weights, if any, enter the marginal probability of stabilised weights
+  untreated = treated == 0
+  weights = np.where(untreated, 1 / p, 1 / (1 - p))
+  if stabilised:
+    counted = ~np.isnan(p) * (1.0 if frequency is None else np.asarray(frequency, dtype=float))
+    marginal = counted @ untreated / counted.sum()
+    weights *= np.where(untreated, marginal, 1 - marginal)
+  return weights
+
+
+def propensity_weights(columns, models=PS_MODELS, stabilised=False):
+  # ({p_<model>: ...}, {iptw_<model>: ...}) for every row, missing where a model's
+  # covariates are
+  X, selections, rows = shared_design(columns, models)
+  y = no_drug(columns)
+  B = fit_logistic(X, y, selections, rows)
+  p = np.where(rows, np.exp(-np.logaddexp(0.0, -(X @ B))), np.nan)
+  scores, weights = {}, {}
+  for k, model in enumerate(models):
+    scores[f"p_{model}"] = p[:, k]
+    weights[f"iptw_{model}"] = iptw(p[:, k], 1 - y, stabilised)
+  return scores, weights
+
+
+def summarise(frame, weights, ties="breslow", workers=1):
+  # DataFrame in cox_model_propensity.dta's layout, one row per weight column
+  models = [name[len("iptw_"):] for name in weights]
+  if workers == 1:
+    kept, risk_sets = cox_model.outcome_risk_sets(frame, OUTCOME)
+    fits = [cox_model.fit_model(frame, kept, risk_sets, TREATMENT_TERMS, ties, w) for w in weights.values()]
+  else:
+    import parallel_fits
+    names = ["start_date", "drug", f"stop_{OUTCOME}", f"fail_{OUTCOME}"]
+    columns = {**{name: frame[name] for name in names}, **weights}
+    tasks = [parallel_fits.FitTask(OUTCOME, model, TREATMENT_TERMS, name) for model, name in zip(models, weights)]
+    with parallel_fits.SharedColumns(columns) as shared:
+      fits = parallel_fits.fit_all(shared, tasks, workers or None, ties)
+  return pd.DataFrame([{"model": model, **fit} for model, fit in zip(models, fits)])
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Fit the 300_ps_model propensity scores and IPTW Cox models")
+  parser.add_argument("--input", default="output/data/main.dta")
+  parser.add_argument("--output", default="output/tables/cox_model_propensity.dta")
+  parser.add_argument("--stabilised", action="store_true", help="stabilise the weights by the marginal group probabilities")
+  parser.add_argument("--ties", choices=cox_engine.TIES, default="breslow")
+  parser.add_argument("--workers", type=int, default=1, help="fit in this many processes (0: one per CPU)")
+  args = parser.parse_args(argv)
+
+  started = time.perf_counter()
+  columns = ["patient_id", "start_date", "drug", *cox_model.model_columns(PS_MODELS)]
+  columns += [f"stop_{OUTCOME}", f"fail_{OUTCOME}"]
+  frame = cox_model.load(args.input, columns)
+  _, weights = propensity_weights(frame, stabilised=args.stabilised)
+  summary = summarise(frame, weights, args.ties, args.workers)
+  cox_model.write_summary(summary, args.output)
+  print(f"Wrote {len(summary)} models to {args.output} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+  main()
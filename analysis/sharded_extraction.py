@@ -0,0 +1,147 @@
+
+# --- PATIENT-SHARDED PARALLEL EXTRACTION ---
+# Splits the patients of a local_backend database into --shards groups by a hash of
+# patient_id and extracts the whole study for each group in its own worker process,
+# with its own SQLite connection. Every variable depends only on the patient's own
+# records, so a shard's columns are exactly those rows of a full extraction.
+#
+# Each finished shard is written to <shard-dir>/shard_<i>_of_<n>_<source>.parquet
+# (renamed into place, so a file is always complete), where <source> is a digest of
+# the database file (path, size, modification time) and of the study definition,
+# codelists.py and the codelist CSVs. A failed shard is retried up to --retries
+# times; shards whose files already exist for the same source are skipped, so
+# rerunning the same command, or --only i, redoes just the shards that failed, and
+# shard files of any other source are deleted rather than merged. The shard files
+# are then concatenated and sorted by patient_id, giving the same rows in the same
+# order as an unsharded extraction.
+#
+# Usage: python analysis/sharded_extraction.py --db output/local.sqlite --shards 8
+#          [--workers 8] [--output output/local_input.csv] [--shard-dir output/shards]
+#          [--retries 1] [--only 3 5] [--force]
+
+import argparse
+import glob
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import local_backend
+import study_spec
+
+## Knuth's multiplicative hash, so consecutive patient_ids spread across shards
+HASH_MULTIPLIER = 2654435761
+
+
+def shard_of(patient_ids, shards):
+  return (np.asarray(patient_ids, dtype="uint64") * np.uint64(HASH_MULTIPLIER) % np.uint64(2 ** 32)) % np.uint64(shards)
+
+
+def source_digest(db):
+  # digest of what the shards are extracted from: the database file and the study
+  digest = hashlib.sha1()
+  stat = os.stat(db)
+  digest.update(f"{os.path.abspath(db)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+  for path in (study_spec.STUDY_DEFINITION_PY, study_spec.CODELISTS_PY):
+    with open(path, "rb") as f:
+      digest.update(f.read())
+  for spec in sorted(study_spec.load_codelists().values(), key=lambda spec: spec.name):
+    path = os.path.join(local_backend.REPO_DIR, spec.path) if spec.path else None
+    if path and os.path.exists(path):
+      stat = os.stat(path)
+      digest.update(f"{spec.path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+  return digest.hexdigest()[:16]
+
+
+def shard_path(shard_dir, shard, shards, source):
+  return os.path.join(shard_dir, f"shard_{shard}_of_{shards}_{source}.parquet")
+
+
+def extract_shard(db, shard, shards, shard_dir, source):
+  # extract one shard into its file; returns (shard, rows, seconds)
+  started = time.perf_counter()
+  conn = local_backend.connect(db)
+  ids = np.array([row[0] for row in conn.execute("SELECT patient_id FROM patient")], dtype="int64")
+  extraction = local_backend.Extraction(conn, patients=ids[shard_of(ids, shards) == shard])
+  table = local_backend.output_table(extraction.run(), extraction.variables, csv=False)
+  conn.close()
+  path = shard_path(shard_dir, shard, shards, source)
+  pq.write_table(table, path + ".partial")
+  os.replace(path + ".partial", path)
+  return shard, table.num_rows, time.perf_counter() - started
+
+
+def run_shards(db, shards, shard_dir, workers=None, retries=1, only=None, force=False, source=None):
+  # extract every missing or --only shard of the database's current source;
+  # returns the shards that still failed
+  os.makedirs(shard_dir, exist_ok=True)
+  source = source or source_digest(db)
+  current = {shard_path(shard_dir, shard, shards, source) for shard in range(shards)}
+  for path in glob.glob(os.path.join(shard_dir, "shard_*.parquet*")):
+    if path not in current:
+      # another database, study or shard count: never merged into this output
+      os.remove(path)
+  pending = [
+    shard for shard in range(shards)
+    if force or (only is not None and shard in only) or not os.path.exists(shard_path(shard_dir, shard, shards, source))
+  ]
+  for attempt in range(retries + 1):
+    if not pending:
+      break
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      futures = {pool.submit(extract_shard, db, shard, shards, shard_dir, source): shard for shard in pending}
+      for future in as_completed(futures):
+        shard = futures[future]
+        try:
+          _, rows, seconds = future.result()
+          print(f"  shard {shard}: {rows} rows in {seconds:.1f}s")
+        except Exception as error:
+          print(f"  shard {shard} failed (attempt {attempt + 1}): {error!r}")
+          failed.append(shard)
+    pending = sorted(failed)
+  return pending
+
+
+def merge(shard_dir, shards, output, source):
+  # concatenate the shard files of one source in patient_id order into output
+  tables = [pq.read_table(shard_path(shard_dir, shard, shards, source)) for shard in range(shards)]
+  table = pa.concat_tables(tables).sort_by("patient_id")
+  if not output.endswith(".parquet"):
+    # flags are 0/1 in CSV output
+    for i, field in enumerate(table.schema):
+      if pa.types.is_boolean(field.type):
+        table = table.set_column(i, field.name, table.column(i).cast(pa.int8()))
+  local_backend.write_table(table, output)
+  return table.num_rows
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Extract the study in patient shards across worker processes")
+  parser.add_argument("--db", default="output/local.sqlite")
+  parser.add_argument("--shards", type=int, default=os.cpu_count())
+  parser.add_argument("--workers", type=int, default=None)
+  parser.add_argument("--output", default="output/local_input.csv")
+  parser.add_argument("--shard-dir", default="output/shards")
+  parser.add_argument("--retries", type=int, default=1)
+  parser.add_argument("--only", type=int, nargs="+", default=None, help="re-extract these shards (and any missing)")
+  parser.add_argument("--force", action="store_true", help="re-extract shards that already have files")
+  args = parser.parse_args(argv)
+
+  started = time.perf_counter()
+  source = source_digest(args.db)
+  failed = run_shards(args.db, args.shards, args.shard_dir, args.workers, args.retries, args.only, args.force, source)
+  if failed:
+    raise SystemExit(f"Shards {failed} failed; rerun with --only {' '.join(map(str, failed))}")
+  if source_digest(args.db) != source:
+    raise SystemExit(f"{args.db} or the study changed during extraction; rerun to re-extract the shards")
+  rows = merge(args.shard_dir, args.shards, args.output, source)
+  print(f"Merged {args.shards} shards, {rows} rows, to {args.output} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,213 @@
+
+# --- SHARED SCANS FOR WINDOWED EVENT FLAGS ---
+# The comorbidity_* / drug_* helper families ask one question of an event table
+# per codelist, over a lookback ending at covid_test_positive_date:
+#
+#   comorbidity_snomed(x)      any event on or before covid_test_positive_date
+#   comorbidity_snomed_6m(x)   any event in [covid_test_positive_date - 6 months, ...]
+#   comorbidity_icd_12m(x)     any admission in [covid_test_positive_date - 12 months, ...]
+#
+# Each flag follows from the date of the last matching event on or before the anchor:
+# the window holds an event exactly when that date is inside it. plan() collects
+# every such binary_flag variable by source table, and evaluate() answers all of a
+# table's flags from a single pass over it: every event is tagged at once with the
+# codelists its code is in (codelist_membership), the last date per (codelist,
+# patient) is taken with one groupby, and every flag is a comparison against that
+# date. The roughly 60 comorbidity and drug columns cost one pass per source table
+# instead of one per variable, and the *_highcostdrugs flags come from a single pass
+# over the high-cost-drugs table. A with_high_cost_drugs flag without
+# drug_name_matches (any drug, as high_cost_drugs_3m/_6m ask) has no codelists and
+# holds for any row.
+# combine() then evaluates maximum_of / minimum_of columns over that matrix, e.g.
+# imid_drug_HCD as one row-wise OR.
+#
+# local_backend.Extraction evaluates these flags through plan(), evaluate() and
+# combine(), so they are shared by full, incremental and sharded local extractions
+# (--no-scans turns it off). cohortextractor still issues one query per variable.
+#
+# Usage: python analysis/shared_scans.py   (prints the plan)
+
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import codelist_membership
+import study_spec
+
+## methods whose binary_flag can be answered from the last matching date
+SCANNED = {
+  "with_these_clinical_events", "with_these_medications", "admitted_to_hospital",
+  "with_high_cost_drugs",
+}
+CODELIST_ARGUMENTS = (
+  "codelist", "with_these_diagnoses", "with_these_procedures", "drug_name_matches",
+)
+## the only other arguments a scanned variable may have
+WINDOW_ARGUMENTS = {
+  "returning", "between", "on_or_before", "on_or_after", "return_expectations",
+  "find_first_match_in_period", "find_last_match_in_period", "date_format",
+}
+OFFSET = re.compile(r"^\s*([A-Za-z_]\w*)\s*(?:-\s*(\d+)\s*(day|month|year)s?)?\s*$")
+
+## offset is None (no lower bound) or (number, "day" | "month" | "year")
+Flag = namedtuple("Flag", "name codelists offset")
+## source is (method, codelist argument), e.g. ("admitted_to_hospital", "with_these_diagnoses")
+Scan = namedtuple("Scan", "source anchor flags")
+
+
+## Planning
+
+def _window(kwargs):
+  # (anchor, offset) for [anchor - offset, anchor] or on_or_before anchor, else None
+  if kwargs.get("on_or_after"):
+    return None
+  if kwargs.get("between"):
+    between = kwargs["between"]
+    if kwargs.get("on_or_before") or len(between) != 2:
+      return None
+    lower, upper = (OFFSET.match(str(bound)) for bound in between)
+    if not (lower and upper and lower.group(2)) or upper.group(2):
+      return None
+    if lower.group(1) != upper.group(1):
+      return None
+    return upper.group(1), (int(lower.group(2)), lower.group(3))
+  match = OFFSET.match(str(kwargs.get("on_or_before") or ""))
+  if match and not match.group(2):
+    return match.group(1), None
+  return None
+
+
+def scannable(variable, outputs):
+  # Flag for a variable evaluate() can answer, else None
+  if variable.hidden or variable.method not in SCANNED or variable.returning != "binary_flag":
+    return None
+  arguments = [key for key in CODELIST_ARGUMENTS if key in variable.kwargs]
+  if not arguments and variable.method == "with_high_cost_drugs":
+    arguments = [None]
+  if len(arguments) != 1 or set(variable.kwargs) - WINDOW_ARGUMENTS - set(arguments):
+    return None
+  window = _window(variable.kwargs)
+  if window is None or window[0] not in outputs:
+    return None
+  return (variable.method, arguments[0]), window[0], Flag(
+    variable.name, tuple(variable.codelists), window[1]
+  )
+
+
+def plan(variables=None):
+  # [Scan], one per (source table, anchor), flags in StudyDefinition order
+  variables = variables or study_spec.load_study()
+  outputs = {column for variable in variables.values() for column in variable.outputs}
+  scans = {}
+  for variable in variables.values():
+    found = scannable(variable, outputs)
+    if found is not None:
+      source, anchor, flag = found
+      scans.setdefault((source, anchor), Scan(source, anchor, [])).flags.append(flag)
+  return list(scans.values())
+
+
+## Evaluation
+
+def _offset(offset):
+  number, unit = offset
+  if unit == "day":
+    return pd.Timedelta(days=number)
+  if unit == "month":
+    return pd.DateOffset(months=number)
+  return pd.DateOffset(years=number)
+
+
+def scan_codelists(scan, codelists):
+  # {flag codelists: union of their codes, None for any code} for one scan's flags
+  return {
+    flag.codelists: set().union(*(codelists[name] for name in flag.codelists)) if flag.codelists else None
+    for flag in scan.flags
+  }
+
+
+def membership(wanted):
+  # CodelistMembership of the keys of a scan_codelists() that have codes, else None
+  coded = {key: codes for key, codes in wanted.items() if codes is not None}
+  return codelist_membership.CodelistMembership(coded) if coded else None
+
+
+def last_event_dates(events, codelists, anchors, compiled=None):
+  # DataFrame (patient x codelist key) of the last event date on or before the
+  # anchor, from one pass over `events` (patient_id, code, date). `codelists` maps
+  # keys to codes (None: any code), `anchors` is a datetime Series indexed by
+  # patient_id and `compiled` is membership(codelists) if already built
+  keys = list(codelists)
+  coded = [key for key in keys if codelists[key] is not None]
+  rows, positions = np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64")
+  if coded:
+    compiled = compiled or membership(codelists)
+    rows, positions = compiled.pairs(compiled.tag(events["code"].values))
+    positions = np.array([keys.index(key) for key in coded], dtype="int64")[positions]
+  for position, key in enumerate(keys):
+    if codelists[key] is None:
+      rows = np.concatenate([rows, np.arange(len(events))])
+      positions = np.concatenate([positions, np.full(len(events), position)])
+  matched = pd.DataFrame({
+    "patient_id": events["patient_id"].values[rows],
+    "codelist": positions,
+    "date": events["date"].values[rows],
+  })
+  anchor = matched["patient_id"].map(anchors)
+  matched = matched[(matched["date"] <= anchor).values]
+  last = matched.groupby(["patient_id", "codelist"])["date"].max().unstack()
+  last.columns = [keys[position] for position in last.columns]
+  return last.reindex(index=anchors.index, columns=keys)
+
+
+def evaluate(scans, tables, codelists, anchors, compiled=None):
+  # DataFrame of bool flags indexed like `anchors`:
+  #   tables     {source: DataFrame(patient_id, code, date)} for each scan source
+  #   codelists  {codelists.py name: codes}
+  #   anchors    DataFrame of anchor date columns indexed by patient_id
+  #   compiled   {source: membership(scan_codelists())} built by the caller, if any
+  compiled = compiled or {}
+  flags = {}
+  for scan in scans:
+    anchor = pd.to_datetime(anchors[scan.anchor])
+    wanted = scan_codelists(scan, codelists)
+    last = last_event_dates(tables[scan.source], wanted, anchor, compiled.get(scan.source))
+    for flag in scan.flags:
+      dates = last.iloc[:, list(wanted).index(flag.codelists)]
+      found = dates.notna()
+      if flag.offset is not None:
+        found &= dates >= anchor - _offset(flag.offset)
+      flags[flag.name] = found.values
+  return pd.DataFrame(flags, index=anchors.index)
+
+
+def combine(flags, variables=None):
+  # Add every maximum_of / minimum_of column whose inputs are all in `flags`
+  # (e.g. imid_drug_HCD over the *_highcostdrugs matrix), in StudyDefinition order
+  variables = variables or study_spec.load_study()
+  for variable in variables.values():
+    if variable.method not in ("maximum_of", "minimum_of"):
+      continue
+    inputs = variable.kwargs.get("column_names", [])
+    if inputs and all(name in flags for name in inputs):
+      # missing values are skipped, as cohortextractor does
+      matrix = flags[inputs]
+      flags[variable.name] = matrix.max(axis=1) if variable.method == "maximum_of" else matrix.min(axis=1)
+  return flags
+
+
+def main():
+  scans = plan()
+  print(f"{sum(len(scan.flags) for scan in scans)} flags from {len(scans)} table scans")
+  for scan in scans:
+    method, argument = scan.source
+    print(f"\n{method}({argument or 'any row'}), anchored on {scan.anchor}:")
+    for flag in scan.flags:
+      window = "all" if flag.offset is None else f"{flag.offset[0]} {flag.offset[1]}s"
+      print(f"  {flag.name}: {'+'.join(flag.codelists) or 'any'} ({window})")
+
+
+if __name__ == "__main__":
+  main()
@@ -2,6 +2,10 @@ from cohortextractor import StudyDefinition, patients, codelist_from_csv, codeli
 import datetime
 from codelists import *
 
+## Set PRUNE_FOR (param or environment) to extract only the columns those actions need
+from study_dependencies import pruned_study_definition
+StudyDefinition = pruned_study_definition(StudyDefinition)
+
 ## Define study time variables
 from datetime import timedelta, date, datetime 
 campaign_start = "2021-12-16"
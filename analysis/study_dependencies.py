@@ -0,0 +1,290 @@
+
+# --- STUDY VARIABLE DEPENDENCIES AND PRUNED EXTRACTION ---
+# Builds the dependency DAG of the StudyDefinition (via study_spec, offline) and
+# cross-references it with the variables the Stata actions in project.yaml use:
+#
+#   a variable depends on every other variable it names in a string argument
+#   ("covid_test_positive_date - 6 months", maximum_of("downs_syndrome_snomed", ...),
+#   satisfying/categorised_as expressions), with <name>_date and <name>_date_measured
+#   resolving to <name>; nested helper columns are dependencies of their parent
+#
+# An action needs the columns used by its own .do file and by the .do files of the
+# actions it (transitively) depends on. Column use follows Stata's rules: names are
+# lower-cased and cut to 32 characters, and a token may be a unique abbreviation or a
+# varlist wildcard (ae_spc*). Comments are ignored. Matching is deliberately generous,
+# so a pruned extraction can keep a column it did not need but never drops one it does.
+# Columns only read by log output (tab, count, codebook, ...) are still kept, since
+# the .do file would stop on a missing variable, but are listed separately.
+#
+# Pruned extraction: set the cohortextractor param or environment variable
+# PRUNE_FOR to a comma-separated list of action names (or "all" for every Stata
+# action) and study_definition.py keeps only those actions' columns, their
+# dependencies and population.
+#
+# Usage: python analysis/study_dependencies.py [--action NAME ...] [--dot FILE]
+
+import argparse
+import fnmatch
+import os
+import re
+
+import study_spec
+
+PROJECT_YAML = os.path.join(os.path.dirname(study_spec.ANALYSIS_DIR), "project.yaml")
+
+## kwargs that never name another variable
+NOT_REFERENCES = {"returning", "return_expectations", "with_these_therapeutics"}
+ALIAS_SUFFIXES = ("_date_measured", "_date")
+ALWAYS_KEPT = {"population"}
+
+STATA_TOKEN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\*?")
+STATA_CONTINUATION = re.compile(r"///[^\n]*\n")
+STATA_COMMENTS = re.compile(r"/\*.*?\*/|//[^\n]*|^\s*\*[^\n]*", re.S | re.M)
+## macro references (`var', $projectdir) and string literals are not variable names
+STATA_NON_NAMES = re.compile(r"`[^'\n]*'|\$\{?\w+\}?|\"[^\"\n]*\"")
+## ... nor the macro a loop or local/global defines
+STATA_MACRO_NAMES = re.compile(r"\b(foreach|forvalues|forval|local|global|tempvar|tempname)\s+\w+")
+STATA_PREFIX = re.compile(r"^\s*(?:(?:by|bysort|bys)\b[^:]*:|quietly\b|qui\b|capture\b|cap\b|noisily\b|noi\b)\s*")
+## commands that only write to the log
+DIAGNOSTIC_COMMANDS = {
+  "tab", "tabulate", "tab1", "tab2", "table", "tabstat", "count", "codebook",
+  "sum", "su", "summarize", "describe", "desc", "list", "li", "inspect",
+  "misstable", "di", "display",
+}
+
+
+## Dependency DAG
+
+def _resolve(name, variables):
+  if name in variables:
+    return name
+  for suffix in ALIAS_SUFFIXES:
+    if name.endswith(suffix) and name[:-len(suffix)] in variables:
+      return name[:-len(suffix)]
+  return None
+
+
+def dependencies(variables=None):
+  # {variable: set of variables it reads}
+  variables = variables or study_spec.load_study()
+  graph = {name: set() for name in variables}
+  for name, variable in variables.items():
+    for key, value in variable.kwargs.items():
+      if key in NOT_REFERENCES:
+        continue
+      for token in study_spec.identifiers(value):
+        target = _resolve(token, variables)
+        if target is not None and target != name:
+          graph[name].add(target)
+    if variable.parent is not None:
+      graph[variable.parent].add(name)
+  return graph
+
+
+def closure(names, graph):
+  # names plus everything they transitively depend on
+  needed, stack = set(), list(names)
+  while stack:
+    name = stack.pop()
+    if name not in needed:
+      needed.add(name)
+      stack.extend(graph.get(name, ()))
+  return needed
+
+
+def topological_order(graph):
+  # dependencies before dependants; raises on a cycle
+  order, state = [], {}
+
+  def visit(name, path):
+    if state.get(name) == "done":
+      return
+    if state.get(name) == "visiting":
+      raise ValueError("Dependency cycle: " + " -> ".join(path + [name]))
+    state[name] = "visiting"
+    for dependency in sorted(graph[name]):
+      visit(dependency, path + [name])
+    state[name] = "done"
+    order.append(name)
+
+  for name in graph:
+    visit(name, [])
+  return order
+
+
+## Stata usage
+
+def stata_tokens(path):
+  # (tokens of every statement, tokens of statements that are not diagnostics)
+  with open(path, errors="replace") as f:
+    source = STATA_COMMENTS.sub(" ", STATA_CONTINUATION.sub(" ", f.read()))
+  source = STATA_MACRO_NAMES.sub(r"\1", STATA_NON_NAMES.sub(" ", source))
+  every, effective = set(), set()
+  for statement in source.splitlines():
+    tokens = {token.lower() for token in STATA_TOKEN.findall(statement)}
+    every.update(tokens)
+    command = STATA_PREFIX.sub("", statement).split(maxsplit=1)
+    while command and STATA_PREFIX.match(" ".join(command)):
+      command = STATA_PREFIX.sub("", " ".join(command)).split(maxsplit=1)
+    if command and command[0].lower().rstrip(",") not in DIAGNOSTIC_COMMANDS:
+      effective.update(tokens)
+  return every, effective
+
+
+def used_columns(tokens, columns):
+  # output columns (original names) a set of .do tokens refers to
+  stata_names = {}
+  for column in columns:
+    stata_names.setdefault(column.lower()[:32], column)
+  used = set()
+  for token in tokens:
+    if token.endswith("*"):
+      used.update(
+        column for stata_name, column in stata_names.items()
+        if fnmatch.fnmatchcase(stata_name, token)
+      )
+    elif token in stata_names:
+      used.add(stata_names[token])
+    else:
+      matches = [column for stata_name, column in stata_names.items() if stata_name.startswith(token)]
+      if len(matches) == 1:
+        used.add(matches[0])
+  return used
+
+
+def project_actions(path=PROJECT_YAML):
+  # {action: (script or None, [needs])}, read line by line to avoid a yaml dependency
+  actions, current, in_actions = {}, None, False
+  with open(path) as f:
+    for line in f:
+      if not line.strip() or line.lstrip().startswith("#"):
+        continue
+      indent = len(line) - len(line.lstrip())
+      text = line.strip()
+      if indent == 0:
+        in_actions = text == "actions:"
+      elif in_actions and indent == 2 and text.endswith(":"):
+        current = text[:-1]
+        actions[current] = (None, [])
+      elif in_actions and current and text.startswith("run:"):
+        scripts = [part for part in text.split() if part.endswith((".do", ".py"))]
+        actions[current] = (scripts[0] if scripts else None, actions[current][1])
+      elif in_actions and current and text.startswith("needs:"):
+        needs = [n.strip() for n in text[len("needs:"):].strip(" []").split(",") if n.strip()]
+        actions[current] = (actions[current][0], needs)
+  return actions
+
+
+def action_columns(variables=None, path=PROJECT_YAML, diagnostics=True):
+  # {Stata action: set of output columns it or its upstream Stata actions use};
+  # diagnostics=False ignores columns only read by tab/count/codebook etc
+  variables = variables or study_spec.load_study()
+  columns = [column for variable in variables.values() for column in variable.outputs]
+  actions = project_actions(path)
+  root = os.path.dirname(path)
+  direct = {}
+  for action, (script, _) in actions.items():
+    if script and script.endswith(".do") and os.path.exists(os.path.join(root, script)):
+      every, effective = stata_tokens(os.path.join(root, script))
+      direct[action] = used_columns(every if diagnostics else effective, columns)
+
+  def upstream(action, seen):
+    for need in actions.get(action, (None, []))[1]:
+      if need not in seen:
+        seen.add(need)
+        upstream(need, seen)
+    return seen
+
+  return {
+    action: set().union(*(direct.get(a, set()) for a in upstream(action, {action})))
+    for action in direct
+  }
+
+
+def needed_variables(actions, variables=None, path=PROJECT_YAML, diagnostics=True):
+  # StudyDefinition variables to extract so that `actions` get every column they use
+  variables = variables or study_spec.load_study()
+  by_action = action_columns(variables, path, diagnostics)
+  if "all" in actions:
+    actions = list(by_action)
+  unknown = [action for action in actions if action not in by_action]
+  if unknown:
+    raise ValueError(f"Not Stata actions in project.yaml: {', '.join(unknown)}")
+  roots = set(ALWAYS_KEPT)
+  for action in actions:
+    roots.update(_resolve(column, variables) for column in by_action[action])
+  return closure(roots & set(variables), dependencies(variables))
+
+
+## Pruned extraction
+
+def _prune_for():
+  try:
+    from cohortextractor import params
+  except ImportError:
+    params = {}
+  value = params.get("prune_for") or os.environ.get("PRUNE_FOR", "")
+  return [action.strip() for action in value.split(",") if action.strip()]
+
+
+def pruned_study_definition(study_definition):
+  # Wraps StudyDefinition so that, when PRUNE_FOR is set, variables no requested
+  # action needs are left out; without it the study definition is unchanged
+  actions = _prune_for()
+  if not actions:
+    return study_definition
+
+  def build(**kwargs):
+    needed = needed_variables(actions)
+    return study_definition(**{
+      key: value for key, value in kwargs.items()
+      if key in needed or not isinstance(value, tuple)
+    })
+
+  return build
+
+
+## Report
+
+def _dot(graph, unused, path):
+  with open(path, "w") as f:
+    f.write("digraph study {\n  rankdir=LR;\n")
+    for name in graph:
+      style = ' [style=dashed, color=grey]' if name in unused else ""
+      f.write(f'  "{name}"{style};\n')
+    for name, targets in graph.items():
+      for target in sorted(targets):
+        f.write(f'  "{target}" -> "{name}";\n')
+    f.write("}\n")
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="StudyDefinition dependency DAG and unused variables")
+  parser.add_argument("--action", action="append", default=[], help="list the variables these actions need")
+  parser.add_argument("--dot", help="write the DAG as a graphviz file")
+  args = parser.parse_args(argv)
+
+  variables = study_spec.load_study()
+  graph = dependencies(variables)
+  topological_order(graph)
+  actions = args.action or ["all"]
+  needed = needed_variables(actions, variables)
+  unused = [name for name in variables if name not in needed]
+  # kept only because a tab/count/codebook line reads them (or something they feed)
+  diagnostic = needed - needed_variables(actions, variables, diagnostics=False)
+
+  print(f"{len(variables)} variables, {sum(map(len, graph.values()))} dependencies")
+  print(f"{len(needed)} needed by {', '.join(actions)}; {len(unused)} can be pruned:")
+  for name in unused:
+    print(f"  {name}")
+  print(f"{len(diagnostic)} more are only read by diagnostic output (tab, count, codebook, ...):")
+  for name in variables:
+    if name in diagnostic:
+      print(f"  {name}")
+  if args.dot:
+    _dot(graph, set(unused), args.dot)
+  return 0
+
+
+if __name__ == "__main__":
+  main()
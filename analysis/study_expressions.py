@@ -0,0 +1,217 @@
+
+# --- VECTORISED STUDY EXPRESSIONS ---
+# Evaluates, over whole columns at once, the two small languages study_definition.py
+# uses to refer to other variables:
+#
+#   satisfying / categorised_as expressions
+#     "age >= 18 AND NOT has_died", "eth='1' OR (NOT eth AND ethnicity_sus='1')"
+#     A bare variable is true when it is set (non-zero, non-empty, non-missing);
+#     comparisons with a missing value are false, as in cohortextractor.
+#
+#   date expressions
+#     "covid_test_positive_date + 5 days", "index_date - 1 day", "today", "2021-12-16"
+#
+# Columns are numpy arrays (dates as datetime64[D] with NaT, labels as object arrays
+# with None), looked up by name in a dict.
+
+import datetime
+import re
+
+import numpy as np
+import pandas as pd
+
+TOKEN = re.compile(r"\s*(?:(\d+(?:\.\d+)?)|'([^']*)'|\"([^\"]*)\"|([A-Za-z_]\w*)|(>=|<=|!=|=|<|>|[()*/+-]))")
+COMPARISONS = {
+  "=": np.equal, "!=": np.not_equal, "<": np.less, "<=": np.less_equal,
+  ">": np.greater, ">=": np.greater_equal,
+}
+DATE = re.compile(
+  r"^\s*([A-Za-z_]\w*|\d{4}-\d{2}-\d{2})\s*(?:([+-])\s*(\d+)\s*(day|month|year)s?)?\s*$"
+)
+
+
+def truthy(values):
+  values = np.asarray(values)
+  if values.dtype == bool:
+    return values
+  if values.dtype.kind == "M":
+    return ~np.isnat(values)
+  if values.dtype.kind in "iuf":
+    return np.nan_to_num(values.astype(float)) != 0
+  present = pd.notna(values)
+  present[present] = values[present] != ""
+  return present
+
+
+def _tokens(expression):
+  tokens, position = [], 0
+  expression = expression.strip()
+  while position < len(expression):
+    match = TOKEN.match(expression, position)
+    if not match or match.end() == position:
+      raise ValueError(f"Cannot parse {expression!r} at {expression[position:]!r}")
+    number, single, double, name, operator = match.groups()
+    if number is not None:
+      tokens.append(("value", float(number)))
+    elif single is not None or double is not None:
+      tokens.append(("value", single if single is not None else double))
+    elif name is not None and name.upper() in ("AND", "OR", "NOT"):
+      tokens.append((name.upper(), None))
+    elif name is not None:
+      tokens.append(("name", name))
+    else:
+      tokens.append((operator, None))
+    position = match.end()
+  return tokens
+
+
+class _Parser:
+  # recursive descent: or > and > not > comparison > sum > product > atom
+
+  def __init__(self, tokens, columns, n):
+    self.tokens, self.columns, self.n, self.i = tokens, columns, n, 0
+
+  def peek(self):
+    return self.tokens[self.i][0] if self.i < len(self.tokens) else None
+
+  def take(self):
+    self.i += 1
+    return self.tokens[self.i - 1]
+
+  def boolean(self):
+    result = self.conjunction()
+    while self.peek() == "OR":
+      self.take()
+      result = result | self.conjunction()
+    return result
+
+  def conjunction(self):
+    result = self.negation()
+    while self.peek() == "AND":
+      self.take()
+      result = result & self.negation()
+    return result
+
+  def negation(self):
+    if self.peek() == "NOT":
+      self.take()
+      return ~self.negation()
+    return self.comparison()
+
+  def comparison(self):
+    left = self.sum()
+    if self.peek() in COMPARISONS:
+      operator = self.take()[0]
+      right = self.sum()
+      return _compare(operator, left, right, self.n)
+    return truthy(left) if np.ndim(left) else np.full(self.n, bool(left))
+
+  def sum(self):
+    result = self.product()
+    while self.peek() in ("+", "-"):
+      operator = self.take()[0]
+      other = self.product()
+      result = _numeric(result) + _numeric(other) if operator == "+" else _numeric(result) - _numeric(other)
+    return result
+
+  def product(self):
+    result = self.atom()
+    while self.peek() in ("*", "/"):
+      operator = self.take()[0]
+      other = self.atom()
+      result = _numeric(result) * _numeric(other) if operator == "*" else _numeric(result) / _numeric(other)
+    return result
+
+  def atom(self):
+    kind, value = self.take()
+    if kind == "(":
+      result = self.boolean()
+      if self.take()[0] != ")":
+        raise ValueError("Unbalanced parentheses")
+      return result
+    if kind == "value":
+      return value
+    if kind == "name":
+      if value not in self.columns:
+        raise KeyError(f"Expression refers to unknown column {value!r}")
+      return self.columns[value]
+    raise ValueError(f"Unexpected {kind!r}")
+
+
+def _numeric(value):
+  if isinstance(value, str):
+    return float(value)
+  value = np.asarray(value)
+  if value.dtype == object:
+    return pd.to_numeric(pd.Series(value), errors="coerce").to_numpy(float)
+  return value.astype(float) if value.dtype == bool else value
+
+
+def _compare(operator, left, right, n):
+  if isinstance(right, str) or isinstance(left, str):
+    # label comparison: missing labels compare unequal to everything
+    left = np.asarray(left, dtype=object) if np.ndim(left) else left
+    right = np.asarray(right, dtype=object) if np.ndim(right) else right
+    result = COMPARISONS[operator](left, right)
+    return np.broadcast_to(np.asarray(result, dtype=bool), (n,)).copy()
+  left, right = _numeric(left), _numeric(right)
+  with np.errstate(invalid="ignore"):
+    result = COMPARISONS[operator](left, right)
+  return np.broadcast_to(np.asarray(result, dtype=bool), (n,)).copy()
+
+
+def evaluate(expression, columns, n):
+  # bool array of length n
+  parser = _Parser(_tokens(expression), columns, n)
+  result = parser.boolean()
+  if parser.i != len(parser.tokens):
+    raise ValueError(f"Unexpected trailing tokens in {expression!r}")
+  return np.broadcast_to(result, (n,)).copy()
+
+
+def categorise(definitions, columns, n):
+  # object array of category labels: the first matching definition, else DEFAULT
+  default = next((label for label, expression in definitions.items() if expression == "DEFAULT"), None)
+  result = np.full(n, default, dtype=object)
+  unassigned = np.ones(n, dtype=bool)
+  for label, expression in definitions.items():
+    if expression == "DEFAULT":
+      continue
+    matched = evaluate(expression, columns, n) & unassigned
+    result[matched] = label
+    unassigned &= ~matched
+  return result
+
+
+def date_expression(expression, columns, options, n):
+  # datetime64[D] array of length n for a date expression
+  match = DATE.match(str(expression))
+  if not match:
+    raise ValueError(f"Cannot evaluate date expression {expression!r}")
+  name, sign, number, unit = match.groups()
+  if name in columns:
+    values = np.asarray(columns[name]).astype("datetime64[D]")
+  elif name == "today":
+    values = np.full(n, np.datetime64(datetime.date.today().isoformat(), "D"))
+  elif name in options:
+    values = date_expression(options[name], columns, options, n)
+  else:
+    values = np.full(n, np.datetime64(name, "D"))
+  if number:
+    number = int(number) * (1 if sign == "+" else -1)
+    if unit == "day":
+      values = values + np.timedelta64(number, "D")
+    else:
+      values = add_months(values, number * (12 if unit == "year" else 1))
+  return values
+
+
+def add_months(values, months):
+  # calendar month arithmetic on datetime64[D], clipping to the end of shorter months
+  start = values.astype("datetime64[M]")
+  day = (values - start.astype("datetime64[D]")).astype("int64")
+  shifted = start + np.timedelta64(months, "M")
+  length = ((shifted + np.timedelta64(1, "M")).astype("datetime64[D]") - shifted.astype("datetime64[D]")).astype("int64")
+  result = shifted.astype("datetime64[D]") + np.minimum(day, length - 1).astype("timedelta64[D]")
+  result[np.isnat(values)] = np.datetime64("NaT")
+  return result
@@ -0,0 +1,70 @@
+
+# --- OUTPUT SCHEMA FOR output/input.csv ---
+# Derives a type for every column cohortextractor writes, from the returning= and
+# return_expectations of each variable in study_definition.py (via study_spec):
+#
+#   date      dates (YYYY-MM-DD), including include_date_of_match columns
+#   bool      binary flags and satisfying(...)
+#   int       ages, counts
+#   float     numeric values, BMI
+#   category  categorised_as(...) and every returning= that yields a label; the
+#             expected labels are taken from return_expectations category ratios
+#
+# maximum_of / minimum_of take the type of the columns they combine.
+
+from collections import namedtuple
+
+import study_spec
+
+Column = namedtuple("Column", "name type categories")
+
+DATE_RETURNING = {
+  "date", "date_admitted", "date_discharged", "date_of_death",
+}
+INT_RETURNING = {"int", "number_of_matches_in_period", "number_of_episodes"}
+FLOAT_RETURNING = {"float", "numeric_value"}
+BOOL_RETURNING = {"binary_flag"}
+
+
+def _categories(variable):
+  ratios = variable.expectations.get("category", {}).get("ratios", {})
+  if variable.method == "categorised_as":
+    ratios = ratios or variable.kwargs.get("category_definitions", {})
+  return tuple(str(key) for key in ratios if key not in (None, ""))
+
+
+def _type(variable, variables, seen=()):
+  returning = variable.returning
+  if returning is None:
+    # maximum_of / minimum_of: whatever the combined columns are
+    types = {
+      _type(variables[name], variables, seen + (variable.name,))
+      for name in variable.kwargs.get("column_names", [])
+      if name in variables and name not in seen
+    }
+    return types.pop() if len(types) == 1 else "float"
+  if returning in DATE_RETURNING:
+    return "date"
+  if returning in BOOL_RETURNING:
+    return "bool"
+  if returning in INT_RETURNING:
+    return "int"
+  if returning in FLOAT_RETURNING:
+    return "float"
+  return "category"
+
+
+def load_schema(variables=None):
+  # [Column] in output order, starting with patient_id
+  variables = variables or study_spec.load_study()
+  columns = [Column("patient_id", "int", ())]
+  for variable in variables.values():
+    if variable.hidden:
+      continue
+    kind = _type(variable, variables)
+    columns.append(Column(
+      variable.name, kind, _categories(variable) if kind == "category" else ()
+    ))
+    for extra in variable.outputs[1:]:
+      columns.append(Column(extra, "date", ()))
+  return columns
@@ -0,0 +1,277 @@
+
+# --- STATIC STUDY SPECIFICATION ---
+# Reads analysis/codelists.py and analysis/study_definition.py with the ast module,
+# without importing cohortextractor or touching any CSV, and returns:
+#
+#   load_codelists()  {codelists.py name: CodelistSpec}
+#   load_study()      {column name: Variable}, in StudyDefinition order
+#
+# Helper factories defined in study_definition.py (comorbidity_snomed(...) etc.) are
+# expanded, combine_codelists(...) becomes a CodelistRef naming every codelist it
+# merges, and variables nested inside categorised_as / satisfying are returned as
+# hidden columns. Tools that must run offline (codelist verification, dependency
+# analysis, schema and dummy-data generation) are built on this.
+
+import ast
+import os
+import re
+from collections import namedtuple
+
+ANALYSIS_DIR = os.path.dirname(os.path.abspath(__file__))
+CODELISTS_PY = os.path.join(ANALYSIS_DIR, "codelists.py")
+STUDY_DEFINITION_PY = os.path.join(ANALYSIS_DIR, "study_definition.py")
+
+## path is relative to the repo root, as written in codelists.py; None for inline codes
+CodelistSpec = namedtuple(
+  "CodelistSpec", "name path system column category_column sources codes"
+)
+## names of the codelists.py variables a codelist argument is built from
+CodelistRef = namedtuple("CodelistRef", "names")
+## an expression the static reader cannot evaluate (e.g. date.today())
+Unknown = namedtuple("Unknown", "source")
+
+
+class Variable(namedtuple("Variable", "name method kwargs hidden parent")):
+
+  @property
+  def returning(self):
+    # None for maximum_of / minimum_of, which return whatever their inputs do
+    if self.method in IMPLIED_RETURNING:
+      return IMPLIED_RETURNING[self.method]
+    return self.kwargs.get("returning", "binary_flag")
+
+  @property
+  def expectations(self):
+    return self.kwargs.get("return_expectations") or {}
+
+  @property
+  def codelists(self):
+    # codelists.py names referenced by this variable's own arguments
+    return sorted({
+      name for value in _walk(self.kwargs) if isinstance(value, CodelistRef)
+      for name in value.names
+    })
+
+  @property
+  def outputs(self):
+    # every output column this variable produces, including implicit date columns
+    if self.hidden:
+      return []
+    columns = [self.name]
+    if self.kwargs.get("include_date_of_match"):
+      columns.append(f"{self.name}_date")
+    if self.kwargs.get("include_measurement_date"):
+      columns.append(f"{self.name}_date_measured")
+    return columns
+
+
+## Return type of methods that take no returning= argument
+IMPLIED_RETURNING = {
+  "satisfying": "binary_flag",
+  "categorised_as": "category",
+  "age_as_of": "int",
+  "sex": "category",
+  "most_recent_bmi": "float",
+  "comparator_from": "category",
+  "date_deregistered_from_all_supported_practices": "date",
+  "maximum_of": None,
+  "minimum_of": None,
+}
+
+## Name given to leading positional arguments of each patients.* method, as in
+## cohortextractor's signatures: with_covid_therapeutics() takes with_these_statuses
+## first, so covid_therapeutics("Sotrovimab") filters on the status, as production does
+POSITIONAL = {
+  "with_these_clinical_events": ["codelist"],
+  "with_these_medications": ["codelist"],
+  "with_these_codes_on_death_certificate": ["codelist"],
+  "with_covid_therapeutics": ["with_these_statuses"],
+  "age_as_of": ["reference_date"],
+  "address_as_of": ["date"],
+  "registered_practice_as_of": ["date"],
+  "comparator_from": ["source"],
+  "satisfying": ["expression"],
+  "categorised_as": ["category_definitions"],
+}
+VARIADIC = {"maximum_of", "minimum_of"}
+
+
+def _walk(value):
+  yield value
+  if isinstance(value, dict):
+    for key, item in value.items():
+      yield from _walk(key)
+      yield from _walk(item)
+  elif isinstance(value, (list, tuple, set)) and not isinstance(value, (CodelistRef, Unknown)):
+    for item in value:
+      yield from _walk(item)
+
+
+def _parse(path):
+  with open(path) as f:
+    return ast.parse(f.read(), filename=path)
+
+
+def _literal(node):
+  try:
+    return ast.literal_eval(node)
+  except ValueError:
+    return Unknown(ast.unparse(node))
+
+
+def load_codelists(path=CODELISTS_PY):
+  specs = {}
+  for node in _parse(path).body:
+    if not (isinstance(node, ast.Assign) and isinstance(node.value, ast.Call)):
+      continue
+    call = node.value
+    func = call.func.id if isinstance(call.func, ast.Name) else None
+    kwargs = {kw.arg: _literal(kw.value) for kw in call.keywords}
+    for target in node.targets:
+      if not isinstance(target, ast.Name):
+        continue
+      name = target.id
+      if func == "codelist_from_csv":
+        csv_path = _literal(call.args[0])
+        specs[name] = CodelistSpec(
+          name, csv_path, kwargs.get("system"), kwargs.get("column", "code"),
+          kwargs.get("category_column"), (os.path.basename(csv_path),), None,
+        )
+      elif func == "codelist":
+        specs[name] = CodelistSpec(
+          name, None, kwargs.get("system"), None, None, (), tuple(_literal(call.args[0])),
+        )
+      elif func == "combine_codelists":
+        parts = [specs[arg.id] for arg in call.args if isinstance(arg, ast.Name)]
+        specs[name] = CodelistSpec(
+          name, None, parts[0].system if parts else None, None, None,
+          tuple(source for part in parts for source in part.sources), None,
+        )
+  return specs
+
+
+class _Reader:
+
+  def __init__(self, tree, codelist_names):
+    self.codelist_names = codelist_names
+    self.helpers = {}
+    self.constants = {}
+    for node in tree.body:
+      if isinstance(node, ast.FunctionDef):
+        self.helpers[node.name] = node
+      elif isinstance(node, ast.Assign) and len(node.targets) == 1:
+        target = node.targets[0]
+        if isinstance(target, ast.Name) and not isinstance(node.value, ast.Call):
+          self.constants[target.id] = _literal(node.value)
+        elif isinstance(target, ast.Name):
+          self.constants[target.id] = Unknown(ast.unparse(node.value))
+
+  def evaluate(self, node, scope):
+    if isinstance(node, ast.Constant):
+      return node.value
+    if isinstance(node, ast.Name):
+      if node.id in scope:
+        return scope[node.id]
+      if node.id in self.codelist_names:
+        return CodelistRef((node.id,))
+      return self.constants.get(node.id, Unknown(node.id))
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+      return [self.evaluate(item, scope) for item in node.elts]
+    if isinstance(node, ast.Dict):
+      return {
+        self.evaluate(key, scope): self.evaluate(value, scope)
+        for key, value in zip(node.keys, node.values)
+      }
+    if isinstance(node, ast.Call):
+      return self.call(node, scope)
+    return Unknown(ast.unparse(node))
+
+  def call(self, node, scope):
+    func = node.func
+    if isinstance(func, ast.Attribute) and getattr(func.value, "id", None) == "patients":
+      method = func.attr
+      args = [self.evaluate(arg, scope) for arg in node.args]
+      kwargs = {kw.arg: self.evaluate(kw.value, scope) for kw in node.keywords}
+      if method in VARIADIC:
+        kwargs["column_names"] = args
+      else:
+        for key, value in zip(POSITIONAL.get(method, []), args):
+          kwargs[key] = value
+      return ("patients", method, kwargs)
+    if isinstance(func, ast.Name) and func.id == "combine_codelists":
+      names = []
+      for arg in node.args:
+        value = self.evaluate(arg, scope)
+        if isinstance(value, CodelistRef):
+          names.extend(value.names)
+      return CodelistRef(tuple(names))
+    if isinstance(func, ast.Name) and func.id in self.helpers:
+      helper = self.helpers[func.id]
+      params = [arg.arg for arg in helper.args.args]
+      inner = dict(zip(params, (self.evaluate(arg, scope) for arg in node.args)))
+      inner.update({kw.arg: self.evaluate(kw.value, scope) for kw in node.keywords})
+      for statement in helper.body:
+        if isinstance(statement, ast.Return):
+          return self.evaluate(statement.value, inner)
+    return Unknown(ast.unparse(node))
+
+
+def _is_definition(value):
+  return isinstance(value, tuple) and len(value) == 3 and value[0] == "patients"
+
+
+def _study_call(tree):
+  for node in ast.walk(tree):
+    if (
+      isinstance(node, ast.Call)
+      and isinstance(node.func, ast.Name)
+      and node.func.id == "StudyDefinition"
+    ):
+      return node
+  raise ValueError("No StudyDefinition(...) call found")
+
+
+def load_study(path=STUDY_DEFINITION_PY, codelists_path=CODELISTS_PY):
+  tree = _parse(path)
+  reader = _Reader(tree, set(load_codelists(codelists_path)))
+  variables = {}
+
+  def add(name, definition, hidden, parent):
+    _, method, kwargs = definition
+    own = {}
+    for key, value in kwargs.items():
+      if _is_definition(value):
+        # nested definitions are the hidden helper columns of categorised_as etc
+        add(key, value, True, name)
+      else:
+        own[key] = value
+    variables[name] = Variable(name, method, own, hidden, parent)
+
+  for keyword in _study_call(tree).keywords:
+    value = reader.evaluate(keyword.value, {})
+    if _is_definition(value):
+      add(keyword.arg, value, False, None)
+  return variables
+
+
+def study_options(path=STUDY_DEFINITION_PY):
+  # Non-variable StudyDefinition arguments, e.g. default_expectations and index_date
+  tree = _parse(path)
+  reader = _Reader(tree, set())
+  return {
+    keyword.arg: reader.evaluate(keyword.value, {})
+    for keyword in _study_call(tree).keywords
+    if not _is_definition(reader.evaluate(keyword.value, {}))
+  }
+
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def identifiers(value):
+  # Every identifier-like token in the strings of a (nested) argument value
+  found = set()
+  for item in _walk(value):
+    if isinstance(item, str):
+      found.update(IDENTIFIER.findall(item))
+  return found
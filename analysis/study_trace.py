@@ -0,0 +1,89 @@
+
+# --- STUDY EXTRACTION TRACING ---
+# Opt-in structured tracing for local_backend extractions. Code under trace opens
+# nested spans:
+#
+#   with tracer.span("scan", sql=sql) as event:
+#     rows = ...
+#     event["rows"] = len(rows)
+#
+# and each span is written, when it closes, as one JSON line to the trace file:
+#
+#   {"frame": "scan", "stack": "study;covid_test_positive;scan", "start": 1700000000.1,
+#    "end": 1700000000.3, "seconds": 0.2, "sql": "...", "rows": 4102}
+#
+# Start and end are Unix timestamps. On close, <trace>.folded receives the same spans
+# as a collapsed-stack profile ("study;variable;frame microseconds", self time per
+# stack) that flamegraph.pl, speedscope or inferno read directly, showing whether
+# time goes into codelist upload, the scan (or index build and lookup) or
+# post-processing.
+#
+# Tracing is off unless a path is given (--trace, or the STUDY_TRACE environment
+# variable); the default NULL tracer's spans cost one dict each.
+#
+# Usage: python analysis/local_backend.py --db output/local.sqlite --trace output/trace.jsonl
+
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+ENVIRONMENT = "STUDY_TRACE"
+ROOT = "study"
+
+
+class Tracer:
+
+  def __init__(self, path, plans=False):
+    self.path = path
+    self.plans = plans
+    self.file = open(path, "w")
+    self.stack = [ROOT]
+    self.children = [0.0]
+    self.folded = Counter()
+
+  @contextmanager
+  def span(self, frame, **fields):
+    # yields the event dict, so counts found inside the span can be added to it
+    event = {"frame": frame, **fields}
+    self.stack.append(frame)
+    self.children.append(0.0)
+    start, started = time.time(), time.perf_counter()
+    try:
+      yield event
+    finally:
+      seconds = time.perf_counter() - started
+      stack = ";".join(self.stack)
+      event.update(stack=stack, start=start, end=start + seconds, seconds=round(seconds, 6))
+      self.file.write(json.dumps(event, default=str) + "\n")
+      # the flame graph wants self time: this span's time less its children's
+      self.folded[stack] += max(seconds - self.children.pop(), 0.0)
+      self.stack.pop()
+      self.children[-1] += seconds
+
+  def close(self):
+    self.file.close()
+    with open(os.path.splitext(self.path)[0] + ".folded", "w") as f:
+      for stack, seconds in self.folded.items():
+        f.write(f"{stack} {round(seconds * 1e6)}\n")
+
+
+class _NullTracer:
+  plans = False
+
+  @contextmanager
+  def span(self, frame, **fields):
+    yield {}
+
+  def close(self):
+    pass
+
+
+NULL = _NullTracer()
+
+
+def from_environment(path=None, plans=False):
+  # a Tracer writing to path (or $STUDY_TRACE), else NULL
+  path = path or os.environ.get(ENVIRONMENT)
+  return Tracer(path, plans) if path else NULL
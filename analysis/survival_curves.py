@@ -0,0 +1,234 @@
+
+# --- SURVIVAL CURVE FIGURES (sts graph / stcurve in 200_cox_model.do) ---
+# Computes and draws the 21 figures the cox_model action declares, three per outcome:
+#
+#   survrisk_<outcome>.svg   Kaplan-Meier survival by drug arm, with numbers at risk
+#                            (sts graph, by(drug) risktable)
+#   survcur_<outcome>.svg    survival from `stcox i.drug` at drug = 0/1/2/3
+#                            (stcurve, survival)
+#   survhaz_<outcome>.svg    Epanechnikov-smoothed hazard from the same model
+#                            (stcurve, haz kernel(epan2))
+#
+# Each outcome's analysis times are sorted once (cox_model.outcome_risk_sets) and the
+# three curves all come from that sort: per-arm numbers at risk and events at each
+# distinct time are reverse cumulative sums of reduceat sums over the sorted rows, and
+# the Cox baseline hazard uses the same groups. The do-file writes survhaz only for
+# ae_all and survcurve_* rather than survcur_*; this writes what project.yaml lists.
+#
+# The curve arrays are cached per outcome as .npz files named by a sha1 of the input
+# columns the outcome uses and the curve settings, so changing the figures' style
+# only re-renders them; the (independent) SVGs are rendered over a process pool.
+# The cache lives in .cache/survival_curves, outside output/ so that it is never
+# released with the figures, and numbers at risk of 1-5 are suppressed before they
+# are stored. CURVE_CACHE_DIR overrides the cache location; CURVE_CACHE=0 disables it.
+#
+# Usage: python analysis/survival_curves.py [--input output/data/main.dta]
+#          [--figures output/figures] [--tmax 28] [--width DAYS] [--workers N]
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import cox_engine
+import cox_model
+import person_time
+import svg_figures
+
+## bump when the curves computed change, so old cache entries are not reused
+VERSION = 2
+## drug arms drawn, in legend order
+ARMS = {0: "Control", 1: "Sotrovimab", 2: "Paxlovid", 3: "Molnupiravir"}
+## points of the smoothed hazard grid
+HAZARD_POINTS = 200
+KINDS = ("survrisk", "survcur", "survhaz")
+
+
+def cache_dir():
+  return os.environ.get("CURVE_CACHE_DIR", os.path.join(".cache", "survival_curves"))
+
+
+def enabled():
+  return os.environ.get("CURVE_CACHE", "1") != "0"
+
+
+def input_digest(columns, outcome, tmax, width):
+  # sha1 of the columns an outcome's curves read and of the curve settings
+  digest = hashlib.sha1(f"{VERSION}:{outcome}:{tmax}:{width}".encode())
+  for name in ("start_date", "drug", f"stop_{outcome}", f"fail_{outcome}"):
+    digest.update(name.encode())
+    digest.update(np.ascontiguousarray(columns[name], dtype="float64").tobytes())
+  return digest.hexdigest()
+
+
+def default_width(event_times):
+  # Silverman's rule of thumb over the event times, at least one day
+  if len(event_times) < 2:
+    return 1.0
+  spread = np.subtract(*np.percentile(event_times, [75, 25])) / 1.349
+  scale = min(np.std(event_times, ddof=1), spread) or np.std(event_times, ddof=1)
+  return max(1.0, 0.9 * scale * len(event_times) ** -0.2)
+
+
+def epanechnikov(grid, times, increments, width):
+  # sum_j K((t - t_j) / b) dH(t_j) / b on the grid, K(u) = 3/4 (1 - u^2) on |u| < 1
+  u = (grid[:, None] - times[None, :]) / width
+  kernel = np.where(np.abs(u) < 1, 0.75 * (1 - u * u), 0.0)
+  return kernel @ increments / width
+
+
+def outcome_curves(columns, outcome, tmax=28, width=None):
+  # {array name: array} of the three figures' curves for one outcome
+  kept, risk_sets = cox_model.outcome_risk_sets(columns, outcome)
+  order, starts = risk_sets.order, risk_sets.starts
+  drug = np.asarray(columns["drug"], dtype=float)[order]
+  arms = np.column_stack([(drug == code) & kept[order] for code in ARMS]).astype(float)
+  # per distinct time: numbers at risk (time at or after it) and events, by arm
+  at_risk = np.cumsum(np.add.reduceat(arms, starts, axis=0)[::-1], axis=0)[::-1]
+  events = np.add.reduceat(arms * risk_sets.event[:, None], starts, axis=0)
+  times = risk_sets.time[starts]
+
+  # numbers at risk under the x axis ticks: at the first time on or after each
+  # (everyone kept at time 0), missing where 1-5
+  ticks = np.arange(0, tmax + 1, 7)
+  slots = np.searchsorted(times, np.maximum(ticks, np.nextafter(0, 1)), side="left")
+  risk_table = np.zeros((len(ticks), len(ARMS)))
+  risk_table[slots < len(times)] = at_risk[slots[slots < len(times)]]
+  risk_table[(risk_table >= person_time.REDACT[0]) & (risk_table <= person_time.REDACT[1])] = np.nan
+
+  shown = (times > 0) & (times <= tmax)
+  times, at_risk, events = times[shown], at_risk[shown], events[shown]
+  with np.errstate(divide="ignore", invalid="ignore"):
+    km = np.cumprod(1 - np.where(at_risk > 0, events / at_risk, 0.0), axis=0)
+
+  # stcox i.drug, then the Breslow baseline (control arm) cumulative hazard
+  X, names, included = cox_model.design(columns, "i.drug", rows=kept)
+  result = cox_engine.fit(risk_sets, X, weights=included.astype(float), robust=False)
+  # without failures the model has no estimate and every arm keeps the baseline
+  coef = np.nan_to_num(result.coef)
+  eta = (X @ coef)[order]
+  risk = np.where(included[order], np.exp(eta), 0.0)
+  denominator = np.cumsum(np.add.reduceat(risk, starts)[::-1])[::-1][shown]
+  all_events = np.add.reduceat((risk_sets.event & included[order]).astype(float), starts)[shown]
+  increments = np.where(denominator > 0, all_events / denominator, 0.0)
+  arm_hr = np.array([np.exp(coef[names.index(f"{code}.drug")]) if f"{code}.drug" in names else 1.0 for code in ARMS])
+  adjusted = np.exp(-np.cumsum(increments)[:, None] * arm_hr[None, :])
+
+  # kernel-smoothed hazard away from the boundaries where the kernel is cut off
+  event_times = times[increments > 0]
+  width = default_width(np.repeat(times, all_events.astype("int64"))) if width is None else width
+  low, high = width, tmax - width
+  if low >= high:
+    low, high = 0.0, float(tmax)
+  grid = np.linspace(low, high, HAZARD_POINTS)
+  baseline = epanechnikov(grid, event_times, increments[increments > 0], width)
+  return {
+    "times": times, "km": km, "ticks": ticks, "risk_table": risk_table,
+    "adjusted": adjusted, "grid": grid, "hazard": baseline[:, None] * arm_hr[None, :],
+    "width": np.array(width), "tmax": np.array(tmax),
+  }
+
+
+def cached_curves(columns, outcome, tmax=28, width=None):
+  # outcome_curves() via the cache when its inputs and settings are unchanged
+  if not enabled():
+    return outcome_curves(columns, outcome, tmax, width)
+  path = os.path.join(cache_dir(), f"{outcome}-{input_digest(columns, outcome, tmax, width)}.npz")
+  try:
+    with np.load(path) as cached:
+      return dict(cached)
+  except (OSError, ValueError):
+    pass
+  curves = outcome_curves(columns, outcome, tmax, width)
+  try:
+    os.makedirs(cache_dir(), exist_ok=True)
+    # write-then-rename so concurrent readers never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=cache_dir(), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+      np.savez(f, **curves)
+    os.replace(tmp, path)
+  except OSError:
+    pass
+  return curves
+
+
+def _risk_label(count):
+  # suppressed numbers at risk (1-5, missing in the risk table) are left blank
+  return "" if np.isnan(count) else f"{count:.0f}"
+
+
+def render(kind, outcome, curves):
+  # svg_figures.Figure for one of KINDS
+  tmax = float(curves["tmax"])
+  xticks = curves["ticks"]
+  if kind == "survrisk":
+    figure = svg_figures.Figure(
+      xlim=(0, tmax), ylim=(0, 1), height=560, margins=(120, 20, 40, 150),
+      xlabel="Time (Days)", ylabel="Survival Probability",
+    )
+    figure.axes(xticks=xticks, yticks=[0, 0.25, 0.5, 0.75, 1], ylabels=["0.000", "0.250", "0.500", "0.750", "1.000"])
+    top = figure.y(0) + 50
+    figure.text(figure.left - 6, top - 16, "Number at risk", anchor="end")
+    for j, label in enumerate(ARMS.values()):
+      colour = svg_figures.PALETTE[j]
+      figure.line(np.r_[0, curves["times"]], np.r_[1, curves["km"][:, j]], colour=colour, step=True, label=label)
+      figure.text(figure.left - 6, top + 16 * j, label, anchor="end")
+      for tick, count in zip(xticks, curves["risk_table"][:, j]):
+        figure.text(figure.x(tick), top + 16 * j, _risk_label(count))
+  elif kind == "survcur":
+    lowest = float(np.min(curves["adjusted"], initial=1.0))
+    floor = min(0.99, np.floor(lowest * 100) / 100)
+    figure = svg_figures.Figure(xlim=(0, tmax), ylim=(floor, 1), xlabel="Time (Days)", ylabel="Survival Probability")
+    figure.axes(xticks=xticks, yticks=np.round(np.linspace(floor, 1, 5), 4))
+    for j, label in enumerate(ARMS.values()):
+      figure.line(np.r_[0, curves["times"]], np.r_[1, curves["adjusted"][:, j]], colour=svg_figures.PALETTE[j], step=True, label=label)
+  else:
+    highest = float(np.max(curves["hazard"], initial=0.0)) or 1.0
+    figure = svg_figures.Figure(xlim=(0, tmax), ylim=(0, 1.1 * highest), xlabel="Time (Days)", ylabel="Smoothed hazard")
+    figure.axes(xticks=xticks, yticks=[float(f"{value:.3g}") for value in np.linspace(0, highest, 5)])
+    for j, label in enumerate(ARMS.values()):
+      figure.line(curves["grid"], curves["hazard"][:, j], colour=svg_figures.PALETTE[j], label=label)
+  figure.title = outcome
+  figure.legend()
+  return figure
+
+
+def _save(kind, outcome, curves, path):
+  render(kind, outcome, curves).save(path)
+  return path
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Draw the survrisk/survcur/survhaz figures of the cox_model action")
+  parser.add_argument("--input", default="output/data/main.dta")
+  parser.add_argument("--figures", default="output/figures")
+  parser.add_argument("--tmax", type=int, default=28, help="days of follow-up drawn")
+  parser.add_argument("--width", type=float, help="hazard kernel half-width in days (default: rule of thumb)")
+  parser.add_argument("--workers", type=int, default=1, help="render in this many processes (0: one per CPU)")
+  args = parser.parse_args(argv)
+
+  started = time.perf_counter()
+  columns = ["patient_id", "start_date", "drug"]
+  columns += [f"{prefix}_{outcome}" for outcome in cox_model.OUTCOMES for prefix in ("stop", "fail")]
+  frame = cox_model.load(args.input, columns)
+  curves = {outcome: cached_curves(frame, outcome, args.tmax, args.width) for outcome in cox_model.OUTCOMES}
+  computed = time.perf_counter() - started
+  os.makedirs(args.figures, exist_ok=True)
+  jobs = [
+    (kind, outcome, curves[outcome], os.path.join(args.figures, f"{kind}_{outcome}.svg"))
+    for outcome in cox_model.OUTCOMES for kind in KINDS
+  ]
+  if args.workers == 1:
+    paths = [_save(*job) for job in jobs]
+  else:
+    import parallel_fits
+    with parallel_fits.single_threaded_pool(args.workers or None) as pool:
+      paths = list(pool.map(_save, *zip(*jobs)))
+  print(f"Wrote {len(paths)} figures to {args.figures} in {time.perf_counter() - started:.1f}s ({computed:.1f}s for the curves)")
+
+
+if __name__ == "__main__":
+  main()
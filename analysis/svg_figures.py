@@ -0,0 +1,145 @@
+
+# --- MINIMAL SVG FIGURES ---
+# Plain SVG writer for the analysis figures (love plots, survival curves), so that
+# they need nothing beyond the standard library: a Figure maps data coordinates onto
+# a plot area, collects polylines, markers and labels, and writes one .svg file.
+#
+# Usage: figure = Figure(xlim=(0, 28), ylim=(0.9, 1), title="ae_all", xlabel="Days")
+#        figure.axes(xticks=range(0, 29, 7), yticks=[0.9, 0.95, 1])
+#        figure.line(times, survival, colour="#1b9e77", label="sotrovimab", step=True)
+#        figure.legend()
+#        figure.save("output/figures/km_ae_all.svg")
+
+from html import escape
+
+## colour-blind safe palette (ColorBrewer Dark2)
+PALETTE = ("#1b9e77", "#d95f02", "#7570b3", "#e7298a", "#66a61e", "#e6ab02", "#a6761d", "#666666")
+
+
+def _number(value):
+  return f"{value:.2f}".rstrip("0").rstrip(".")
+
+
+def tick_label(value):
+  return f"{value:g}" if isinstance(value, (int, float)) else str(value)
+
+
+class Figure:
+
+  def __init__(self, xlim, ylim, width=640, height=480, margins=(60, 20, 40, 50), title="", xlabel="", ylabel=""):
+    # margins: left, right, top, bottom in pixels
+    self.xlim, self.ylim = xlim, ylim
+    self.width, self.height = width, height
+    self.left, self.right, self.top, self.bottom = margins
+    self.title, self.xlabel, self.ylabel = title, xlabel, ylabel
+    self.elements, self.entries = [], []
+
+  def x(self, value):
+    low, high = self.xlim
+    return self.left + (value - low) / (high - low) * (self.width - self.left - self.right)
+
+  def y(self, value):
+    low, high = self.ylim
+    return self.height - self.bottom - (value - low) / (high - low) * (self.height - self.top - self.bottom)
+
+  def text(self, x, y, text, anchor="middle", size=11, rotate=False):
+    transform = f' transform="rotate(-90 {_number(x)} {_number(y)})"' if rotate else ""
+    self.elements.append(
+      f'<text x="{_number(x)}" y="{_number(y)}" font-size="{size}" text-anchor="{anchor}"{transform}>'
+      f"{escape(str(text))}</text>"
+    )
+
+  def axes(self, xticks=(), yticks=(), ylabels=None):
+    # frame, ticks and labels; ylabels replaces the y tick labels (categorical axes)
+    x0, x1 = self.x(self.xlim[0]), self.x(self.xlim[1])
+    y0, y1 = self.y(self.ylim[0]), self.y(self.ylim[1])
+    self.elements.append(
+      f'<rect x="{_number(x0)}" y="{_number(y1)}" width="{_number(x1 - x0)}" height="{_number(y0 - y1)}"'
+      ' fill="none" stroke="black"/>'
+    )
+    for tick in xticks:
+      x = self.x(tick)
+      self.elements.append(f'<line x1="{_number(x)}" y1="{_number(y0)}" x2="{_number(x)}" y2="{_number(y0 + 4)}" stroke="black"/>')
+      self.text(x, y0 + 16, tick_label(tick))
+    labels = ylabels if ylabels is not None else [tick_label(tick) for tick in yticks]
+    for tick, label in zip(yticks, labels):
+      y = self.y(tick)
+      self.elements.append(f'<line x1="{_number(x0 - 4)}" y1="{_number(y)}" x2="{_number(x0)}" y2="{_number(y)}" stroke="black"/>')
+      self.text(x0 - 6, y + 4, label, anchor="end")
+    if self.title:
+      self.text(self.width / 2, self.top / 2 + 5, self.title, size=14)
+    if self.xlabel:
+      self.text((x0 + x1) / 2, self.height - 10, self.xlabel)
+    if self.ylabel:
+      self.text(14, (y0 + y1) / 2, self.ylabel, rotate=True)
+
+  def line(self, xs, ys, colour="black", width=1.5, dash=None, step=False, label=None):
+    # polyline through (xs, ys); step draws a right-continuous step function
+    points = []
+    previous = None
+    for x, y in zip(xs, ys):
+      if step and previous is not None:
+        points.append((self.x(x), self.y(previous)))
+      points.append((self.x(x), self.y(y)))
+      previous = y
+    dashes = f' stroke-dasharray="{dash}"' if dash else ""
+    self.elements.append(
+      f'<polyline points="{" ".join(f"{_number(x)},{_number(y)}" for x, y in points)}" fill="none"'
+      f' stroke="{colour}" stroke-width="{width}"{dashes}/>'
+    )
+    if label is not None:
+      self.entries.append((label, colour, "line"))
+
+  def band(self, xs, lower, upper, colour="black", opacity=0.15, step=False):
+    # shaded region between lower and upper (confidence intervals)
+    def trace(values, xs):
+      points, previous = [], None
+      for x, y in zip(xs, values):
+        if step and previous is not None:
+          points.append((x, previous))
+        points.append((x, y))
+        previous = y
+      return points
+    outline = trace(upper, xs) + trace(lower, xs)[::-1]
+    self.elements.append(
+      f'<polygon points="{" ".join(f"{_number(self.x(x))},{_number(self.y(y))}" for x, y in outline)}"'
+      f' fill="{colour}" fill-opacity="{opacity}" stroke="none"/>'
+    )
+
+  def points(self, xs, ys, colour="black", radius=3.5, filled=True, label=None):
+    fill = colour if filled else "white"
+    for x, y in zip(xs, ys):
+      self.elements.append(
+        f'<circle cx="{_number(self.x(x))}" cy="{_number(self.y(y))}" r="{radius}" fill="{fill}" stroke="{colour}"/>'
+      )
+    if label is not None:
+      self.entries.append((label, colour, "filled" if filled else "open"))
+
+  def vline(self, x, colour="grey", dash=None):
+    self.line([x, x], self.ylim, colour=colour, width=1, dash=dash)
+
+  def legend(self, x=None, y=None):
+    # entries added with label=, stacked from the top right of the plot area
+    x = self.width - self.right - 150 if x is None else x
+    y = self.top + 16 if y is None else y
+    for label, colour, kind in self.entries:
+      if kind == "line":
+        self.elements.append(f'<line x1="{x}" y1="{y - 4}" x2="{x + 20}" y2="{y - 4}" stroke="{colour}" stroke-width="2"/>')
+      else:
+        fill = colour if kind == "filled" else "white"
+        self.elements.append(f'<circle cx="{x + 10}" cy="{y - 4}" r="3.5" fill="{fill}" stroke="{colour}"/>')
+      self.text(x + 26, y, label, anchor="start")
+      y += 16
+
+  def render(self):
+    return "\n".join([
+      f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{self.height}"'
+      f' viewBox="0 0 {self.width} {self.height}" font-family="sans-serif">',
+      f'<rect width="{self.width}" height="{self.height}" fill="white"/>',
+      *self.elements,
+      "</svg>",
+    ]) + "\n"
+
+  def save(self, path):
+    with open(path, "w") as f:
+      f.write(self.render())
@@ -0,0 +1,304 @@
+
+# --- SYNTHETIC TABLES FOR THE LOCAL BACKEND ---
+# Fills a local_backend SQLite database with synthetic patient records at any scale,
+# so the study can be extracted and its queries timed offline. Unlike dummy_data.py,
+# which draws the output columns directly, this draws the underlying event tables,
+# and every variable is then computed from them by local_backend.
+#
+# Per patient, the number of rows in each event table is Poisson (RATES). Codes are
+# drawn from the codelists the study actually queries on that table (HIT_SHARE of
+# rows) or from a noise code, so every codelist has matches and every query has
+# non-matching rows to skip. SGSS tests fall in the study period (each marked as
+# starting an infection episode or not) and a share of
+# positive patients get a therapeutic within 5 days of their test, so the
+# treated / untreated cohorts are populated. From each patient's index date (first
+# treatment, else first positive test) a share get an emergency admission (half with
+# a COVID primary diagnosis) or a death within OUTCOME_DAYS after it, or a high-cost
+# drug up to six months before it, so the outcome and lookback windows have events. Patients are generated in chunks with
+# numpy and bulk-inserted; the indexes are built once at the end.
+#
+# Usage: python analysis/synthetic_tables.py --patients 100000 [--db output/local.sqlite]
+#          [--seed 0] [--chunk-size 50000]
+
+import argparse
+import os
+
+import numpy as np
+
+import local_backend
+import study_spec
+
+## mean rows per patient in each event table
+RATES = {
+  "clinical_event": 20.0, "medication": 8.0, "apcs": 0.6, "sgss_test": 1.5,
+  "high_cost_drug": 0.05, "vaccination": 2.5,
+}
+## share of event rows carrying a code from one of the study's codelists
+HIT_SHARE = 0.3
+## share of event dates in the study period, where most windows are
+RECENT_SHARE = 0.3
+NOISE_CODE = "XaXXX"
+HISTORY = ("2010-01-01", "2023-01-01")
+STUDY_PERIOD = ("2021-12-01", "2022-06-30")
+STP_CODES = [f"E540000{i:02d}" for i in range(5, 50)]
+REGIONS = [
+  "North East", "North West", "Yorkshire and The Humber", "East Midlands", "West Midlands",
+  "East", "London", "South East", "South West",
+]
+ADMISSION_METHODS = ["11", "12", "13", "21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28", "31"]
+THERAPEUTICS = ["Sotrovimab", "Molnupiravir", "Paxlovid", "Remdesivir", "Casirivimab and imdevimab"]
+THERAPEUTIC_STATUSES = ["Approved", "Treatment Complete", "Treatment Not Started", "Treatment Stopped"]
+RISK_GROUPS = ["Downs syndrome", "solid cancer", "haematological diseases", "renal disease", "liver disease", "IMID", "HIV/AIDS"]
+TREATED_SHARE = 0.15
+DEATH_SHARE = 0.02
+EPISODE_DAYS = 90
+## shares of patients with an index date (first treatment, else first positive test)
+## given an outcome relative to it; outcomes fall a geometric number of days (mean
+## 1 / OUTCOME_DAILY) from it, at most OUTCOME_DAYS
+OUTCOME_SHARES = {"admission": 0.2, "death": 0.03, "high_cost_drug": 0.05}
+OUTCOME_DAILY = 0.1
+OUTCOME_DAYS = 60
+## codelists outcome admissions draw their primary diagnosis and procedures from
+OUTCOME_CODELISTS = {"covid_diagnosis": "covid_icd10_codes", "mabs_procedure": "mabs_procedure_codes"}
+
+## (table, codelist argument) pairs whose codelists feed each table's code pool
+SOURCES = {
+  ("with_these_clinical_events", "codelist"): "clinical_event",
+  ("with_these_medications", "codelist"): "medication",
+  ("admitted_to_hospital", "with_these_diagnoses"): "apcs_diagnosis",
+  ("admitted_to_hospital", "with_these_primary_diagnoses"): "apcs_diagnosis",
+  ("admitted_to_hospital", "with_these_procedures"): "apcs_procedure",
+  ("with_high_cost_drugs", "drug_name_matches"): "high_cost_drug",
+  ("with_these_codes_on_death_certificate", "codelist"): "ons_death_cause",
+}
+
+
+class Pool:
+  # the codelists queried on one table; a draw picks a codelist, then a code in it,
+  # so one-code codelists are hit as often as large ones
+
+  def __init__(self, codelists):
+    codelists = [codes for codes in codelists if codes]
+    self.codes = np.array([code for codes in codelists for code in codes], dtype=object)
+    self.lengths = np.array([len(codes) for codes in codelists])
+    self.offsets = np.cumsum(self.lengths) - self.lengths
+
+  def draw(self, rng, n):
+    if not len(self.codes):
+      return np.full(n, NOISE_CODE, dtype=object)
+    picked = rng.integers(0, len(self.lengths), n)
+    return self.codes[self.offsets[picked] + (rng.random(n) * self.lengths[picked]).astype(int)]
+
+
+def code_pools(variables=None, specs=None):
+  # {table: Pool of the codelists the study looks for in it}
+  variables = variables or study_spec.load_study()
+  specs = specs or study_spec.load_codelists()
+  pools = {table: {} for table in SOURCES.values()}
+  pools["clinical_event"]["bmi"] = list(local_backend.BMI_CODES)
+  for variable in variables.values():
+    for argument, value in variable.kwargs.items():
+      table = SOURCES.get((variable.method, argument))
+      if table and isinstance(value, study_spec.CodelistRef):
+        for name in value.names:
+          pools[table][name] = [code for code, _ in local_backend.load_codes(name, specs)]
+  for pool, name in OUTCOME_CODELISTS.items():
+    pools[pool] = {name: [code for code, _ in local_backend.load_codes(name, specs)]}
+  return {table: Pool(codelists.values()) for table, codelists in pools.items()}
+
+
+def _days(rng, n, period):
+  lower, upper = (np.datetime64(bound, "D") for bound in period)
+  return lower + rng.integers(0, (upper - lower).astype(int) + 1, n).astype("timedelta64[D]")
+
+
+def _text(dates):
+  return np.datetime_as_string(dates, unit="D").astype(object)
+
+
+def _codes(rng, n, pool):
+  codes = pool.draw(rng, n)
+  codes[rng.random(n) >= HIT_SHARE] = NOISE_CODE
+  return codes
+
+
+def _event_days(rng, n):
+  # event dates over the history, RECENT_SHARE of them in the study period
+  return np.where(rng.random(n) < RECENT_SHARE, _days(rng, n, STUDY_PERIOD), _days(rng, n, HISTORY))
+
+
+def _owners(rng, ids, rate):
+  # patient_id for each row of an event table with Poisson(rate) rows per patient
+  return np.repeat(ids, rng.poisson(rate, len(ids)))
+
+
+def _first_dates(ids, owners, dates):
+  # each patient's earliest date among rows owned by them, NaT if none
+  days = np.full(len(ids), np.iinfo("int64").max)
+  np.minimum.at(days, np.searchsorted(ids, owners), dates.astype("int64"))
+  return np.where(days < np.iinfo("int64").max, days, np.datetime64("NaT").astype("int64")).astype("datetime64[D]")
+
+
+def _outcomes(rng, ids, index, share):
+  # (patient positions, 0-OUTCOME_DAYS day offsets) for a share of indexed patients
+  chosen = np.flatnonzero(~np.isnat(index) & (rng.random(len(ids)) < share))
+  return chosen, np.minimum(rng.geometric(OUTCOME_DAILY, len(chosen)) - 1, OUTCOME_DAYS).astype("timedelta64[D]")
+
+
+def chunk_tables(ids, rng, pools):
+  # {table: list of row-value columns} for the patients `ids`
+  n = len(ids)
+  tables = {}
+  born = _days(rng, n, ("1920-01-01", "2021-12-31"))
+  tables["patient"] = [ids, _text(born), np.where(rng.random(n) < 0.5, "F", "M").astype(object)]
+
+  started = _days(rng, n, ("1990-01-01", "2021-06-01"))
+  left = rng.random(n) < 0.03
+  ended = np.where(left, _text(_days(rng, n, STUDY_PERIOD)), None)
+  region = rng.integers(0, len(REGIONS), n)
+  tables["registration"] = [
+    ids, _text(started), ended, np.array(STP_CODES, dtype=object)[rng.integers(0, len(STP_CODES), n)],
+    np.array(REGIONS, dtype=object)[region],
+  ]
+  tables["address"] = [ids, _text(started), [None] * n, rng.integers(1, 32845, n)]
+  tables["sus_ethnicity"] = [ids, rng.integers(1, 7, n).astype(str).astype(object)]
+
+  owners = _owners(rng, ids, RATES["clinical_event"])
+  m = len(owners)
+  comparators = np.array([None, None, None, None, "<", ">", "~"], dtype=object)[rng.integers(0, 7, m)]
+  tables["clinical_event"] = [
+    owners, _text(_event_days(rng, m)), _codes(rng, m, pools["clinical_event"]),
+    np.round(rng.normal(28, 6, m), 1), comparators,
+  ]
+  owners = _owners(rng, ids, RATES["medication"])
+  m = len(owners)
+  tables["medication"] = [owners, _text(_event_days(rng, m)), _codes(rng, m, pools["medication"])]
+
+  owners = _owners(rng, ids, RATES["sgss_test"])
+  m = len(owners)
+  tested = _days(rng, m, STUDY_PERIOD)
+  positive = rng.random(m) < 0.5
+  # a test starts an episode unless the patient had one with the same result in the 90 days before
+  order = np.lexsort((tested, positive, owners))
+  same = (owners[order][1:] == owners[order][:-1]) & (positive[order][1:] == positive[order][:-1])
+  gap = (tested[order][1:] - tested[order][:-1]).astype(int)
+  episode_start = np.ones(m, dtype=int)
+  episode_start[order[1:]] = ~(same & (gap <= EPISODE_DAYS))
+  pick = lambda labels: np.array(labels, dtype=object)[rng.integers(0, len(labels), m)]
+  tables["sgss_test"] = [
+    owners, _text(tested), np.where(positive, "positive", "negative").astype(object), episode_start,
+    pick(["LFT_Only", "PCR_Only", "LFT_WithPCR"]), pick(["0", "1", "9", ""]), pick(["Y", "N", ""]),
+    pick(["B.1.617.2", "B.1.1.529", "VOC-22JAN-01", ""]),
+  ]
+
+  # therapeutics follow a share of positive tests by 0-5 days
+  treated = np.flatnonzero(positive & (rng.random(m) < TREATED_SHARE))
+  t = len(treated)
+  given = rng.integers(0, 6, t).astype("timedelta64[D]")
+  tables["therapeutic"] = [
+    owners[treated], _text(tested[treated] + given),
+    np.array(THERAPEUTICS, dtype=object)[rng.integers(0, len(THERAPEUTICS), t)],
+    np.array(THERAPEUTIC_STATUSES, dtype=object)[
+      np.searchsorted([0.8, 0.9, 0.95], rng.random(t), side="right")
+    ],
+    np.where(rng.random(t) < 0.95, "non_hospitalised", "hospitalised").astype(object),
+    np.array(RISK_GROUPS, dtype=object)[rng.integers(0, len(RISK_GROUPS), t)],
+    np.array(REGIONS, dtype=object)[rng.integers(0, len(REGIONS), t)],
+  ]
+
+  # each patient's index date, and admissions, deaths and high-cost drugs after (or,
+  # for the drugs, before) it, so the outcome and lookback windows have events
+  index = _first_dates(ids, owners[treated], tested[treated] + given)
+  untreated = np.isnat(index)
+  index[untreated] = _first_dates(ids, owners[positive], tested[positive])[untreated]
+
+  owners = _owners(rng, ids, RATES["apcs"])
+  m = len(owners)
+  admitted = _event_days(rng, m)
+  methods = np.array(ADMISSION_METHODS, dtype=object)[rng.integers(0, len(ADMISSION_METHODS), m)]
+  classes = np.where(rng.random(m) < 0.8, "1", "2").astype(object)
+  diagnoses = _codes(rng, m, pools["apcs_diagnosis"])
+  chosen, after = _outcomes(rng, ids, index, OUTCOME_SHARES["admission"])
+  k = len(chosen)
+  emergency = [method for method in ADMISSION_METHODS if method.startswith("2")]
+  owners = np.concatenate([owners, ids[chosen]])
+  admitted = np.concatenate([admitted, index[chosen] + after])
+  methods = np.concatenate([methods, np.array(emergency, dtype=object)[rng.integers(0, len(emergency), k)]])
+  classes = np.concatenate([classes, np.full(k, "1", dtype=object)])
+  diagnoses = np.concatenate([
+    diagnoses, np.where(rng.random(k) < 0.5, pools["covid_diagnosis"].draw(rng, k), _codes(rng, k, pools["apcs_diagnosis"])),
+  ])
+  m += k
+  discharged = admitted + rng.geometric(0.25, m).astype("timedelta64[D]")
+  spells = np.arange(ids[0] * 100, ids[0] * 100 + m)
+  tables["apcs"] = [spells, owners, _text(admitted), _text(discharged), methods, classes, diagnoses]
+  extra = rng.poisson(1.5, m)
+  secondary = np.repeat(spells, extra)
+  tables["apcs_diagnosis"] = [
+    np.concatenate([spells, secondary]),
+    np.concatenate([diagnoses, _codes(rng, len(secondary), pools["apcs_diagnosis"])]),
+  ]
+  procedures = np.repeat(spells, rng.poisson(0.5, m))
+  mabs = spells[m - k:][rng.random(k) < 0.3]
+  tables["apcs_procedure"] = [
+    np.concatenate([procedures, mabs]),
+    np.concatenate([_codes(rng, len(procedures), pools["apcs_procedure"]), pools["mabs_procedure"].draw(rng, len(mabs))]),
+  ]
+
+  owners = _owners(rng, ids, RATES["high_cost_drug"])
+  chosen, before = _outcomes(rng, ids, index, OUTCOME_SHARES["high_cost_drug"])
+  owners = np.concatenate([owners, ids[chosen]])
+  days = np.concatenate([_event_days(rng, len(owners) - len(chosen)), index[chosen] - 3 * before])
+  tables["high_cost_drug"] = [owners, _text(days), pools["high_cost_drug"].draw(rng, len(owners))]
+
+  owners = _owners(rng, ids, RATES["vaccination"])
+  m = len(owners)
+  tables["vaccination"] = [
+    owners, _text(_days(rng, m, ("2020-12-08", "2022-06-30"))), np.full(m, local_backend.COVID_VACCINE_DISEASE),
+  ]
+
+  death = np.where(rng.random(n) < DEATH_SHARE, _days(rng, n, ("2021-06-01", "2022-12-31")), np.datetime64("NaT"))
+  chosen, after = _outcomes(rng, ids, index, OUTCOME_SHARES["death"])
+  death[chosen] = index[chosen] + after
+  died = np.flatnonzero(~np.isnat(death))
+  d = len(died)
+  causes = _codes(rng, d, pools["ons_death_cause"])
+  tables["ons_death"] = [ids[died], _text(death[died]), causes]
+  tables["ons_death_cause"] = [ids[died], causes]
+  return tables
+
+
+def populate(path, patients, seed=0, chunk_size=50_000):
+  if os.path.exists(path):
+    os.remove(path)
+  conn = local_backend.connect(path)
+  pools = code_pools()
+  for number, start in enumerate(range(0, patients, chunk_size)):
+    rng = np.random.default_rng([seed, number])
+    ids = np.arange(start + 1, min(start + chunk_size, patients) + 1)
+    for table, columns in chunk_tables(ids, rng, pools).items():
+      rows = zip(*(np.asarray(column, dtype=object).tolist() for column in columns))
+      conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})", rows)
+    conn.commit()
+  local_backend.create_indexes(conn)
+  conn.commit()
+  return conn
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Fill a local SQLite database with synthetic patient records")
+  parser.add_argument("--patients", type=int, default=100_000)
+  parser.add_argument("--db", default="output/local.sqlite")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--chunk-size", type=int, default=50_000)
+  args = parser.parse_args(argv)
+  conn = populate(args.db, args.patients, args.seed, args.chunk_size)
+  counts = {
+    table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    for table in ("patient", "clinical_event", "medication", "apcs", "sgss_test", "therapeutic")
+  }
+  print(f"Wrote {args.db}: " + ", ".join(f"{table} {count}" for table, count in counts.items()))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,166 @@
+
+# --- COVID THERAPEUTICS TIMELINE ---
+# Every with_covid_therapeutics variable in study_definition.py (first treatment
+# with each drug, its _not_start and _stopped variants, high_risk_cohort_ and
+# region_covid_therapeutics) reads the same therapeutics table with a different
+# filter. timeline() answers all of them from one read of that table:
+#
+#   1. each variable's filter (drug, status, indication, date window) is a
+#      vectorised mask over the table's columns
+#   2. the matching rows of every variable are stacked into one frame, sorted once
+#      by (variable, patient, date), and the first or last row per (variable,
+#      patient) is kept with a single drop_duplicates
+#   3. the kept rows are pivoted to one column per variable (date, risk group or
+#      region)
+#
+# The table is a DataFrame with patient_id, therapeutic, status, indication, date,
+# risk_group and region. Statuses default to cohortextractor's, approved or complete.
+#
+# local_backend.Extraction evaluates with_covid_therapeutics this way (unless
+# --no-scans): the first such column evaluated runs timeline() for every query with
+# the same anchor columns (anchor_columns()), from one read of the therapeutic table.
+# date_treated, a minimum_of over these columns, is then evaluated like any other.
+#
+# Usage: python analysis/therapeutics_timeline.py   (prints the plan)
+
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import shared_scans
+import study_spec
+
+METHOD = "with_covid_therapeutics"
+DEFAULT_STATUSES = ("Approved", "Treatment Complete")
+## returning= -> table column; binary_flag and date come from the matched row itself
+RETURNED_COLUMNS = {"risk_group": "risk_group", "region": "region", "therapeutic": "therapeutic"}
+BOUND = re.compile(
+  r"^\s*([A-Za-z_]\w*|\d{4}-\d{2}-\d{2})\s*(?:([+-])\s*(\d+)\s*(day|month|year)s?)?\s*$"
+)
+
+## lower/upper are date expressions such as "covid_test_positive_date + 5 days" or None
+Query = namedtuple("Query", "name therapeutics statuses indications lower upper first returning")
+
+
+def _names(value):
+  if value is None:
+    return None
+  return (value,) if isinstance(value, str) else tuple(value)
+
+
+def plan(variables=None):
+  # [Query] for every with_covid_therapeutics column, in StudyDefinition order
+  variables = variables or study_spec.load_study()
+  queries = []
+  for variable in variables.values():
+    if variable.method != METHOD or variable.hidden:
+      continue
+    kwargs = variable.kwargs
+    lower, upper = kwargs.get("between") or (kwargs.get("on_or_after"), kwargs.get("on_or_before"))
+    queries.append(Query(
+      variable.name,
+      _names(kwargs.get("with_these_therapeutics")),
+      _names(kwargs.get("with_these_statuses")) or DEFAULT_STATUSES,
+      _names(kwargs.get("with_these_indications")),
+      lower,
+      upper,
+      not kwargs.get("find_last_match_in_period"),
+      variable.returning,
+    ))
+  return queries
+
+
+def anchor_columns(query, outputs):
+  # the columns among `outputs` that a query's window bounds refer to
+  names = [BOUND.match(str(bound)) for bound in (query.lower, query.upper) if bound is not None]
+  return tuple(sorted({match.group(1) for match in names if match and match.group(1) in outputs}))
+
+
+def _bound(expression, patient_ids, anchors, options):
+  # per-row datetime64 values of a date expression for the given table rows
+  match = BOUND.match(str(expression))
+  if not match:
+    raise ValueError(f"Cannot evaluate date expression {expression!r}")
+  name, sign, number, unit = match.groups()
+  if name in anchors:
+    values = pd.to_datetime(anchors[name]).reindex(patient_ids)
+  else:
+    values = pd.Series(pd.Timestamp(options.get(name, name)), index=patient_ids)
+  if number:
+    offset = shared_scans._offset((int(number), unit))
+    values = values + offset if sign == "+" else values - offset
+  return values.to_numpy()
+
+
+def timeline(table, queries, anchors, options=None):
+  # DataFrame with one column per query, indexed like `anchors` (patient_id)
+  options = options if options is not None else study_spec.study_options()
+  patient_ids = table["patient_id"].to_numpy()
+  dates = pd.to_datetime(table["date"]).to_numpy()
+  columns = {
+    name: table[name].to_numpy() for name in ("therapeutic", "status", "indication")
+  }
+  bounds = {}
+
+  def bound(expression):
+    if expression not in bounds:
+      bounds[expression] = _bound(expression, patient_ids, anchors, options)
+    return bounds[expression]
+
+  rows, owners = [], []
+  for i, query in enumerate(queries):
+    mask = np.isin(columns["status"], query.statuses)
+    if query.therapeutics is not None:
+      mask &= np.isin(columns["therapeutic"], query.therapeutics)
+    if query.indications is not None:
+      mask &= np.isin(columns["indication"], query.indications)
+    if query.lower is not None:
+      mask &= dates >= bound(query.lower)
+    if query.upper is not None:
+      mask &= dates <= bound(query.upper)
+    matched = np.flatnonzero(mask)
+    rows.append(matched)
+    owners.append(np.full(len(matched), i))
+
+  hits = pd.DataFrame({
+    "query": np.concatenate(owners),
+    "patient_id": patient_ids[np.concatenate(rows)],
+    "date": dates[np.concatenate(rows)],
+    "row": np.concatenate(rows),
+  })
+  hits["first"] = np.array([query.first for query in queries], dtype=bool)[hits["query"]]
+  # ascending date for find_first, descending for find_last, then keep the top row
+  hits["key"] = np.where(hits["first"], hits["date"].values.astype("int64"), -hits["date"].values.astype("int64"))
+  hits = hits.sort_values(["query", "patient_id", "key"], kind="stable")
+  hits = hits.drop_duplicates(["query", "patient_id"])
+
+  result = {}
+  for i, query in enumerate(queries):
+    found = hits[hits["query"].values == i]
+    if query.returning == "binary_flag":
+      values = pd.Series(True, index=found["patient_id"].values)
+      result[query.name] = values.reindex(anchors.index, fill_value=False).values
+      continue
+    if query.returning in RETURNED_COLUMNS:
+      values = table[RETURNED_COLUMNS[query.returning]].to_numpy()[found["row"].values]
+    else:
+      values = found["date"].values
+    result[query.name] = pd.Series(values, index=found["patient_id"].values).reindex(anchors.index).values
+  return pd.DataFrame(result, index=anchors.index)
+
+
+def main():
+  queries = plan()
+  print(f"{len(queries)} with_covid_therapeutics columns from one table read:")
+  for query in queries:
+    window = f"[{query.lower or ''}, {query.upper or ''}]"
+    print(
+      f"  {query.name}: {'/'.join(query.therapeutics or ('any',))}"
+      f" {'/'.join(query.statuses)} {window} {'first' if query.first else 'last'} {query.returning}"
+    )
+
+
+if __name__ == "__main__":
+  main()
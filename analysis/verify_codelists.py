@@ -0,0 +1,160 @@
+
+# --- OFFLINE CODELIST INTEGRITY CHECK ---
+# Checks the CSVs in codelists/ against codelists/codelists.json and
+# codelists/codelists.txt without downloading anything:
+#
+#   * every file listed in codelists.json exists and its sha1 matches the recorded sha
+#   * codelists.json and codelists.txt list the same codelist ids
+#   * every CSV in codelists/ is listed in codelists.json
+#
+# For each bad file it lists the codelists.py variables built from it and the
+# StudyDefinition columns that use those variables, directly or through columns
+# derived from them. Files are hashed the way
+# codelists.json records them (see codelist_cache.file_sha) on a thread pool, as
+# hashlib releases the GIL and threads avoid process start-up cost. Each hash is
+# cached against the file's size and mtime, so a warm run only stats the directory.
+#
+# Usage: python analysis/verify_codelists.py [--codelist-dir codelists] [--no-cache]
+# Exits non-zero if anything does not match.
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import study_dependencies
+import study_spec
+from codelist_cache import cache_dir, file_sha
+
+HASH_CACHE = "verify_hashes.json"
+
+
+def _load_hash_cache(path):
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+
+def _save_hash_cache(path, cache):
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+      json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+  except OSError:
+    pass
+
+
+def hash_files(codelist_dir, names, cache_path=None):
+  # {file name: sha1 or None if missing}, re-hashing only files whose size or
+  # mtime changed since the cached hash was taken
+  cache = _load_hash_cache(cache_path) if cache_path else {}
+  hashes, stale = {}, []
+  for name in names:
+    try:
+      stat = os.stat(os.path.join(codelist_dir, name))
+    except FileNotFoundError:
+      hashes[name] = None
+      continue
+    entry = cache.get(name)
+    if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+      hashes[name] = entry[2]
+    else:
+      stale.append((name, stat))
+
+  if stale:
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+      paths = [os.path.join(codelist_dir, name) for name, _ in stale]
+      for (name, stat), sha in zip(stale, pool.map(file_sha, paths)):
+        hashes[name] = sha
+        cache[name] = [stat.st_size, stat.st_mtime_ns, sha]
+    if cache_path:
+      _save_hash_cache(cache_path, cache)
+  return hashes
+
+
+def check(codelist_dir, cache_path=None):
+  # Returns {file name: [problem, ...]} plus problems not tied to one file
+  with open(os.path.join(codelist_dir, "codelists.json")) as f:
+    manifest = json.load(f)["files"]
+  with open(os.path.join(codelist_dir, "codelists.txt")) as f:
+    listed_ids = {
+      line.strip().rstrip("/") for line in f if line.strip() and not line.startswith("#")
+    }
+
+  problems = {}
+  general = []
+  csvs = {name for name in os.listdir(codelist_dir) if name.endswith(".csv")}
+  hashes = hash_files(codelist_dir, sorted(set(manifest) | csvs), cache_path)
+
+  for name, entry in sorted(manifest.items()):
+    if hashes[name] is None:
+      problems.setdefault(name, []).append("missing from codelists/")
+    elif hashes[name] != entry.get("sha"):
+      problems.setdefault(name, []).append(
+        f"sha {hashes[name][:12]} does not match codelists.json {entry.get('sha', '')[:12]}"
+      )
+    if entry.get("id", "").rstrip("/") not in listed_ids:
+      problems.setdefault(name, []).append(f"id {entry.get('id')} not in codelists.txt")
+  for name in sorted(csvs - set(manifest)):
+    problems.setdefault(name, []).append("not listed in codelists.json")
+
+  manifest_ids = {entry.get("id", "").rstrip("/") for entry in manifest.values()}
+  for codelist_id in sorted(listed_ids - manifest_ids):
+    general.append(f"{codelist_id} is in codelists.txt but has no file in codelists.json")
+  return problems, general
+
+
+def dependents(bad_files):
+  # codelists.py variables and StudyDefinition columns that read any bad file
+  codelists = study_spec.load_codelists()
+  variables = sorted(
+    name for name, spec in codelists.items() if set(spec.sources) & set(bad_files)
+  )
+  affected = set(variables)
+  study = study_spec.load_study()
+  direct = {variable.name for variable in study.values() if affected & set(variable.codelists)}
+  # and every column derived from those (maximum_of, satisfying, ...), at any depth
+  readers = {name: set() for name in study}
+  for name, inputs in study_dependencies.dependencies(study).items():
+    for input_name in inputs:
+      readers[input_name].add(name)
+  return variables, sorted(study_dependencies.closure(direct, readers))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Check codelists/ against codelists.json and codelists.txt")
+  parser.add_argument("--codelist-dir", default="codelists")
+  parser.add_argument("--no-cache", action="store_true", help="re-hash every file")
+  args = parser.parse_args(argv)
+
+  cache_path = None if args.no_cache else os.path.join(cache_dir(), HASH_CACHE)
+
+  problems, general = check(args.codelist_dir, cache_path)
+  for message in general:
+    print(message)
+  for name, messages in problems.items():
+    for message in messages:
+      print(f"{name}: {message}")
+  if not problems and not general:
+    print("All codelists match codelists.json and codelists.txt")
+    return 0
+
+  variables, columns = dependents(problems)
+  if variables:
+    print("\nAffected codelists.py variables:")
+    for name in variables:
+      print(f"  {name}")
+  if columns:
+    print("\nAffected StudyDefinition columns:")
+    for name in columns:
+      print(f"  {name}")
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
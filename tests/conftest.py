@@ -0,0 +1,73 @@
+
+# --- TEST FIXTURES ---
+# The analysis scripts import each other as top-level modules (they are run as
+# python analysis/<script>.py), so the tests put analysis/ on the path the same way.
+# cohort() builds a small synthetic main.dta: every column cox_model.py,
+# propensity_model.py and survival_curves.py read, with outcomes that depend on
+# age, drug and solid_cancer, some missing covariates and some rows stset drops.
+# local_db() is a small synthetic_tables.py database for the local extraction tests.
+#
+# Usage: python -m pytest -q
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "analysis"))
+
+import cox_model  # noqa: E402
+import local_backend  # noqa: E402
+import synthetic_tables  # noqa: E402
+
+BINARY = (
+  "drugs_consider_risk_contra downs_syndrome solid_cancer haem_disease renal_disease liver_disease"
+  " imid_on_drug immunosupression hiv_aids solid_organ rare_neuro diabetes chronic_cardiac_disease"
+  " chronic_respiratory_disease hypertension"
+)
+
+
+def make_cohort(n, seed=0):
+  # DataFrame laid out like main.dta, dates as day numbers
+  rng = np.random.default_rng(seed)
+  frame = {"patient_id": np.arange(n), "start_date": rng.integers(22600, 23000, n).astype(float)}
+  frame["drug"] = rng.choice([0, 1, 2, 3], n, p=[0.5, 0.2, 0.2, 0.1]).astype(float)
+  frame["age"] = rng.integers(18, 95, n).astype(float)
+  frame["sex"] = rng.integers(0, 2, n).astype(float)
+  frame["region_nhs"] = rng.integers(1, 8, n).astype(float)
+  for name in BINARY.split():
+    frame[name] = (rng.random(n) < 0.1).astype(float)
+  frame["vaccination_status"] = rng.integers(0, 5, n).astype(float)
+  frame["imd"] = np.where(rng.random(n) < 0.05, np.nan, rng.integers(1, 6, n))
+  frame["White"] = np.where(rng.random(n) < 0.1, np.nan, (rng.random(n) < 0.8) * 1.0)
+  frame["bmi_group"] = np.where(rng.random(n) < 0.2, np.nan, rng.integers(0, 4, n))
+  linear = 0.02 * (frame["age"] - 50) + 0.3 * (frame["drug"] == 1) - 0.2 * (frame["drug"] == 2) + 0.5 * frame["solid_cancer"]
+  for outcome in cox_model.OUTCOMES:
+    hazard = rng.uniform(0.002, 0.02) * np.exp(linear)
+    failure, censored = rng.exponential(1 / hazard), rng.integers(1, 29, n)
+    failed = failure <= censored
+    days = np.where(failed, np.ceil(failure), censored).astype(float)
+    days[rng.random(n) < 0.01] = 0
+    frame[f"stop_{outcome}"] = frame["start_date"] + days
+    frame[f"fail_{outcome}"] = failed.astype(float)
+  return pd.DataFrame(frame)
+
+
+@pytest.fixture(scope="session")
+def cohort():
+  return make_cohort(3000)
+
+
+@pytest.fixture(scope="session")
+def local_db(tmp_path_factory):
+  path = str(tmp_path_factory.mktemp("local") / "local.sqlite")
+  synthetic_tables.populate(path, 2000, 0).close()
+  return path
+
+
+def extract(path, **kwargs):
+  # {column: values} of a local extraction; each gets its own connection, as an
+  # extraction's temporary tables outlive it
+  return local_backend.Extraction(local_backend.connect(path), **kwargs).run()
@@ -0,0 +1,55 @@
+
+# --- COVARIATE BALANCE TESTS ---
+# balance_table's matrix moments against per-group np.average, as pbalchk computes
+# them: complete cases of the model's covariates, reliability-weighted variances and
+# standardised differences over the pooled SD of the unweighted groups.
+
+import numpy as np
+import pytest
+
+import balance
+
+MODELS = {"small": "age i.sex", "large": "age i.sex imd White"}
+
+
+def weighted_moments(values, weights):
+  mean = np.average(values, weights=weights)
+  variance = weights @ (values - mean) ** 2 / (weights.sum() - (weights @ weights) / weights.sum())
+  return mean, variance
+
+
+def test_balance_table(cohort):
+  rng = np.random.default_rng(4)
+  weights = {f"iptw_{model}": rng.uniform(1, 4, len(cohort)) for model in MODELS}
+  weights["iptw_large"][:10] = np.nan
+  table = balance.balance_table(cohort, weights, MODELS).set_index(["model", "weighting", "covariate"])
+  untreated = cohort["drug"].values == 0
+  for model, terms in MODELS.items():
+    covariates = [term.split(".")[-1] for term in terms.split()]
+    rows = cohort[covariates].notna().all(axis=1).values
+    for name in covariates:
+      values = cohort[name].values
+      for weighting in ("unweighted", "weighted"):
+        w = rows.astype(float) if weighting == "unweighted" else np.where(rows, np.nan_to_num(weights[f"iptw_{model}"]), 0.0)
+        (m0, v0), (m1, v1) = (weighted_moments(values[group & (w > 0)], w[group & (w > 0)]) for group in (untreated, ~untreated))
+        if weighting == "unweighted":
+          pooled = np.sqrt((v0 + v1) / 2)
+          # reliability weights of 1 give the usual sample variance
+          assert v0 == pytest.approx(np.var(values[rows & untreated], ddof=1))
+        row = table.loc[(model, weighting, name)]
+        assert row["mean_no_drug"] == pytest.approx(m0)
+        assert row["mean_drug"] == pytest.approx(m1)
+        assert row["var_no_drug"] == pytest.approx(v0)
+        assert row["var_drug"] == pytest.approx(v1)
+        assert row["smd"] == pytest.approx((m0 - m1) / pooled)
+        assert row["variance_ratio"] == pytest.approx(v0 / v1)
+
+
+def test_layout(cohort):
+  weights = {f"iptw_{model}": np.ones(len(cohort)) for model in MODELS}
+  table = balance.balance_table(cohort, weights, MODELS)
+  assert len(table) == 2 * (2 + 4)
+  # unit weights leave every statistic as it was
+  unweighted = table[table["weighting"] == "unweighted"].drop(columns="weighting").reset_index(drop=True)
+  weighted = table[table["weighting"] == "weighted"].drop(columns="weighting").reset_index(drop=True)
+  np.testing.assert_allclose(unweighted.select_dtypes("number"), weighted.select_dtypes("number"))
@@ -0,0 +1,55 @@
+
+# --- PER-VARIABLE BENCHMARK TESTS ---
+
+import json
+import tracemalloc
+
+import pytest
+
+import benchmark_variables
+import local_backend
+
+
+def timing(seconds):
+  return {"seconds": seconds, "rows": 0, "vm_steps": 0, "peak_bytes": 0}
+
+
+def test_regressions():
+  baseline = {"1000": {"fast": timing(0.001), "slow": timing(0.1), "steady": timing(0.2)}}
+  results = {
+    "1000": {"fast": timing(0.003), "slow": timing(0.2), "steady": timing(0.25), "new": timing(1.0)},
+    "10000": {"slow": timing(5.0)},
+  }
+  # fast stays under min_seconds; new and the 10000 run have no baseline
+  assert benchmark_variables.regressions(results, baseline, 1.5, 0.005) == [("1000", "slow", 0.1, 0.2)]
+  assert benchmark_variables.regressions(results, baseline, 1.5, 0.0005) == [
+    ("1000", "fast", 0.001, 0.003), ("1000", "slow", 0.1, 0.2),
+  ]
+
+
+def test_measure(local_db):
+  extraction = local_backend.Extraction(local_backend.connect(local_db))
+  extraction.run()
+  variable = extraction.variables["all_hosp_date"]
+  measured = benchmark_variables.measure(extraction, variable, repeat=2)
+  assert set(measured) == {"seconds", "rows", "vm_steps", "peak_bytes"}
+  assert measured["seconds"] > 0 and measured["vm_steps"] > 0 and measured["peak_bytes"] > 0
+  assert measured["rows"] == benchmark_variables.matched_rows(extraction, variable) > 0
+  assert not tracemalloc.is_tracing()
+
+
+def test_main_flags_regressions(tmp_path, capsys):
+  output, baseline = tmp_path / "results.json", tmp_path / "baseline.json"
+  arguments = [
+    "--sizes", "200", "--variables", "age", "covid_positive_previous_30_days", "--repeat", "1",
+    "--cache-dir", str(tmp_path / "cache"), "--output", str(output),
+  ]
+  benchmark_variables.main(arguments)
+  results = json.loads(output.read_text())["results"]
+  assert set(results["200"]) == {"age", "covid_positive_previous_30_days"}
+  for measured in results["200"].values():
+    measured["seconds"] /= 100
+  baseline.write_text(json.dumps({"results": results}))
+  with pytest.raises(SystemExit):
+    benchmark_variables.main(arguments + ["--baseline", str(baseline), "--min-seconds", "0"])
+  assert "REGRESSION" in capsys.readouterr().out
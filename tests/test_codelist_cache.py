@@ -0,0 +1,93 @@
+
+# --- BINARY CODELIST CACHE TESTS ---
+
+import os
+
+import pytest
+
+import codelist_cache
+
+
+@pytest.fixture
+def csv_path(tmp_path, monkeypatch):
+  monkeypatch.setenv("CODELIST_CACHE_DIR", str(tmp_path / "cache"))
+  monkeypatch.delenv("CODELIST_CACHE", raising=False)
+  path = tmp_path / "codes.csv"
+  path.write_text("code,group\nA1,x\nB2,y\n")
+  return str(path)
+
+
+class Parser:
+  # stands in for the CSV reader, counting how often the CSV is parsed
+
+  def __init__(self, codes):
+    self.codes, self.calls = codes, 0
+
+  def __call__(self):
+    self.calls += 1
+    return list(self.codes)
+
+
+def load(csv_path, parse, category_column=None, system="ctv3"):
+  return codelist_cache.load(csv_path, system, "code", category_column, parse)
+
+
+def test_warm_load_skips_parsing(csv_path):
+  parse = Parser(["A1", "B2"])
+  assert load(csv_path, parse) == ["A1", "B2"]
+  assert load(csv_path, parse) == ["A1", "B2"]
+  assert parse.calls == 1
+  assert os.path.exists(codelist_cache.cache_path(csv_path, "code"))
+
+
+def test_categories_round_trip(csv_path):
+  parse = Parser([("A1", "x"), ("B2", "y")])
+  load(csv_path, parse, "group")
+  assert load(csv_path, parse, "group") == [("A1", "x"), ("B2", "y")]
+  assert parse.calls == 1
+
+
+def test_edited_csv_invalidates(csv_path):
+  load(csv_path, Parser(["A1", "B2"]))
+  with open(csv_path, "a") as f:
+    f.write("C3,z\n")
+  parse = Parser(["A1", "B2", "C3"])
+  assert load(csv_path, parse) == ["A1", "B2", "C3"]
+  assert parse.calls == 1
+
+
+def test_touched_csv_still_hits(csv_path):
+  # a fresh checkout changes the mtime but not the content
+  load(csv_path, Parser(["A1", "B2"]))
+  stat = os.stat(csv_path)
+  os.utime(csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+  parse = Parser(["A1", "B2"])
+  assert load(csv_path, parse) == ["A1", "B2"]
+  assert parse.calls == 0
+
+
+def test_other_system_misses(csv_path):
+  load(csv_path, Parser(["A1", "B2"]))
+  parse = Parser(["A1", "B2"])
+  load(csv_path, parse, system="snomed")
+  assert parse.calls == 1
+
+
+@pytest.mark.parametrize("keep", [0, 10, codelist_cache.HEADER.size + 2])
+def test_empty_or_truncated_entry_is_a_miss(csv_path, keep):
+  load(csv_path, Parser(["A1", "B2"]))
+  path = codelist_cache.cache_path(csv_path, "code")
+  with open(path, "r+b") as f:
+    f.truncate(keep)
+  assert codelist_cache.read(path, csv_path) is None
+  parse = Parser(["A1", "B2"])
+  assert load(csv_path, parse) == ["A1", "B2"]
+  assert parse.calls == 1
+
+
+def test_disabled(csv_path, monkeypatch):
+  monkeypatch.setenv("CODELIST_CACHE", "0")
+  parse = Parser(["A1"])
+  load(csv_path, parse)
+  load(csv_path, parse)
+  assert parse.calls == 2
@@ -0,0 +1,54 @@
+
+# --- VECTORISED CODELIST MEMBERSHIP TESTS ---
+# tag(), contains() and pairs() against Python set lookups.
+
+import numpy as np
+import pytest
+
+from codelist_membership import CodelistMembership
+
+## ids that only look alike: leading zeros, too long for int64, and text
+TRICKY = ["0", "00", "123", "0123", "1234567890123456789", "12345678901234567", "Y1234", "XaXXX", "Ménière", ""]
+
+
+@pytest.fixture
+def codelists():
+  rng = np.random.default_rng(10)
+  numbers = [str(code) for code in rng.integers(10 ** 5, 10 ** 15, 400)]
+  texts = ["".join(rng.choice(list("ABCXYZ0123.ab"), rng.integers(3, 8))) for _ in range(400)]
+  pool = numbers + texts + TRICKY
+  # more than 64 codelists, so masks span two words
+  return {f"list_{i}": set(rng.choice(pool, rng.integers(0, 40))) for i in range(70)}, pool
+
+
+def test_matches_sets(codelists):
+  codelists, pool = codelists
+  rng = np.random.default_rng(11)
+  rows = list(rng.choice(pool + ["999", "not a code at all", "A" * 40, "01234"], 5000)) + [None]
+  membership = CodelistMembership(codelists)
+  assert len(membership) == len(set().union(*codelists.values()))
+  masks = membership.tag(np.array(rows, dtype=object))
+  assert masks.shape == (len(rows), 2)
+  expected_pairs = []
+  for position, (key, codes) in enumerate(codelists.items()):
+    expected = np.array([code is not None and code in codes for code in rows])
+    np.testing.assert_array_equal(membership.contains(masks, key), expected, key)
+    expected_pairs += [(row, position) for row in np.flatnonzero(expected)]
+  found_rows, positions = membership.pairs(masks)
+  assert sorted(zip(found_rows.tolist(), positions.tolist())) == sorted(expected_pairs)
+  assert list(found_rows) == sorted(found_rows)
+
+
+def test_string_arrays():
+  membership = CodelistMembership({"a": ["0123", "A1"], "b": ["123", "A1"]})
+  masks = membership.tag(np.array(["123", "0123", "A1", "A12", "B"]))
+  np.testing.assert_array_equal(membership.contains(masks, "a"), [False, True, True, False, False])
+  np.testing.assert_array_equal(membership.contains(masks, "b"), [True, False, True, False, False])
+
+
+def test_empty():
+  membership = CodelistMembership({"a": [], "b": ["A1"]})
+  masks = membership.tag(np.array([], dtype=object))
+  assert masks.shape == (0, 1)
+  rows, positions = membership.pairs(membership.tag(np.array(["A1", "X"], dtype=object)))
+  assert list(rows) == [0] and list(positions) == [1]
@@ -0,0 +1,84 @@
+
+# --- LAZY CODELIST REGISTRY TESTS ---
+# codelist_from_csv reads nothing until a variable uses the codes, then gives what
+# cohortextractor's own codelist_from_csv gives. Needs cohortextractor.
+
+import pickle
+
+import pytest
+
+cohortextractor = pytest.importorskip("cohortextractor")
+
+import codelist_registry  # noqa: E402
+
+
+@pytest.fixture
+def csv_path(tmp_path, monkeypatch):
+  # the cache (codelist_cache.py) is tested on its own
+  monkeypatch.setenv("CODELIST_CACHE", "0")
+  path = tmp_path / "codes.csv"
+  path.write_text("code,term,group\nA1,first,x\nB2,second,y\nC3,third,x\n")
+  return str(path)
+
+
+def test_not_read_until_used(tmp_path):
+  codes = codelist_registry.codelist_from_csv(str(tmp_path / "missing.csv"), system="ctv3")
+  assert not codes.loaded
+  assert codes.system == "ctv3" and not codes.has_categories
+  with pytest.raises(OSError):
+    len(codes)
+
+
+def test_codes_match_cohortextractor(csv_path):
+  codes = codelist_registry.codelist_from_csv(csv_path, system="ctv3")
+  assert not codes.loaded
+  assert "B2" in codes
+  assert codes.loaded
+  assert list(codes) == list(cohortextractor.codelist_from_csv(csv_path, system="ctv3"))
+  categorised = codelist_registry.codelist_from_csv(csv_path, system="ctv3", category_column="group")
+  assert categorised.has_categories
+  assert list(categorised) == list(cohortextractor.codelist_from_csv(csv_path, system="ctv3", category_column="group"))
+
+
+def test_pickles_as_plain_codelist(csv_path):
+  codes = pickle.loads(pickle.dumps(codelist_registry.codelist_from_csv(csv_path, system="ctv3")))
+  assert not isinstance(codes, codelist_registry.LazyCodelist)
+  assert list(codes) == ["A1", "B2", "C3"] and codes.system == "ctv3"
+
+
+def test_load_times(csv_path):
+  codes = codelist_registry.codelist_from_csv(csv_path, system="ctv3")
+  codes.resolve()
+  assert codes.name in codelist_registry.load_times()
+
+
+def test_combine_memoised(csv_path, tmp_path):
+  other = tmp_path / "other.csv"
+  other.write_text("code,term,group\nC3,third,x\nD4,fourth,y\n")
+  first = codelist_registry.codelist_from_csv(csv_path, system="ctv3")
+  second = codelist_registry.codelist_from_csv(str(other), system="ctv3")
+  combined = codelist_registry.combine_codelists(first, second)
+  assert codelist_registry.combine_codelists(first, second) is combined
+  assert not combined.loaded and not first.loaded
+  expected = cohortextractor.combine_codelists(
+    cohortextractor.codelist_from_csv(csv_path, system="ctv3"),
+    cohortextractor.codelist_from_csv(str(other), system="ctv3"),
+  )
+  assert list(combined) == list(expected) == ["A1", "B2", "C3", "D4"]
+  assert codelist_registry.combine_codelists(second, first) is not combined
+  with pytest.raises(ValueError):
+    codelist_registry.combine_codelists(first, codelist_registry.codelist_from_csv(str(other), system="snomed"))
+  with pytest.raises(ValueError):
+    codelist_registry.combine_codelists(
+      first, codelist_registry.codelist_from_csv(str(other), system="ctv3", category_column="group"),
+    )
+
+
+def test_same_content_shared(csv_path, tmp_path):
+  copy = tmp_path / "copy.csv"
+  copy.write_text(open(csv_path).read())
+  first = codelist_registry.codelist_from_csv(csv_path, system="ctv3").resolve()
+  second = codelist_registry.codelist_from_csv(str(copy), system="ctv3").resolve()
+  assert list(first) == list(second)
+  assert all(a is b for a, b in zip(first, second))
+  assert codelist_registry.intern_codes(["A1", "B2", "C3"]) is codelist_registry.intern_codes(("A1", "B2", "C3"))
@@ -0,0 +1,168 @@
+
+# --- COX ENGINE REFERENCE TESTS ---
+# cox_engine.fit against published values for the Gehan leukaemia remission data and
+# against a direct, loop-per-event-time implementation of the same estimators
+# (partial likelihood, information and score residuals written out term by term).
+
+import numpy as np
+import pytest
+
+import cox_engine
+
+## Gehan (1965): weeks of remission, 6-MP then placebo; 0 marks a censored time
+GEHAN_6MP = [(6, 1), (6, 1), (6, 1), (6, 0), (7, 1), (9, 0), (10, 1), (10, 0), (11, 0), (13, 1), (16, 1),
+             (17, 0), (19, 0), (20, 0), (22, 1), (23, 1), (25, 0), (32, 0), (32, 0), (34, 0), (35, 0)]
+GEHAN_PLACEBO = [(t, 1) for t in (1, 1, 2, 2, 3, 4, 4, 5, 5, 8, 8, 8, 8, 11, 11, 12, 12, 15, 17, 22, 23)]
+## coef and model-based se of placebo vs 6-MP, as stcox and coxph report them
+GEHAN = {"breslow": (1.5092, 0.4096), "efron": (1.5721, 0.4124)}
+
+
+def gehan():
+  rows = GEHAN_6MP + GEHAN_PLACEBO
+  time = np.array([t for t, _ in rows], dtype=float)
+  event = np.array([e for _, e in rows], dtype=bool)
+  placebo = np.r_[np.zeros(len(GEHAN_6MP)), np.ones(len(GEHAN_PLACEBO))]
+  return time, event, placebo[:, None]
+
+
+def reference(time, event, X, weights, beta, efron):
+  # (loglik, score, information, weighted score residuals) one event time at a time
+  n, p = X.shape
+  risk = np.exp(X @ beta)
+  loglik, score, information = 0.0, np.zeros(p), np.zeros((p, p))
+  residuals = np.zeros((n, p))
+  for t in np.unique(time[event & (weights > 0)]):
+    at_risk = (time >= t) & (weights > 0)
+    tied = at_risk & event & (time == t)
+    m = tied.sum()
+    mean_weight = weights[tied].sum() / m
+    loglik += weights[tied] @ (X[tied] @ beta)
+    score += weights[tied] @ X[tied]
+    means = []
+    for l in range(m):
+      fraction = l / m if efron else 0.0
+      share = np.where(tied, 1 - fraction, 1.0) * at_risk * weights * risk
+      S0, S1, S2 = share.sum(), share @ X, (share[:, None] * X).T @ X
+      mean = S1 / S0
+      means.append(mean)
+      loglik -= mean_weight * np.log(S0)
+      score -= mean_weight * mean
+      information += mean_weight * (S2 / S0 - np.outer(mean, mean))
+      residuals -= (mean_weight * np.where(tied, 1 - fraction, 1.0) * at_risk * risk / S0)[:, None] * (X - mean)
+    residuals[tied] += X[tied] - np.mean(means, axis=0)
+  return loglik, score, information, residuals * weights[:, None]
+
+
+def reference_fit(time, event, X, weights, efron):
+  # (beta, model variance, robust variance) by plain Newton-Raphson
+  beta = np.zeros(X.shape[1])
+  for _ in range(50):
+    _, score, information, _ = reference(time, event, X, weights, beta, efron)
+    step = np.linalg.solve(information, score)
+    beta += step
+    if np.max(np.abs(step)) < 1e-12:
+      break
+  _, _, information, residuals = reference(time, event, X, weights, beta, efron)
+  model_var = np.linalg.inv(information)
+  clusters = (weights > 0).sum()
+  robust = model_var @ residuals.T @ residuals @ model_var * clusters / (clusters - 1)
+  return beta, model_var, robust
+
+
+def tied_sample(n=400, seed=1):
+  # heavily tied times (whole days), two covariates, weights with some zeros
+  rng = np.random.default_rng(seed)
+  X = np.column_stack([rng.normal(size=n), rng.random(n) < 0.3]).astype(float)
+  time = np.ceil(rng.exponential(10 / np.exp(X @ [0.4, -0.6])))
+  censored = rng.integers(1, 30, n)
+  event = time <= censored
+  time = np.minimum(time, censored).astype(float)
+  weights = np.where(rng.random(n) < 0.1, 0.0, rng.uniform(0.5, 3, n))
+  return time, event, X, weights
+
+
+@pytest.mark.parametrize("ties", cox_engine.TIES)
+def test_gehan(ties):
+  time, event, X = gehan()
+  result = cox_engine.fit(cox_engine.RiskSets(time, event), X, ties=ties)
+  coef, se = GEHAN[ties]
+  assert result.coef[0] == pytest.approx(coef, abs=5e-4)
+  assert np.sqrt(result.model_var[0, 0]) == pytest.approx(se, abs=5e-4)
+  assert (result.n, result.events) == (42, 30)
+
+
+@pytest.mark.parametrize("ties", cox_engine.TIES)
+def test_gehan_robust(ties):
+  time, event, X = gehan()
+  result = cox_engine.fit(cox_engine.RiskSets(time, event), X, ties=ties)
+  beta, model_var, robust = reference_fit(time, event, X, np.ones(len(time)), ties == "efron")
+  np.testing.assert_allclose(result.coef, beta, rtol=1e-8)
+  np.testing.assert_allclose(result.model_var, model_var, rtol=1e-8)
+  np.testing.assert_allclose(result.var, robust, rtol=1e-8)
+  np.testing.assert_allclose(result.se, np.sqrt(np.diag(robust)), rtol=1e-8)
+
+
+@pytest.mark.parametrize("ties", cox_engine.TIES)
+def test_weighted_ties(ties):
+  time, event, X, weights = tied_sample()
+  result = cox_engine.fit(cox_engine.RiskSets(time, event), X, weights=weights, ties=ties)
+  beta, model_var, robust = reference_fit(time, event, X, weights, ties == "efron")
+  np.testing.assert_allclose(result.coef, beta, rtol=1e-7)
+  np.testing.assert_allclose(result.model_var, model_var, rtol=1e-7)
+  np.testing.assert_allclose(result.var, robust, rtol=1e-7)
+  loglik = reference(time, event, X, weights, beta, ties == "efron")[0]
+  assert result.loglik == pytest.approx(loglik, rel=1e-9)
+
+
+def test_start_and_chunks(monkeypatch):
+  # a warm start and small row blocks change nothing but the iterations
+  time, event, X, weights = tied_sample()
+  risk_sets = cox_engine.RiskSets(time, event)
+  result = cox_engine.fit(risk_sets, X, weights=weights, ties="efron")
+  monkeypatch.setattr(cox_engine, "CHUNK", 7)
+  monkeypatch.setattr(cox_engine, "MAX_PRODUCT_GROUPS", 0)
+  started = cox_engine.fit(risk_sets, X, weights=weights, ties="efron", start=result.coef)
+  np.testing.assert_allclose(started.coef, result.coef, rtol=1e-7)
+  np.testing.assert_allclose(started.var, result.var, rtol=1e-7)
+
+
+def test_collinear_columns_omitted():
+  time, event, X, weights = tied_sample()
+  risk_sets = cox_engine.RiskSets(time, event)
+  result = cox_engine.fit(risk_sets, X, weights=weights)
+  padded = np.column_stack([X[:, 0], np.ones(len(X)), X[:, 1], 2 * X[:, 0] - X[:, 1]])
+  omitted = cox_engine.fit(risk_sets, padded, weights=weights)
+  np.testing.assert_array_equal(omitted.omitted, [False, True, False, True])
+  np.testing.assert_allclose(omitted.coef, [result.coef[0], 0, result.coef[1], 0], atol=1e-12)
+  assert np.isnan(omitted.se[[1, 3]]).all()
+  np.testing.assert_allclose(omitted.se[[0, 2]], result.se, rtol=1e-10)
+  hr, lower, upper = cox_engine.hazard_ratios(omitted, [0, 1])
+  assert hr[0] == pytest.approx(np.exp(result.coef[0]))
+  assert np.isnan([hr[1], lower[1], upper[1]]).all()
+
+
+def test_independent():
+  rng = np.random.default_rng(0)
+  x = rng.normal(size=(50, 2))
+  X = np.column_stack([np.zeros(50), x[:, 0], x[:, 1], x.sum(axis=1), rng.normal(size=50)])
+  keep = cox_engine.independent(cox_engine.gram(X, np.ones(50)))
+  np.testing.assert_array_equal(keep, [False, True, True, False, True])
+
+
+def test_ties_checked():
+  time, event, X = gehan()
+  with pytest.raises(ValueError):
+    cox_engine.fit(cox_engine.RiskSets(time, event), X, ties="exact")
+
+
+@pytest.mark.parametrize("ties", cox_engine.TIES)
+def test_no_failures(ties):
+  # nothing to estimate: missing coefficients rather than a singular information matrix
+  time, _, X, weights = tied_sample()
+  risk_sets = cox_engine.RiskSets(time, np.zeros(len(time), dtype=bool))
+  result = cox_engine.fit(risk_sets, X, weights=weights, ties=ties)
+  assert np.isnan(result.coef).all() and np.isnan(result.var).all()
+  assert (result.n, result.events) == ((weights > 0).sum(), 0)
+  assert np.isnan(cox_engine.hazard_ratios(result, [0, 1])).all()
+  empty = cox_engine.fit(cox_engine.RiskSets(*tied_sample()[:2]), X, weights=np.zeros(len(time)))
+  assert np.isnan(empty.coef).all() and empty.n == 0
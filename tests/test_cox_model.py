@@ -0,0 +1,50 @@
+
+# --- COX MODEL SUMMARY TESTS ---
+# Factor-variable design matrices, and terms stcox would omit as collinear.
+
+import numpy as np
+
+import cox_model
+
+
+def test_design():
+  columns = {"age": np.array([50, 60, np.nan, 70.0]), "bmi_group": np.array([0, 1, 2, 2.0]), "drug": np.array([0, 3, 1, 0.0])}
+  X, names, included = cox_model.design(columns, "i.drug age 1b.bmi_group")
+  # levels from the included rows: drug 1 only appears on the row with missing age
+  assert names == ["3.drug", "age", "0.bmi_group", "2.bmi_group"]
+  np.testing.assert_array_equal(included, [True, True, False, True])
+  np.testing.assert_array_equal(X, [[0, 50, 1, 0], [1, 60, 0, 0], [0, 0, 0, 0], [0, 70, 0, 1]])
+
+
+def test_constant_covariate_omitted(cohort, capsys):
+  frame = cohort.copy()
+  kept, risk_sets = cox_model.outcome_risk_sets(frame, "died")
+  expected = cox_model.fit_model(frame, kept, risk_sets, "i.drug age")
+  frame["White"] = 1.0
+  frame["age2"] = 2 * frame["age"]
+  row = cox_model.fit_model(frame, kept, risk_sets, "i.drug age White age2")
+  assert row == expected
+  notes = capsys.readouterr().out
+  assert "White omitted because of collinearity" in notes
+  assert "age2 omitted because of collinearity" in notes
+
+
+def test_drug_omitted(cohort, capsys):
+  frame = cohort.copy()
+  frame["sotrovimab"] = (frame["drug"] == 1).astype(float)
+  kept, risk_sets = cox_model.outcome_risk_sets(frame, "died")
+  row = cox_model.fit_model(frame, kept, risk_sets, "sotrovimab i.drug age")
+  assert np.isnan([row["hr_sot"], row["lc_sot"], row["uc_sot"]]).all()
+  assert np.isfinite([row["hr_pax"], row["lc_mol"]]).all()
+  assert "1.drug omitted because of collinearity" in capsys.readouterr().out
+
+
+def test_outcome_without_failures(cohort, capsys):
+  frame = cohort.copy()
+  frame["fail_died"] = 0.0
+  frame["stop_ae_all"] = frame["start_date"]
+  summary = cox_model.summarise(frame, ["died", "ae_all", "covid_hosp"])
+  missing = summary.filter(regex="^(hr|lc|uc)_").isna().all(axis=1)
+  np.testing.assert_array_equal(missing, summary["failure"] != "covid_hosp")
+  assert summary["ptime_all"].notna().all()
+  assert "no failures among the 0 rows" in capsys.readouterr().out
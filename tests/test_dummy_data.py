@@ -0,0 +1,62 @@
+
+# --- DUMMY DATA TESTS ---
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dummy_data
+import study_expressions
+
+
+@pytest.fixture(scope="module")
+def generator():
+  return dummy_data.Generator(seed=1, workers=1)
+
+
+@pytest.fixture(scope="module")
+def chunk(generator):
+  return generator.chunk(0, 0, 3000)
+
+
+def test_derived_columns_agree(generator, chunk):
+  variables = generator.variables
+  population = study_expressions.evaluate(variables["population"].kwargs["expression"], chunk, 3000)
+  np.testing.assert_array_equal(chunk["population"], population)
+  assert 0 < study_expressions.truthy(chunk["population"]).sum() < 3000
+  drugs = np.stack([chunk[name] for name in variables["date_treated"].kwargs["column_names"]])
+  np.testing.assert_array_equal(chunk["date_treated"], np.fmin.reduce(drugs, axis=0))
+
+
+def test_dates_in_window(chunk):
+  treated = ~np.isnat(chunk["sotrovimab"])
+  assert treated.any()
+  days = (chunk["sotrovimab"] - chunk["covid_test_positive_date"])[treated].astype(int)
+  assert days.min() >= 0 and days.max() <= 5
+
+
+def test_seeded_by_chunk_not_workers(generator, chunk):
+  other = dummy_data.Generator(seed=1, workers=4).chunk(0, 0, 3000)
+  for name in chunk:
+    np.testing.assert_array_equal(chunk[name], other[name], name)
+  assert not np.array_equal(generator.chunk(1, 3000, 3000)["age"], chunk["age"])
+
+
+def test_write(tmp_path):
+  path = tmp_path / "dummy.csv"
+  dummy_data.write(str(path), 250, seed=2, chunk_size=100, workers=1)
+  frame = pd.read_csv(path)
+  generator = dummy_data.Generator(workers=1)
+  assert list(frame.columns) == [column.name for column in generator.schema]
+  assert list(frame["patient_id"]) == list(range(1, 251))
+  assert set(frame["covid_test_positive"]) <= {0, 1}
+
+
+def test_check_populated():
+  expected = np.array([True, False, True])
+  dummy_data._check_populated("x", np.array(["2022-01-01", "NaT", "NaT"], dtype="datetime64[D]"), expected)
+  with pytest.raises(ValueError, match="x: no value drawn for any of the 2 patients"):
+    dummy_data._check_populated("x", np.array([np.nan, 1.0, np.nan]), expected)
+  with pytest.raises(ValueError):
+    dummy_data._check_populated("x", np.array([None, "a", None], dtype=object), expected)
+  dummy_data._check_populated("x", np.full(3, np.nan), np.zeros(3, dtype=bool))
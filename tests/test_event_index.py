@@ -0,0 +1,62 @@
+
+# --- PER-PATIENT EVENT INDEX TESTS ---
+# EventIndex lookups against a per-patient loop, and a local extraction through the
+# indexes against one querying each variable.
+
+import numpy as np
+import pytest
+
+from conftest import extract
+from event_index import EventIndex
+
+
+@pytest.fixture
+def events():
+  rng = np.random.default_rng(8)
+  n = 3000
+  patients = rng.integers(1, 121, n)
+  days = np.datetime64("2021-01-01") + rng.integers(0, 500, n)
+  days[rng.random(n) < 0.02] = np.datetime64("NaT")
+  return patients, days.astype("datetime64[D]"), rng.normal(size=n)
+
+
+def windows(n, rng):
+  lower = np.datetime64("2021-03-01") + rng.integers(0, 300, n)
+  upper = lower + rng.integers(-5, 90, n)
+  lower[rng.random(n) < 0.1] = np.datetime64("NaT")
+  return lower.astype("datetime64[D]"), upper.astype("datetime64[D]")
+
+
+def test_lookup_matches_loop(events):
+  event_patients, event_days, values = events
+  # patient 200 has no events; patients above 120 but not listed are dropped
+  patient_ids = np.array(sorted(set(range(1, 101)) | {200}))
+  index = EventIndex(patient_ids, event_patients, event_days, {"value": values})
+  assert len(index) == ((event_patients <= 100) & ~np.isnat(event_days)).sum()
+  lower, upper = windows(len(patient_ids), np.random.default_rng(9))
+  for bounds in ((lower, upper), (None, upper), (lower, None), (None, None)):
+    first, last, count = index.lookup(*bounds)
+    first_days, last_values = index.take(first), index.take(last, "value")
+    for i, patient in enumerate(patient_ids):
+      inside = (event_patients == patient) & ~np.isnat(event_days)
+      if bounds[0] is not None:
+        inside &= event_days >= bounds[0][i]
+      if bounds[1] is not None:
+        inside &= event_days <= bounds[1][i]
+      # a missing bound is a closed window, as it is in SQL
+      if any(bound is not None and np.isnat(bound[i]) for bound in bounds):
+        inside[:] = False
+      assert count[i] == inside.sum()
+      if inside.any():
+        assert first_days[i] == event_days[inside].min()
+        latest = event_days[inside].max()
+        assert last_values[i] == values[inside & (event_days == latest)][-1]
+      else:
+        assert first[i] == last[i] == -1 and np.isnat(first_days[i]) and np.isnan(last_values[i])
+
+
+def test_extraction_matches_unindexed(local_db):
+  indexed, unindexed = extract(local_db), extract(local_db, indexed=False)
+  assert set(indexed) == set(unindexed)
+  for name, values in unindexed.items():
+    np.testing.assert_array_equal(indexed[name], values, name)
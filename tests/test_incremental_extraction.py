@@ -0,0 +1,80 @@
+
+# --- INCREMENTAL EXTRACTION TESTS ---
+# A checkpoint taken before some patients and the latest records arrived, refreshed
+# against the complete database, gives what a full extraction of it gives.
+
+import shutil
+import sqlite3
+
+import numpy as np
+import pytest
+
+import incremental_extraction
+import local_backend
+from conftest import extract
+
+AS_OF = "2022-03-15"
+## records on or after the settled date (AS_OF less the default lag) arrive late
+SETTLED = "2022-03-01"
+LATE = {
+  "clinical_event": "date", "medication": "date", "apcs": "admission_date", "sgss_test": "specimen_date",
+  "therapeutic": "date", "high_cost_drug": "date", "vaccination": "date", "ons_death": "date",
+}
+NEW_PATIENTS = 1800
+
+
+@pytest.fixture(scope="module")
+def earlier_db(local_db, tmp_path_factory):
+  # the database as it stood at AS_OF
+  path = str(tmp_path_factory.mktemp("incremental") / "earlier.sqlite")
+  shutil.copy(local_db, path)
+  conn = sqlite3.connect(path)
+  for table, column in LATE.items():
+    conn.execute(f"DELETE FROM {table} WHERE {column} >= ?", (SETTLED,))
+  tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+  for table in tables:
+    if "patient_id" in [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]:
+      conn.execute(f"DELETE FROM {table} WHERE patient_id > ?", (NEW_PATIENTS,))
+  conn.commit()
+  conn.close()
+  return path
+
+
+def test_refresh_matches_full(local_db, earlier_db, tmp_path):
+  checkpoint = str(tmp_path / "checkpoint")
+  first = incremental_extraction.extract(local_backend.connect(earlier_db), checkpoint, AS_OF)
+  assert first.n == NEW_PATIENTS
+  refreshed = incremental_extraction.extract(local_backend.connect(local_db), checkpoint, "2022-04-01")
+  assert isinstance(refreshed, incremental_extraction.IncrementalExtraction)
+  assert refreshed.new.sum() == 2000 - NEW_PATIENTS
+  # some variables are reused as they were, the rest refreshed for some patients only
+  assert any(count == 2000 - NEW_PATIENTS for count in refreshed.refreshed.values())
+  full = extract(local_db)
+  assert set(refreshed.columns) == set(full)
+  for name, values in full.items():
+    assert not incremental_extraction.differs(refreshed.columns[name], values).any(), name
+
+
+def test_checkpoint_round_trip(tmp_path):
+  columns = {
+    "patient_id": np.array([1, 2, 3]),
+    "flag": np.array([True, False, True]),
+    "date": np.array(["2022-01-01", "NaT", "2022-02-01"], dtype="datetime64[D]"),
+    "value": np.array([1.5, np.nan, 2.0]),
+    "label": np.array(["a", None, "b"], dtype=object),
+  }
+  comparators = {"value": np.array(["<", None, None], dtype=object)}
+  incremental_extraction.save_checkpoint(str(tmp_path), columns, comparators, AS_OF)
+  loaded, loaded_comparators, as_of = incremental_extraction.load_checkpoint(str(tmp_path))
+  assert as_of == AS_OF
+  for name, values in columns.items():
+    assert loaded[name].dtype == values.dtype
+    assert not incremental_extraction.differs(loaded[name], values).any()
+  assert list(loaded_comparators["value"]) == ["<", None, None]
+  assert incremental_extraction.load_checkpoint(str(tmp_path / "missing")) is None
+
+
+def test_align():
+  values, found = incremental_extraction.align(np.array([10.0, 20.0, 30.0]), np.array([1, 3, 5]), np.array([1, 2, 5, 6]))
+  np.testing.assert_array_equal(values, [10.0, np.nan, 30.0, np.nan])
+  np.testing.assert_array_equal(found, [True, False, True, False])
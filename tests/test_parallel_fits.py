@@ -0,0 +1,29 @@
+
+# --- PARALLEL FITTING TESTS ---
+# The process-pool Cox grid (parallel_fits) gives the same table as the serial one.
+
+import numpy as np
+import pandas as pd
+
+import cox_model
+import parallel_fits
+
+OUTCOMES = ["died", "ae_all"]
+
+
+def test_cox_grid(cohort):
+  serial = cox_model.summarise(cohort, OUTCOMES)
+  parallel = parallel_fits.summarise(cohort, OUTCOMES, workers=2)
+  pd.testing.assert_frame_equal(parallel, serial)
+  assert len(serial) == len(OUTCOMES) * len(cox_model.MODELS)
+  assert serial.filter(like="hr_").notna().all().all()
+
+
+def test_shared_columns():
+  columns = {"a": np.arange(5.0), "b": np.ones(5)}
+  with parallel_fits.SharedColumns(columns) as shared:
+    memory, attached = parallel_fits.attach(shared.spec)
+    np.testing.assert_array_equal(attached["a"], columns["a"])
+    assert not attached["b"].flags.writeable
+    del attached
+    memory.close()
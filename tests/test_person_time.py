@@ -0,0 +1,57 @@
+
+# --- PERSON-TIME AND SUPPRESSION TESTS ---
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import person_time
+
+
+def columns(events_per_group):
+  # one outcome, drug groups 0-3 with the given numbers of events, 10 days each row
+  drug, failed = [], []
+  for code, events in enumerate(events_per_group):
+    drug += [code] * 10
+    failed += [1] * events + [0] * (10 - events)
+  n = len(drug)
+  return {
+    "start_date": np.zeros(n), "drug": np.array(drug, dtype=float),
+    "stop_x": np.full(n, 10.0), "fail_x": np.array(failed, dtype=float),
+  }
+
+
+def test_rate_table():
+  table = person_time.rate_table(columns([0, 1, 5, 6]), ["x"]).loc["x"]
+  assert table["ptime_all"] == 400
+  assert table["events_all"] == 12
+  assert table["rate_all"] == pytest.approx(12 / 400)
+  assert [table[f"events_{group}"] for group in ("control", "sot", "pax", "mol")] == [0, 1, 5, 6]
+  assert table["ptime_mol"] == 100
+
+
+@pytest.mark.parametrize("events, suppressed", [(0, False), (1, True), (5, True), (6, False)])
+def test_suppress_boundaries(events, suppressed):
+  row = person_time.outcome_rates(columns([events, 0, 0, 10]), ["x"])["x"]
+  assert np.isnan(row["events_control"]) == suppressed
+  assert np.isnan(row["rate_control"]) == suppressed
+  assert row["ptime_control"] == 100
+  if not suppressed:
+    assert row["events_control"] == events
+    assert row["rate_control"] == pytest.approx(events / 100)
+
+
+def test_rows_stset_drops():
+  # stop on or before start: no person-time and no event
+  data = columns([2, 0, 0, 0])
+  data["stop_x"][0] = 0.0
+  data["stop_x"][1] = np.nan
+  table = person_time.rate_table(data, ["x"]).loc["x"]
+  assert table["ptime_control"] == 80
+  assert table["events_control"] == 0
+
+
+def test_suppress_copies():
+  table = pd.DataFrame({f"{kind}_{group}": [3.0] for kind in ("ptime", "events", "rate") for group in person_time.GROUPS})
+  person_time.suppress(table)
+  assert table["events_all"].iloc[0] == 3
@@ -0,0 +1,35 @@
+
+# --- PROPENSITY BOOTSTRAP TESTS ---
+# Replicates depend on the seed and batch only, not on the number of workers, and
+# the summary takes percentile intervals over the replicates that converged.
+
+import numpy as np
+
+import cox_model
+import propensity_bootstrap
+import propensity_model
+
+
+def test_bootstrap(cohort):
+  point, serial = propensity_bootstrap.bootstrap(cohort, replicates=6, workers=1)
+  _, parallel = propensity_bootstrap.bootstrap(cohort, replicates=6, workers=2)
+  np.testing.assert_array_equal(parallel, serial)
+  assert serial.shape == (6, len(propensity_model.PS_MODELS), len(cox_model.DRUGS))
+  assert np.isfinite(serial).all()
+  assert not np.allclose(serial[0], point)
+
+
+def test_summarise():
+  models = ["a", "b"]
+  point = np.zeros((2, len(cox_model.DRUGS)))
+  replicates = np.log(np.arange(1, 202, dtype=float))[:, None, None] * np.ones((201, 2, len(cox_model.DRUGS)))
+  # model b failed to converge in one replicate, and has no estimate at all for the last drug
+  replicates[0, 1, 0] = np.nan
+  replicates[:, 1, -1] = np.nan
+  summary = propensity_bootstrap.summarise(point, replicates, models)
+  first, last = next(iter(cox_model.DRUGS.values())), list(cox_model.DRUGS.values())[-1]
+  assert list(summary["model"]) == models
+  assert list(summary["replicates"]) == [201, 0]
+  np.testing.assert_allclose(summary[f"hr_{first}"], 1.0)
+  np.testing.assert_allclose(summary.loc[0, [f"lc_{first}", f"uc_{first}"]].astype(float), [6.0, 196.0])
+  assert np.isnan(summary.loc[1, [f"lc_{last}", f"uc_{last}"]].astype(float)).all()
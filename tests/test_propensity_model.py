@@ -0,0 +1,87 @@
+
+# --- PROPENSITY MODEL TESTS ---
+# fit_logistic's joint IRLS against a plain Newton-Raphson fit of each model on its
+# own, the inverse probability weights against their definition, and the IPTW
+# models fitted across processes against the serial fits.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import propensity_model
+
+
+def newton(X, y, weights):
+  # logistic regression coefficients by Newton-Raphson on the weighted log likelihood
+  beta = np.zeros(X.shape[1])
+  for _ in range(100):
+    p = 1 / (1 + np.exp(-(X @ beta)))
+    step = np.linalg.solve((X * (weights * p * (1 - p))[:, None]).T @ X, X.T @ (weights * (y - p)))
+    beta += step
+    if np.max(np.abs(step)) < 1e-12:
+      break
+  return beta
+
+
+@pytest.fixture
+def sample():
+  rng = np.random.default_rng(2)
+  n = 2000
+  X = np.column_stack([np.ones(n), rng.normal(size=n), rng.random(n) < 0.4, rng.integers(0, 5, n)]).astype(float)
+  y = (rng.random(n) < 1 / (1 + np.exp(-(X @ [-0.3, 0.8, -0.5, 0.2])))).astype(float)
+  selections = [np.array([0, 1]), np.array([0, 1, 2]), np.array([0, 1, 2, 3])]
+  rows = np.column_stack([np.ones(n, dtype=bool), rng.random(n) < 0.9, rng.random(n) < 0.8])
+  return X, y, selections, rows
+
+
+def test_irls_matches_newton(sample):
+  X, y, selections, rows = sample
+  B = propensity_model.fit_logistic(X, y, selections, rows)
+  for k, selection in enumerate(selections):
+    expected = newton(X[:, selection], y, rows[:, k].astype(float))
+    np.testing.assert_allclose(B[selection, k], expected, rtol=1e-8, atol=1e-10)
+    assert not B[np.setdiff1d(np.arange(X.shape[1]), selection), k].any()
+
+
+def test_frequency_weights(sample):
+  # a frequency weight of 2 is the row twice
+  X, y, selections, rows = sample
+  frequency = np.random.default_rng(3).integers(0, 3, len(y)).astype(float)
+  B = propensity_model.fit_logistic(X, y, selections, rows, frequency)
+  repeated = np.repeat(np.arange(len(y)), frequency.astype("int64"))
+  expected = propensity_model.fit_logistic(X[repeated], y[repeated], selections, rows[repeated])
+  np.testing.assert_allclose(B, expected, rtol=1e-8, atol=1e-10)
+
+
+def test_collinear_column_omitted(sample):
+  X, y, selections, rows = sample
+  X = np.column_stack([X, 3 * X[:, 1]])
+  B = propensity_model.fit_logistic(X, y, [np.array([0, 1, 4])], rows[:, :1])
+  assert B[4, 0] == 0
+  np.testing.assert_allclose(B[[0, 1], 0], newton(X[:, [0, 1]], y, np.ones(len(y))), rtol=1e-8)
+
+
+def test_shared_design_omits_constant_term(cohort):
+  frame = cohort.copy()
+  frame["White"] = 1.0
+  models = {"a": "age White", "b": "age i.sex"}
+  X, selections, rows = propensity_model.shared_design(frame, models)
+  # constant, age, White, 1.sex: White is constant on model a's rows
+  assert list(selections[0]) == [0, 1]
+  assert list(selections[1]) == [0, 1, 3]
+  assert rows.shape == (len(frame), 2)
+
+
+def test_iptw():
+  p = np.array([0.2, 0.5, 0.8, np.nan])
+  treated = np.array([0, 1, 1, 0])
+  np.testing.assert_allclose(propensity_model.iptw(p, treated), [5, 2, 5, np.nan])
+  # stabilised: times the marginal probability of the row's own group
+  np.testing.assert_allclose(propensity_model.iptw(p, treated, stabilised=True), [5 / 3, 4 / 3, 10 / 3, np.nan])
+
+
+def test_iptw_models(cohort):
+  _, weights = propensity_model.propensity_weights(cohort)
+  serial = propensity_model.summarise(cohort, weights)
+  parallel = propensity_model.summarise(cohort, weights, workers=2)
+  pd.testing.assert_frame_equal(parallel, serial)
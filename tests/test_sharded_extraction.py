@@ -0,0 +1,57 @@
+
+# --- SHARDED EXTRACTION TESTS ---
+
+import os
+import shutil
+
+import numpy as np
+import pyarrow.parquet as pq
+
+import local_backend
+import sharded_extraction
+from conftest import extract
+
+
+def test_merged_shards_match_full(local_db, tmp_path):
+  shard_dir, output = str(tmp_path / "shards"), str(tmp_path / "sharded.parquet")
+  os.makedirs(shard_dir)
+  stale = os.path.join(shard_dir, "shard_0_of_3_0123456789abcdef.parquet")
+  open(stale, "w").close()
+  sharded_extraction.main(["--db", local_db, "--shards", "3", "--workers", "2",
+                           "--shard-dir", shard_dir, "--output", output])
+  assert not os.path.exists(stale)
+  full = str(tmp_path / "full.parquet")
+  columns = extract(local_db)
+  local_backend.write(columns, local_backend.Extraction(local_backend.connect(local_db)).variables, full)
+  assert pq.read_table(output).equals(pq.read_table(full))
+
+
+def test_finished_shards_reused(local_db, tmp_path):
+  shard_dir = str(tmp_path / "shards")
+  source = sharded_extraction.source_digest(local_db)
+  assert sharded_extraction.run_shards(local_db, 2, shard_dir, workers=1, source=source) == []
+  paths = [sharded_extraction.shard_path(shard_dir, shard, 2, source) for shard in range(2)]
+  written = [os.stat(path).st_mtime_ns for path in paths]
+  assert sharded_extraction.run_shards(local_db, 2, shard_dir, workers=1, source=source) == []
+  assert [os.stat(path).st_mtime_ns for path in paths] == written
+  ids = np.concatenate([pq.read_table(path).column("patient_id").to_numpy() for path in paths])
+  assert len(ids) == len(set(ids))
+
+
+def test_source_digest(local_db, tmp_path):
+  copy = str(tmp_path / "copy.sqlite")
+  shutil.copy(local_db, copy)
+  digest = sharded_extraction.source_digest(copy)
+  assert sharded_extraction.source_digest(copy) == digest
+  assert sharded_extraction.source_digest(local_db) != digest
+  stat = os.stat(copy)
+  os.utime(copy, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+  assert sharded_extraction.source_digest(copy) != digest
+
+
+def test_shard_of():
+  ids = np.arange(1, 10001)
+  shards = sharded_extraction.shard_of(ids, 4)
+  assert set(shards) == {0, 1, 2, 3}
+  assert np.bincount(shards.astype(int)).min() > 2000
+  np.testing.assert_array_equal(sharded_extraction.shard_of(ids[::-1], 4), shards[::-1])
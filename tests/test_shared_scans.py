@@ -0,0 +1,126 @@
+
+# --- SHARED SCAN TESTS ---
+# evaluate() against each flag computed on its own, one filter per variable, and a
+# local extraction with the scans against one without.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import local_backend
+import shared_scans
+import study_spec
+from conftest import extract
+from shared_scans import Flag, Scan
+
+CODELISTS = {"a": {"A1", "A2"}, "b": {"B1"}, "c": {"A2", "C1"}}
+
+
+def direct(events, codes, anchor, offset):
+  # the variable as its own query: any matching event in [anchor - offset, anchor]
+  frame = events[events["code"].isin(codes)] if codes is not None else events
+  anchor_dates = frame["patient_id"].map(anchor)
+  inside = frame["date"] <= anchor_dates
+  if offset is not None:
+    inside &= frame["date"] >= anchor_dates - shared_scans._offset(offset)
+  found = set(frame.loc[inside.values, "patient_id"])
+  return np.array([patient in found for patient in anchor.index])
+
+
+@pytest.fixture
+def events():
+  rng = np.random.default_rng(3)
+  n = 2000
+  return pd.DataFrame({
+    "patient_id": rng.integers(1, 301, n),
+    "code": rng.choice(["A1", "A2", "B1", "C1", "X9"], n),
+    "date": pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 730, n), unit="D"),
+  })
+
+
+@pytest.fixture
+def anchors():
+  rng = np.random.default_rng(4)
+  dates = pd.Timestamp("2022-01-01") + pd.to_timedelta(rng.integers(-200, 60, 320), unit="D")
+  # some patients have no anchor date, and so no flags
+  dates = dates.where(rng.random(320) > 0.1)
+  return pd.DataFrame({"index_date": dates}, index=pd.Index(np.arange(1, 321), name="patient_id"))
+
+
+def test_evaluate_matches_direct(events, anchors):
+  flags = [
+    Flag("ever_a", ("a",), None),
+    Flag("a_6m", ("a",), (6, "month")),
+    Flag("a_or_b_30d", ("a", "b"), (30, "day")),
+    Flag("c_1y", ("c",), (1, "year")),
+    Flag("any_3m", (), (3, "month")),
+  ]
+  scan = Scan(("with_these_clinical_events", "codelist"), "index_date", flags)
+  result = shared_scans.evaluate([scan], {scan.source: events}, CODELISTS, anchors)
+  assert list(result.columns) == [flag.name for flag in flags]
+  anchor = anchors["index_date"]
+  for flag in flags:
+    codes = set().union(*(CODELISTS[name] for name in flag.codelists)) if flag.codelists else None
+    np.testing.assert_array_equal(result[flag.name], direct(events, codes, anchor, flag.offset), flag.name)
+  assert result["ever_a"].any() and not result["ever_a"].all()
+
+
+def test_plan():
+  scans = {scan.source: scan for scan in shared_scans.plan()}
+  clinical = scans["with_these_clinical_events", "codelist"]
+  assert clinical.anchor == "covid_test_positive_date"
+  flags = {flag.name: flag for flag in clinical.flags}
+  assert flags["downs_syndrome_snomed"] == Flag("downs_syndrome_snomed", ("downs_syndrome_nhsd_snomed_codes",), None)
+  assert flags["solid_cancer"].offset == (6, "month")
+  assert ("admitted_to_hospital", "with_these_diagnoses") in scans
+
+
+def scannable(returning="binary_flag", **kwargs):
+  variable = study_spec.Variable(
+    "x", "with_these_clinical_events", dict(returning=returning, codelist="a", **kwargs), False, None,
+  )
+  return shared_scans.scannable(variable, {"index_date"})
+
+
+def test_scannable_windows():
+  assert scannable(on_or_before="index_date")[2].offset is None
+  assert scannable(between=["index_date - 6 months", "index_date"])[2].offset == (6, "month")
+  # windows that do not end at the anchor, and other return types, are left alone
+  assert scannable(on_or_after="index_date") is None
+  assert scannable(between=["index_date - 6 months", "index_date - 1 day"]) is None
+  assert scannable(on_or_before="other_date") is None
+  assert scannable("date", on_or_before="index_date") is None
+
+
+def test_extraction_matches_unscanned(local_db):
+  scanned = local_backend.Extraction(local_backend.connect(local_db)).scanned
+  with_scans, without = extract(local_db), extract(local_db, scans=False)
+  assert len(scanned) > 50
+  for name in scanned:
+    np.testing.assert_array_equal(with_scans[name], without[name], name)
+
+
+def test_high_cost_drugs_single_scan(local_db):
+  # every *_highcostdrugs flag is "any drug in the window", from one scan
+  scans = [scan for scan in shared_scans.plan() if scan.source[0] == "with_high_cost_drugs"]
+  assert len(scans) == 1
+  assert len(scans[0].flags) == 21
+  assert all(flag.codelists == () for flag in scans[0].flags)
+  assert shared_scans.scan_codelists(scans[0], {}) == {(): None}
+  # and imid_drug_HCD, their maximum_of, comes with them
+  scanned = local_backend.Extraction(local_backend.connect(local_db)).scanned
+  assert scanned["imid_drug_HCD"] is scanned["rituximab_highcostdrugs"]
+
+
+def test_combine():
+  variables = {
+    "any_ab": study_spec.Variable("any_ab", "maximum_of", {"column_names": ["a", "b"]}, False, None),
+    "all_ab": study_spec.Variable("all_ab", "minimum_of", {"column_names": ["a", "b"]}, False, None),
+    "any_ac": study_spec.Variable("any_ac", "maximum_of", {"column_names": ["a", "c"]}, False, None),
+  }
+  flags = pd.DataFrame({"a": [True, True, False, False], "b": [True, False, True, False]})
+  combined = shared_scans.combine(flags, variables)
+  assert list(combined["any_ab"]) == [True, True, True, False]
+  assert list(combined["all_ab"]) == [True, False, False, False]
+  # c is not a scanned flag, so any_ac is left to the extraction
+  assert "any_ac" not in combined
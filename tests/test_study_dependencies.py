@@ -0,0 +1,89 @@
+
+# --- STUDY DEPENDENCY TESTS ---
+
+import pytest
+
+import study_dependencies
+import study_spec
+
+
+@pytest.fixture(scope="module")
+def variables():
+  return study_spec.load_study()
+
+
+def test_dependencies(variables):
+  graph = study_dependencies.dependencies(variables)
+  assert graph["downs_syndrome"] == {"downs_syndrome_icd", "downs_syndrome_snomed"}
+  assert {"age", "has_died", "covid_test_positive"} <= graph["population"]
+  assert graph["covid_positive_previous_30_days"] == {"covid_test_positive_date"}
+  # "creatinine_ctv3_date" names the date of creatinine_ctv3
+  assert "creatinine_ctv3" in graph["age_creatinine_ctv3"]
+
+
+def test_topological_order(variables):
+  graph = study_dependencies.dependencies(variables)
+  order = study_dependencies.topological_order(graph)
+  assert sorted(order) == sorted(variables)
+  position = {name: i for i, name in enumerate(order)}
+  for name, targets in graph.items():
+    assert all(position[target] < position[name] for target in targets)
+  with pytest.raises(ValueError, match="a -> b -> a"):
+    study_dependencies.topological_order({"a": {"b"}, "b": {"a"}})
+
+
+def test_closure():
+  graph = {"a": {"b"}, "b": {"c"}, "c": set(), "d": {"a"}}
+  assert study_dependencies.closure(["a"], graph) == {"a", "b", "c"}
+
+
+def test_stata_tokens(tmp_path):
+  script = tmp_path / "x.do"
+  script.write_text(
+    "* a comment naming unused_one\n"
+    "gen y = Age + bmi // unused_two\n"
+    "tab sex\n"
+    "by region: qui count if region_nhs == \"London\"\n"
+    "foreach var of varlist ae_spc* { \n"
+    "  replace `var' = 0 if eGFR_rec < 60 ///\n"
+    "    & solid_cancer\n"
+    "}\n"
+  )
+  every, effective = study_dependencies.stata_tokens(script)
+  assert {"age", "bmi", "sex", "region_nhs", "ae_spc*", "egfr_rec", "solid_cancer"} <= every
+  assert not {"unused_one", "unused_two", "london", "var"} & every
+  assert "sex" not in effective and "region_nhs" not in effective
+  assert {"age", "solid_cancer"} <= effective
+
+
+def test_used_columns():
+  columns = ["age", "eGFR_record", "ae_spc_all", "ae_spc_cvd", "renal_disease", "renal_transplant",
+             "a_column_name_that_is_longer_than_32"]
+  tokens = {"age", "egfr_rec", "ae_spc*", "renal", "a_column_name_that_is_longer_tha"}
+  assert study_dependencies.used_columns(tokens, columns) == {
+    "age", "eGFR_record", "ae_spc_all", "ae_spc_cvd", "a_column_name_that_is_longer_than_32",
+  }
+
+
+def test_needed_variables(variables):
+  needed = study_dependencies.needed_variables(["all"], variables)
+  assert {"population", "age", "sex", "covid_test_positive"} <= needed
+  assert needed == study_dependencies.closure(needed, study_dependencies.dependencies(variables))
+  assert len(needed) < len(variables)
+  with pytest.raises(ValueError, match="not_an_action"):
+    study_dependencies.needed_variables(["not_an_action"], variables)
+
+
+def test_pruned_study_definition(variables, monkeypatch):
+  def study_definition(**kwargs):
+    return kwargs
+
+  monkeypatch.delenv("PRUNE_FOR", raising=False)
+  assert study_dependencies.pruned_study_definition(study_definition) is study_definition
+  monkeypatch.setenv("PRUNE_FOR", "all")
+  needed = study_dependencies.needed_variables(["all"], variables)
+  unused = next(name for name in variables if name not in needed)
+  kept = study_dependencies.pruned_study_definition(study_definition)(
+    index_date="2021-12-16", age=("age",), **{unused: ("unused",)},
+  )
+  assert kept == {"index_date": "2021-12-16", "age": ("age",)}
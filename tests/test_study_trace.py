@@ -0,0 +1,62 @@
+
+# --- EXTRACTION TRACING TESTS ---
+
+import json
+import time
+
+import pytest
+
+import local_backend
+import study_trace
+
+
+def read(path):
+  with open(path) as f:
+    return [json.loads(line) for line in f]
+
+
+def test_nested_spans(tmp_path):
+  path = str(tmp_path / "trace.jsonl")
+  tracer = study_trace.Tracer(path)
+  with tracer.span("age", method="age_as_of"):
+    with tracer.span("scan", sql="SELECT 1") as event:
+      time.sleep(0.02)
+      event["rows"] = 3
+    with pytest.raises(KeyError):
+      with tracer.span("lookup"):
+        raise KeyError("x")
+  tracer.close()
+  events = read(path)
+  # written as each span closes, so children come first
+  assert [event["stack"] for event in events] == ["study;age;scan", "study;age;lookup", "study;age"]
+  scan, _, age = events
+  assert scan["rows"] == 3 and scan["sql"] == "SELECT 1" and age["method"] == "age_as_of"
+  assert scan["seconds"] >= 0.02 and age["seconds"] >= scan["seconds"]
+  assert age["start"] <= scan["start"] <= scan["end"] <= age["end"]
+  folded = dict(line.rsplit(" ", 1) for line in (tmp_path / "trace.folded").read_text().splitlines())
+  assert set(folded) == {"study;age;scan", "study;age;lookup", "study;age"}
+  # self time: the parent's own microseconds exclude its children's
+  assert int(folded["study;age"]) < int(folded["study;age;scan"])
+
+
+def test_from_environment(tmp_path, monkeypatch):
+  monkeypatch.delenv(study_trace.ENVIRONMENT, raising=False)
+  assert study_trace.from_environment() is study_trace.NULL
+  with study_trace.NULL.span("x") as event:
+    event["rows"] = 1
+  monkeypatch.setenv(study_trace.ENVIRONMENT, str(tmp_path / "env.jsonl"))
+  tracer = study_trace.from_environment()
+  assert isinstance(tracer, study_trace.Tracer) and tracer.path == str(tmp_path / "env.jsonl")
+  tracer.close()
+
+
+def test_extraction_trace(local_db, tmp_path):
+  path = str(tmp_path / "trace.jsonl")
+  tracer = study_trace.Tracer(path)
+  extraction = local_backend.Extraction(local_backend.connect(local_db), tracer=tracer)
+  extraction.run()
+  tracer.close()
+  events = read(path)
+  variables = {event["frame"] for event in events if event["stack"].count(";") == 1}
+  assert variables == set(extraction.variables)
+  assert any(event["stack"].startswith("study;all_hosp_date;") for event in events)
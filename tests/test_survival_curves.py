@@ -0,0 +1,89 @@
+
+# --- SURVIVAL CURVE TESTS ---
+# Kaplan-Meier curves and numbers at risk against a hand computation on a dozen
+# patients, and the curve cache's round trip.
+
+import os
+
+import numpy as np
+import pytest
+
+import cox_engine
+import survival_curves
+
+## (drug, days, failed) per patient
+PATIENTS = [
+  (0, 2, 1), (0, 3, 0), (0, 3, 1), (0, 5, 1), (0, 5, 1), (0, 8, 0),
+  (1, 1, 1), (1, 4, 0),
+  (2, 6, 1),
+  (3, 7, 1), (3, 9, 0),
+  (0, 0, 1),  # stop on start_date: dropped by stset
+]
+
+
+def columns():
+  drug, days, failed = (np.array(values, dtype=float) for values in zip(*PATIENTS))
+  return {"start_date": np.full(len(drug), 100.0), "drug": drug, "stop_x": 100 + days, "fail_x": failed}
+
+
+def test_kaplan_meier():
+  curves = survival_curves.outcome_curves(columns(), "x", tmax=28)
+  np.testing.assert_array_equal(curves["times"], [1, 2, 3, 4, 5, 6, 7, 8, 9])
+  # control: 6 at risk, 1 event at day 2, 1 of 5 at day 3 (one censored), 2 of 3 at day 5
+  control = [1, 5 / 6, 4 / 6, 4 / 6, 4 / 18, 4 / 18, 4 / 18, 4 / 18, 4 / 18]
+  np.testing.assert_allclose(curves["km"][:, 0], control)
+  np.testing.assert_allclose(curves["km"][:, 1], [1 / 2] * 9)
+  np.testing.assert_allclose(curves["km"][:, 2], [1] * 5 + [0] * 4)
+  np.testing.assert_allclose(curves["km"][:, 3], [1] * 6 + [1 / 2] * 3)
+
+
+def test_risk_table_suppressed():
+  curves = survival_curves.outcome_curves(columns(), "x", tmax=28)
+  np.testing.assert_array_equal(curves["ticks"], [0, 7, 14, 21, 28])
+  # at day 0: 6 / 2 / 1 / 2 at risk; at day 7: 1 / 0 / 0 / 2; nobody after day 9
+  expected = np.array([[6, np.nan, np.nan, np.nan], [np.nan, 0, 0, np.nan], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]])
+  np.testing.assert_array_equal(curves["risk_table"], expected)
+  assert [survival_curves._risk_label(count) for count in curves["risk_table"][0]] == ["6", "", "", ""]
+
+
+def test_adjusted_is_breslow():
+  # stcox i.drug: the control arm's curve is exp(-H0), H0 the Breslow cumulative
+  # baseline hazard, and arm j's is exp(-H0 hr_j)
+  data = columns()
+  curves = survival_curves.outcome_curves(data, "x", tmax=28)
+  kept = data["stop_x"] > data["start_date"]
+  days, drug, failed = (data[name][kept] for name in ("stop_x", "drug", "fail_x"))
+  days = days - 100
+  X = np.column_stack([drug == code for code in (1, 2, 3)]).astype(float)
+  coef = cox_engine.fit(cox_engine.RiskSets(days, failed == 1), X, robust=False).coef
+  risk = np.exp(X @ coef)
+  increments = [failed[days == t].sum() / risk[days >= t].sum() for t in curves["times"]]
+  control = np.exp(-np.cumsum(increments))
+  np.testing.assert_allclose(curves["adjusted"][:, 0], control)
+  for j in (1, 2, 3):
+    np.testing.assert_allclose(curves["adjusted"][:, j], control ** np.exp(coef[j - 1]))
+  assert curves["hazard"].shape == (survival_curves.HAZARD_POINTS, len(survival_curves.ARMS))
+
+
+def test_cache_round_trip(tmp_path, monkeypatch):
+  monkeypatch.setenv("CURVE_CACHE_DIR", str(tmp_path))
+  data = columns()
+  computed = survival_curves.cached_curves(data, "x")
+  assert len(os.listdir(tmp_path)) == 1
+  cached = survival_curves.cached_curves(data, "x")
+  for name, values in computed.items():
+    np.testing.assert_array_equal(cached[name], values)
+  data["fail_x"][0] = 0
+  survival_curves.cached_curves(data, "x")
+  assert len(os.listdir(tmp_path)) == 2
+
+
+def test_cache_outside_outputs(monkeypatch):
+  monkeypatch.delenv("CURVE_CACHE_DIR", raising=False)
+  assert not os.path.normpath(survival_curves.cache_dir()).startswith("output")
+
+
+@pytest.mark.parametrize("kind", survival_curves.KINDS)
+def test_render(kind):
+  svg = survival_curves.render(kind, "x", survival_curves.outcome_curves(columns(), "x")).render()
+  assert svg.startswith("<svg") and "nan" not in svg
@@ -0,0 +1,38 @@
+
+# --- SYNTHETIC TABLES TESTS ---
+
+import numpy as np
+
+import local_backend
+import synthetic_tables
+from conftest import extract
+
+
+def test_seeded(tmp_path):
+  rows = []
+  for name in ("a", "b"):
+    conn = synthetic_tables.populate(str(tmp_path / f"{name}.sqlite"), 300, seed=7, chunk_size=100)
+    rows.append(conn.execute("SELECT * FROM clinical_event ORDER BY rowid").fetchall())
+    conn.close()
+  assert rows[0] and rows[0] == rows[1]
+
+
+def test_rates(local_db):
+  conn = local_backend.connect(local_db)
+  patients = conn.execute("SELECT COUNT(*) FROM patient").fetchone()[0]
+  assert patients == 2000
+  for table in ("clinical_event", "medication", "vaccination"):
+    rows = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    assert abs(rows / patients - synthetic_tables.RATES[table]) < 0.1 * synthetic_tables.RATES[table], table
+
+
+def test_study_populated(local_db):
+  columns = extract(local_db)
+  population = np.asarray(columns["population"], dtype=bool)
+  assert 0.1 < population.mean() < 0.9
+  # outcomes follow the index date, so they land in the follow-up windows
+  for name in ("covid_hosp_date", "all_hosp_date", "death_date", "died_date_ons"):
+    assert (~np.isnat(columns[name][population])).sum() >= 5, name
+  # and the lookback flags, high-cost drugs included, have events
+  for name in ("solid_cancer", "diabetes", "imid_drug_HCD"):
+    assert columns[name][population].astype(bool).any(), name
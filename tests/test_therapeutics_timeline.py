@@ -0,0 +1,95 @@
+
+# --- COVID THERAPEUTICS TIMELINE TESTS ---
+# timeline() against each query filtered on its own, and a local extraction with the
+# timeline against one that queries each column.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import therapeutics_timeline
+from conftest import extract
+from therapeutics_timeline import Query
+
+DRUGS = ["Sotrovimab", "Paxlovid", "Molnupiravir"]
+STATUSES = ["Approved", "Treatment Complete", "Treatment Not Started", "Treatment Stopped"]
+
+
+@pytest.fixture
+def table():
+  rng = np.random.default_rng(5)
+  n = 1500
+  return pd.DataFrame({
+    "patient_id": rng.integers(1, 201, n),
+    "therapeutic": rng.choice(DRUGS, n),
+    "status": rng.choice(STATUSES, n),
+    "indication": rng.choice(["non_hospitalised", "hospital_onset"], n),
+    "date": pd.Timestamp("2022-01-01") + pd.to_timedelta(rng.integers(0, 120, n), unit="D"),
+    "risk_group": rng.choice(["Downs syndrome", "solid cancer", "IMID"], n),
+    "region": rng.choice(["London", "East"], n),
+  })
+
+
+@pytest.fixture
+def anchors():
+  rng = np.random.default_rng(6)
+  dates = pd.Timestamp("2022-01-01") + pd.to_timedelta(rng.integers(0, 120, 220), unit="D")
+  return pd.DataFrame({"positive_date": dates.where(rng.random(220) > 0.1)},
+                      index=pd.Index(np.arange(1, 221), name="patient_id"))
+
+
+def direct(table, query, anchors, options):
+  # the query on its own: filter, then the first or last match per patient
+  rows = table[table["status"].isin(query.statuses)]
+  if query.therapeutics is not None:
+    rows = rows[rows["therapeutic"].isin(query.therapeutics)]
+  if query.indications is not None:
+    rows = rows[rows["indication"].isin(query.indications)]
+  for expression, keep in ((query.lower, np.greater_equal), (query.upper, np.less_equal)):
+    if expression is not None:
+      bound = therapeutics_timeline._bound(expression, rows["patient_id"].to_numpy(), anchors, options)
+      rows = rows[keep(rows["date"], bound)]
+  rows = rows.sort_values("date", kind="stable", ascending=query.first).drop_duplicates("patient_id")
+  if query.returning == "binary_flag":
+    return anchors.index.isin(rows["patient_id"])
+  column = therapeutics_timeline.RETURNED_COLUMNS.get(query.returning, "date")
+  return rows.set_index("patient_id")[column].reindex(anchors.index).values
+
+
+def test_timeline_matches_direct(table, anchors):
+  options = {"index_date": "2022-02-01"}
+  queries = [
+    Query("first_sot", ("Sotrovimab",), therapeutics_timeline.DEFAULT_STATUSES, ("non_hospitalised",),
+          "positive_date", "positive_date + 5 days", True, "date"),
+    Query("last_stopped", ("Paxlovid", "Molnupiravir"), ("Treatment Stopped",), None,
+          "positive_date - 1 month", "positive_date", False, "date"),
+    Query("risk_group", None, therapeutics_timeline.DEFAULT_STATUSES, None, "index_date", None, True, "risk_group"),
+    Query("region", DRUGS, ("Approved",), None, "positive_date", None, True, "region"),
+    Query("treated", None, therapeutics_timeline.DEFAULT_STATUSES, None, None, "2022-02-15", True, "binary_flag"),
+  ]
+  result = therapeutics_timeline.timeline(table, queries, anchors, options)
+  assert list(result.columns) == [query.name for query in queries]
+  for query in queries:
+    expected = direct(table, query, anchors, options)
+    pd.testing.assert_series_equal(pd.Series(result[query.name].values), pd.Series(expected), obj=query.name)
+    assert pd.notna(result[query.name]).any()
+
+
+def test_plan_statuses():
+  queries = {query.name: query for query in therapeutics_timeline.plan()}
+  assert queries["sotrovimab_not_start"].statuses == ("Treatment Not Started",)
+  assert queries["high_risk_cohort_covid_therapeutics"].statuses == therapeutics_timeline.DEFAULT_STATUSES
+  # covid_therapeutics() passes the drug positionally, which cohortextractor reads as
+  # with_these_statuses
+  assert queries["sotrovimab"].statuses == ("Sotrovimab",) and queries["sotrovimab"].therapeutics is None
+  assert therapeutics_timeline.anchor_columns(queries["sotrovimab"], {"covid_test_positive_date"}) == (
+    "covid_test_positive_date",
+  )
+
+
+def test_extraction_matches_per_column(local_db):
+  names = [query.name for query in therapeutics_timeline.plan()] + ["date_treated"]
+  timelined, per_column = extract(local_db), extract(local_db, scans=False)
+  assert pd.notna(timelined["sotrovimab_not_start"]).any()
+  for name in names:
+    np.testing.assert_array_equal(timelined[name], per_column[name], name)
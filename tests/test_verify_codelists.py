@@ -0,0 +1,56 @@
+
+# --- CODELIST INTEGRITY CHECK TESTS ---
+
+import json
+import os
+
+import pytest
+
+import verify_codelists
+from codelist_cache import file_sha
+
+
+@pytest.fixture
+def codelist_dir(tmp_path):
+  # two good files, listed in both codelists.json and codelists.txt
+  files = {}
+  for name in ("a.csv", "b.csv"):
+    (tmp_path / name).write_text(f"code\n{name[0].upper()}1\n")
+    files[name] = {"id": f"user/x/{name[0]}/1", "sha": file_sha(str(tmp_path / name))}
+  (tmp_path / "codelists.json").write_text(json.dumps({"files": files}))
+  (tmp_path / "codelists.txt").write_text("# ids\nuser/x/a/1\nuser/x/b/1\n")
+  return tmp_path
+
+
+def test_clean(codelist_dir):
+  assert verify_codelists.check(str(codelist_dir)) == ({}, [])
+
+
+def test_problems(codelist_dir):
+  (codelist_dir / "a.csv").write_text("code\nA2\n")
+  os.remove(codelist_dir / "b.csv")
+  (codelist_dir / "c.csv").write_text("code\nC1\n")
+  with open(codelist_dir / "codelists.txt", "a") as f:
+    f.write("user/x/d/1\n")
+  problems, general = verify_codelists.check(str(codelist_dir))
+  assert sorted(problems) == ["a.csv", "b.csv", "c.csv"]
+  assert "does not match codelists.json" in problems["a.csv"][0]
+  assert problems["b.csv"] == ["missing from codelists/"]
+  assert problems["c.csv"] == ["not listed in codelists.json"]
+  assert general == ["user/x/d/1 is in codelists.txt but has no file in codelists.json"]
+
+
+def test_cached_hashes(codelist_dir, tmp_path, monkeypatch):
+  cache_path = str(tmp_path / "cache" / verify_codelists.HASH_CACHE)
+  first = verify_codelists.hash_files(str(codelist_dir), ["a.csv", "b.csv"], cache_path)
+  # a warm run only stats the files
+  monkeypatch.setattr(verify_codelists, "file_sha", None)
+  assert verify_codelists.hash_files(str(codelist_dir), ["a.csv", "b.csv"], cache_path) == first
+
+
+def test_dependents():
+  # the Down's syndrome codes feed a column, its maximum_of and the population
+  variables, columns = verify_codelists.dependents(["nhsd-downs-syndrome-icd-10.csv"])
+  assert variables == ["downs_syndrome_nhsd_icd10_codes"]
+  assert {"downs_syndrome_icd", "downs_syndrome", "population"} <= set(columns)
+  assert "downs_syndrome_snomed" not in columns